@@ -0,0 +1,115 @@
+# admission.py
+
+import asyncio
+import json
+from collections import deque
+
+
+# 受付拒否（キュー満杯または待ち時間超過）
+class AdmissionRejected(Exception):
+    def __init__(self, pool, reason):
+        super().__init__(f"{pool.name}: {reason}")
+        self.pool = pool
+        self.reason = reason
+
+
+# エンドポイント分類ごとの同時実行枠と待ち行列
+class AdmissionPool:
+    def __init__(self, name, limit, queue_size, max_wait, status_code=503, retry_after=1):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._waiters = deque()
+
+    async def acquire(self):
+        # 空きがあり待ち行列もなければ即座に受け付ける
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+
+        if len(self._waiters) >= self.queue_size:
+            self.rejected += 1
+            raise AdmissionRejected(self, "queue full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except asyncio.TimeoutError:
+            # タイムアウトと同時に枠を譲られていた場合はそのまま処理する
+            if not (waiter.done() and not waiter.cancelled()):
+                self.timed_out += 1
+                raise AdmissionRejected(self, "queue timeout")
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        self.admitted += 1
+
+    def release(self):
+        # 待っているリクエストに枠をそのまま引き渡す
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+
+# リクエストをプールに振り分けるASGIミドルウェア
+class AdmissionMiddleware:
+    def __init__(self, app, classify, pools):
+        self.app = app
+        self.classify = classify
+        self.pools = pools
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        pool = self.pools.get(self.classify(scope["method"], scope["path"]))
+        if pool is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await pool.acquire()
+        except AdmissionRejected as e:
+            await self._reject(e, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            pool.release()
+
+    async def _reject(self, error, send):
+        body = json.dumps({"detail": "Server is busy, please retry later"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": error.pool.status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(error.pool.retry_after).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -1,21 +1,90 @@
 # app.py
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Literal, Optional
 from contextlib import contextmanager
 from dotenv import load_dotenv
 import os
+import asyncio
+import random
+import secrets
+import time
+import base64
+import json
 import mysql.connector
 from decimal import Decimal
-from datetime import datetime
-import uuid
+from datetime import date, datetime, timedelta
+from admission import AdmissionPool, AdmissionMiddleware
+from rate_limit import MemoryBucketStore, RedisBucketStore, RateLimiter, RateLimited
+from auth import SessionTokens, UserCache
+from passwords import PasswordHasher
+from catalog_cache import ProductCache, BackgroundSnapshot, run_periodically
+from search_index import SearchIndex
+from autocomplete import PrefixSuggester
+from popularity import PopularityCounter
+from sales_rollup import SalesRollup, sales_totals
+from order_queue import DurableQueue, WorkerPool
+from reservations import StockReservations, DatabaseReservationStore, hot_product_ids
+from ids import UlidGenerator
+from replicas import ReplicaRouter
+from invalidation import InvalidationBus, transport_from_env
+from live_updates import ProductUpdateHub
+from compression import CompressionMiddleware, CompressedPayload, PayloadCache, negotiate
+from images import ImagePipeline, VARIANT_PATH, parse_byte_range
+from db import db_config, get_db_cursor
+from models import Product, Category
 
 load_dotenv()
 
 app = FastAPI()
 
+# エンドポイント分類ごとの同時実行数制限（上限を超えた分は待ち行列へ、溢れたら503）
+# 注文確定は専用の枠を持つため、閲覧が混雑しても影響を受けない
+admission_pools = {
+    "catalog": AdmissionPool(
+        "catalog",
+        limit=int(os.getenv("ADMISSION_CATALOG_LIMIT", 32)),
+        queue_size=int(os.getenv("ADMISSION_CATALOG_QUEUE", 64)),
+        max_wait=float(os.getenv("ADMISSION_CATALOG_MAX_WAIT", 0.5)),
+    ),
+    "cart": AdmissionPool(
+        "cart",
+        limit=int(os.getenv("ADMISSION_CART_LIMIT", 16)),
+        queue_size=int(os.getenv("ADMISSION_CART_QUEUE", 32)),
+        max_wait=float(os.getenv("ADMISSION_CART_MAX_WAIT", 2.0)),
+    ),
+    "checkout": AdmissionPool(
+        "checkout",
+        limit=int(os.getenv("ADMISSION_CHECKOUT_LIMIT", 8)),
+        queue_size=int(os.getenv("ADMISSION_CHECKOUT_QUEUE", 64)),
+        max_wait=float(os.getenv("ADMISSION_CHECKOUT_MAX_WAIT", 5.0)),
+        retry_after=2,
+    ),
+}
+
+def classify_request(method, path):
+    if path in ("/api/orders/create", "/api/orders/intake"):
+        return "checkout"
+    # 接続を張り続けるストリームは同時実行数の枠を使わない
+    if path == "/api/products/stream":
+        return None
+    if path.startswith("/api/cart"):
+        return "cart"
+    if method == "GET" and (path.startswith("/api/products") or path.startswith("/api/categories")):
+        return "catalog"
+    return None
+
+# レスポンス圧縮（COMPRESSION_MIN_SIZE バイト以上の本文を gzip / brotli で圧縮）
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
+
+# CORSヘッダーを拒否レスポンスにも付けるため、CORSより先に登録する
+app.add_middleware(AdmissionMiddleware, classify=classify_request, pools=admission_pools)
+
 # CORS設定
 app.add_middleware(
     CORSMiddleware,
@@ -23,49 +92,228 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
+)
+
+# 読み取り専用レプリカ（DB_REPLICAS に "host[:port]" をカンマ区切りで指定、認証情報はプライマリと共通）
+def replica_config(address):
+    host, _, port = address.strip().partition(":")
+    return dict(db_config, host=host, port=int(port or 3306))
+
+replica_router = ReplicaRouter(
+    [replica_config(address) for address in os.getenv("DB_REPLICAS", "").split(",") if address.strip()],
+    max_lag=float(os.getenv("DB_REPLICA_MAX_LAG", 2)),
+    pin_seconds=float(os.getenv("DB_REPLICA_PIN_SECONDS", 5))
 )
+REPLICA_CHECK_INTERVAL = int(os.getenv("DB_REPLICA_CHECK_INTERVAL", 1))
+
+@app.on_event("startup")
+async def start_replica_check():
+    if replica_router.enabled:
+        app.state.replica_check_task = asyncio.create_task(
+            run_periodically("check_replicas", replica_router.check, REPLICA_CHECK_INTERVAL)
+        )
 
-# MySQL接続情報
-db_config = {
-    "host": os.getenv("DB_HOST", "localhost"),
-    "user": os.getenv("DB_USER", "takuya_oshima"),
-    "password": os.getenv("DB_PASSWORD", "Shigure1230@"),
-    "database": os.getenv("DB_NAME", "ec_site")
+# レート制限（ルートグループごとに 1秒あたりの補充量, バースト量）
+# RATE_LIMIT_REDIS_URL を設定すると複数ワーカーでバケットを共有する
+rate_limit_budgets = {
+    "cart_user": (float(os.getenv("RATE_LIMIT_CART_USER_RATE", 5)), int(os.getenv("RATE_LIMIT_CART_USER_BURST", 20))),
+    "cart_ip": (float(os.getenv("RATE_LIMIT_CART_IP_RATE", 20)), int(os.getenv("RATE_LIMIT_CART_IP_BURST", 60))),
+    "login_user": (float(os.getenv("RATE_LIMIT_LOGIN_USER_RATE", 0.2)), int(os.getenv("RATE_LIMIT_LOGIN_USER_BURST", 5))),
+    "login_ip": (float(os.getenv("RATE_LIMIT_LOGIN_IP_RATE", 1)), int(os.getenv("RATE_LIMIT_LOGIN_IP_BURST", 10))),
 }
 
-# データベース接続のコンテキストマネージャ
-@contextmanager
-def get_db_cursor(isolation_level=None):
-    conn = mysql.connector.connect(**db_config)
-    cursor = None
+if os.getenv("RATE_LIMIT_REDIS_URL"):
+    rate_limit_store = RedisBucketStore(os.getenv("RATE_LIMIT_REDIS_URL"))
+else:
+    rate_limit_store = MemoryBucketStore(int(os.getenv("RATE_LIMIT_MAX_BUCKETS", 10000)))
+
+rate_limiter = RateLimiter(rate_limit_store, rate_limit_budgets)
+
+def enforce_rate_limit(group, request, user_key=None):
+    client_ip = request.client.host if request.client else "unknown"
     try:
-        if isolation_level:
-            conn.start_transaction(isolation_level=isolation_level)
-        cursor = conn.cursor(dictionary=True)
+        rate_limiter.check(f"{group}_ip", client_ip)
+        if user_key is not None:
+            rate_limiter.check(f"{group}_user", user_key)
+    except RateLimited as e:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+# セッショントークンとユーザー存在確認キャッシュ
+# SESSION_SECRET は全ワーカーで共通の値を設定する
+# 未設定時はプロセスごとに生成するため、他のワーカーで発行したトークンは検証できない
+# （複数ワーカー（WEB_CONCURRENCY > 1）で未設定なら起動しない）
+SESSION_SECRET = os.getenv("SESSION_SECRET")
+if not SESSION_SECRET:
+    if int(os.getenv("WEB_CONCURRENCY", 1)) > 1:
+        raise RuntimeError("SESSION_SECRET must be set when running more than one worker")
+    print("SESSION_SECRET is not set; session tokens are valid only in this process")
+    SESSION_SECRET = secrets.token_hex(32)
+
+session_tokens = SessionTokens(
+    SESSION_SECRET,
+    ttl=int(os.getenv("SESSION_TTL", 86400))
+)
+user_cache = UserCache(
+    max_size=int(os.getenv("USER_CACHE_SIZE", 10000)),
+    ttl=int(os.getenv("USER_CACHE_TTL", 300))
+)
+
+# パスワードハッシュ計算用のスレッドプール（同時実行数 = PASSWORD_HASH_WORKERS）
+password_hasher = PasswordHasher(max_workers=int(os.getenv("PASSWORD_HASH_WORKERS", 2)))
+
+# user_id の存在確認（有効なトークンまたはキャッシュがあればDBを参照しない）
+def ensure_user(cursor, request, user_id, status_code=401):
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        token_user_id = session_tokens.verify(authorization[len("Bearer "):])
+        if token_user_id is None:
+            raise HTTPException(status_code=401, detail="Invalid session token")
+        if token_user_id != user_id:
+            raise HTTPException(status_code=403, detail="Session does not match user")
+        return
+
+    if user_id in user_cache:
+        return
+
+    cursor.execute("SELECT id FROM users WHERE id = %s", (user_id,))
+    if not cursor.fetchone():
+        raise HTTPException(status_code=status_code, detail="User not found")
+    user_cache.add(user_id)
+
+# 読み取り専用の処理用（遅延の小さいレプリカ、なければプライマリ）
+# user_id を渡すと、直前に書き込んだユーザーはプライマリから読む
+@contextmanager
+def get_read_cursor(user_id=None):
+    with get_db_cursor(connection=replica_router.connect(user_id)) as cursor:
         yield cursor
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        if cursor:
-            cursor.close()
-        conn.close()
-
-# モデル定義
-class Product(BaseModel):
-    id: int
-    category_id: int
-    name: str
-    description: Optional[str] = None
-    price: int
-    stock: int
-    image_url: Optional[str] = None
-
-class Category(BaseModel):
-    id: int
-    name: str
 
+# デッドロック(1213)・ロック待ちタイムアウト(1205)はトランザクションごと再実行する
+RETRYABLE_DB_ERRORS = (1205, 1213)
+TRANSACTION_MAX_ATTEMPTS = int(os.getenv("TRANSACTION_MAX_ATTEMPTS", 5))
+TRANSACTION_RETRY_BUDGET = float(os.getenv("TRANSACTION_RETRY_BUDGET", 3.0))
+TRANSACTION_RETRY_BASE_DELAY = float(os.getenv("TRANSACTION_RETRY_BASE_DELAY", 0.02))
+
+transaction_retry_stats = {
+    "retries": {errno: 0 for errno in RETRYABLE_DB_ERRORS},
+    "recovered": 0,
+    "exhausted": 0,
+}
+
+# work(cursor) を1つのトランザクションとして実行し、競合で失敗した場合は
+# ジッター付き指数バックオフで再実行する（回数と経過時間の両方に上限あり）
+async def run_transaction(work, isolation_level=None):
+    deadline = time.monotonic() + TRANSACTION_RETRY_BUDGET
+    attempt = 1
+    while True:
+        try:
+            with get_db_cursor(isolation_level=isolation_level) as cursor:
+                result = work(cursor)
+            if attempt > 1:
+                transaction_retry_stats["recovered"] += 1
+            return result
+        except mysql.connector.Error as e:
+            if e.errno not in RETRYABLE_DB_ERRORS:
+                raise e
+
+            delay = random.uniform(0, TRANSACTION_RETRY_BASE_DELAY * 2 ** attempt)
+            if attempt >= TRANSACTION_MAX_ATTEMPTS or time.monotonic() + delay > deadline:
+                transaction_retry_stats["exhausted"] += 1
+                print(f"Transaction retries exhausted: {str(e)}")
+                raise HTTPException(
+                    status_code=503,
+                    detail="Server is busy, please retry later",
+                    headers={"Retry-After": "1"}
+                )
+
+            transaction_retry_stats["retries"][e.errno] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+# 商品キャッシュ（在庫・価格の更新時に該当IDを破棄する）
+product_cache = ProductCache(
+    max_size=int(os.getenv("PRODUCT_CACHE_SIZE", 10000)),
+    ttl=int(os.getenv("PRODUCT_CACHE_TTL", 60))
+)
+
+# キャッシュ破棄の通知（複数ワーカー・ホストで各プロセスのキャッシュをそろえる）
+# INVALIDATION_REDIS_URL: 複数ホスト / INVALIDATION_SOCKET_DIR, INVALIDATION_FILE: 同一ホスト
+invalidation_bus = InvalidationBus(transport_from_env())
+invalidation_bus.subscribe("products", product_cache.invalidate)
+
+# 書き込んだユーザーの読み取りのプライマリへの固定は全ワーカーで行う
+# （書き込み直後の読み取りは別のワーカーに届くことが多い。取りこぼした場合は各エンドポイントの読み直しに任せる）
+def pin_user_reads(user_id):
+    if replica_router.enabled:
+        invalidation_bus.publish("replica_pins", [user_id])
+
+def apply_replica_pins(user_ids):
+    for user_id in user_ids or []:
+        replica_router.pin(user_id)
+
+invalidation_bus.subscribe("replica_pins", apply_replica_pins)
+
+@app.on_event("startup")
+async def start_invalidation_bus():
+    invalidation_bus.start()
+
+@app.on_event("shutdown")
+async def stop_invalidation_bus():
+    await asyncio.get_running_loop().run_in_executor(None, invalidation_bus.stop)
+
+# キャッシュ可能なカタログ応答は圧縮済みの本文ごと保持する（バージョンごとに1回だけ圧縮する）
+catalog_payloads = PayloadCache(
+    max_entries=int(os.getenv("CATALOG_PAYLOAD_CACHE_SIZE", 1000)),
+    ttl=int(os.getenv("CATALOG_PAYLOAD_TTL", 30))
+)
+
+def encode_json(data):
+    return json.dumps(jsonable_encoder(data), ensure_ascii=False, separators=(",", ":")).encode()
+
+def payload_response(request, payload):
+    encoding = None
+    if len(payload.body) >= COMPRESSION_MIN_SIZE:
+        encoding = negotiate(request.headers.get("accept-encoding", ""))
+    headers = dict(payload.headers, Vary="Accept-Encoding")
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(payload.encoded(encoding), media_type="application/json", headers=headers)
+
+# 商品画像の縮小版（WebP）。未生成の画像は初回の参照時にプロセスプールで作る
+IMAGE_BASE_URL = os.getenv("IMAGE_BASE_URL", "http://localhost:8000")
+IMAGE_VARIANT_WIDTHS = {"thumb": 320, "medium": 800}
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+image_pipeline = ImagePipeline(
+    os.getenv("IMAGE_SOURCE_ROOT", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")),
+    os.getenv("IMAGE_VARIANT_ROOT", "image_variants"),
+    IMAGE_VARIANT_WIDTHS,
+    workers=int(os.getenv("IMAGE_WORKERS", 2))
+)
+
+def image_variant_urls(image_url):
+    variants = image_pipeline.urls(image_url) if image_url else None
+    if not variants:
+        return None
+    return {name: f"{IMAGE_BASE_URL}/images/{path}" for name, path in variants.items()}
+
+def format_product(product):
+    return {
+        'id': product['id'],
+        'category_id': product['category_id'],
+        'name': product['name'],
+        'description': product['description'] if product['description'] else None,
+        'price': int(product['price']) if product['price'] else 0,
+        'stock': product['stock'],
+        'image_url': product['image_url'] if product['image_url'] else None,
+        'image_variants': image_variant_urls(product['image_url'])
+    }
+
+# モデル定義（Product, Category は models.py）
 class LoginRequest(BaseModel):
     username: str
     password: str
@@ -78,6 +326,25 @@ class CartItemAdd(BaseModel):
 class CartItemUpdate(BaseModel):
     quantity: int = Field(gt=0)
 
+class CartOperation(BaseModel):
+    op: Literal["add", "set", "remove"]
+    product_id: int
+    quantity: int = Field(default=0, ge=0)
+
+class CartBatch(BaseModel):
+    user_id: int
+    operations: List[CartOperation]
+    atomic: bool = False
+
+class StockAdjustment(BaseModel):
+    # set: 在庫数を quantity にする / add: quantity を加算する（負数で減算）
+    mode: Literal["set", "add"]
+    product_id: int
+    quantity: int
+
+class StockAdjustmentBatch(BaseModel):
+    adjustments: List[StockAdjustment]
+
 class OrderCreate(BaseModel):
     user_id: int
     payment_method: str
@@ -88,68 +355,189 @@ class OrderCreate(BaseModel):
 
 # ログインエンドポイント
 @app.post("/api/login")
-async def login(request: LoginRequest):
+async def login(request: LoginRequest, http_request: Request):
+    enforce_rate_limit("login", http_request, request.username)
     try:
         with get_db_cursor() as cursor:
             cursor.execute(
-                "SELECT id FROM users WHERE name = %s AND password = %s",
-                (request.username, request.password)
+                "SELECT id, password FROM users WHERE name = %s",
+                (request.username,)
             )
-            user = cursor.fetchone()
-            
-            if user:
-                return {"userId": user["id"]}
+            users = cursor.fetchall()
+
+        # パスワード照合はDB接続を保持せずスレッドプールで行う
+        user = None
+        needs_rehash = False
+        for candidate in users or [{"id": None, "password": None}]:
+            matched, needs_rehash = await password_hasher.verify(
+                request.password, candidate["password"]
+            )
+            if matched:
+                user = candidate
+                break
+
+        if not user:
             raise HTTPException(
                 status_code=401,
                 detail="ユーザー名またはパスワードが正しくありません"
             )
+
+        # 平文または旧パラメータのパスワードはログイン時にハッシュへ移行する
+        if needs_rehash:
+            password_hash = await password_hasher.hash(request.password)
+            with get_db_cursor() as cursor:
+                cursor.execute(
+                    "UPDATE users SET password = %s WHERE id = %s AND password = %s",
+                    (password_hash, user["id"], user["password"])
+                )
+
+        user_cache.add(user["id"])
+        return {
+            "userId": user["id"],
+            "token": session_tokens.issue(user["id"])
+        }
     except Exception as e:
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
 
+# 商品一覧の並び順（並び替えカラム, 降順か）
+# それぞれ (category_id, カラム, id) / (カラム, id) の複合インデックスで並び替え・ページングする
+ProductSort = Literal["id", "price_asc", "price_desc", "newest", "popularity"]
+PRODUCT_SORTS = {
+    "id": (None, False),
+    "price_asc": ("price", False),
+    "price_desc": ("price", True),
+    "newest": ("created_at", True),
+    "popularity": ("popularity", True),
+}
+PRODUCT_LIST_MAX_LIMIT = int(os.getenv("PRODUCT_LIST_MAX_LIMIT", 100))
+
+def encode_list_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+def decode_list_cursor(value):
+    # [並び替えカラムの値, id] の形でなければ不正なカーソルとして扱う
+    try:
+        position = json.loads(base64.urlsafe_b64decode(value.encode()))
+    except ValueError:
+        position = None
+    if (not isinstance(position, list) or len(position) != 2
+            or not isinstance(position[0], (str, int, float, type(None))) or type(position[1]) is not int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return position
+
+# 絞り込み・並び替え・キーセットページングに対応した商品一覧の取得
+# 戻り値: (商品リスト, 次ページのカーソル)
+def query_product_list(cursor, category_id=None, min_price=None, max_price=None,
+                       in_stock=False, sort="id", limit=None, after=None):
+    column, descending = PRODUCT_SORTS[sort]
+    conditions = []
+    params = []
+    if category_id is not None:
+        conditions.append("category_id = %s")
+        params.append(category_id)
+    if min_price is not None:
+        conditions.append("price >= %s")
+        params.append(min_price)
+    if max_price is not None:
+        conditions.append("price <= %s")
+        params.append(max_price)
+    if in_stock:
+        conditions.append(f"{AVAILABLE_STOCK_SQL} > 0")
+
+    if limit is not None:
+        limit = min(max(limit, 1), PRODUCT_LIST_MAX_LIMIT)
+    elif after:
+        limit = PRODUCT_LIST_MAX_LIMIT
+
+    if after:
+        position = decode_list_cursor(after)
+        operator = "<" if descending else ">"
+        if column is None:
+            conditions.append(f"id {operator} %s")
+            params.append(position[-1])
+        else:
+            conditions.append(f"({column} {operator} %s OR ({column} = %s AND id {operator} %s))")
+            params.extend([position[0], position[0], position[1]])
+
+    direction = "DESC" if descending else "ASC"
+    order_by = f"{column} {direction}, id {direction}" if column else f"id {direction}"
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    limit_clause = ""
+    if limit is not None:
+        # 次ページの有無を判定するため1件多く取得する
+        limit_clause = "LIMIT %s"
+        params.append(limit + 1)
+
+    cursor.execute(f"""
+        SELECT 
+            id,
+            category_id,
+            name,
+            description,
+            price,
+            {AVAILABLE_STOCK_SQL} AS stock,
+            image_url,
+            created_at,
+            popularity
+        FROM products
+        {where}
+        ORDER BY {order_by}
+        {limit_clause}
+    """, params)
+    rows = cursor.fetchall()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_list_cursor([last[column] if column else None, last['id']])
+
+    return [format_product(row) for row in rows], next_cursor
+
 # 商品一覧取得
 @app.get("/api/products", response_model=List[Product])
-async def get_products():
+async def get_products(
+    request: Request,
+    min_price: Optional[int] = None,
+    max_price: Optional[int] = None,
+    in_stock: bool = False,
+    sort: ProductSort = "id",
+    limit: Optional[int] = None,
+    after: Optional[str] = None
+):
+    # 在庫・価格が更新されると product_cache.version が進み、キャッシュした一覧は使われなくなる
+    # 新しい version で保存する内容に遅延中のレプリカの古い値が入らないよう、プライマリから読む
+    key = ("products", request.url.query)
+    version = product_cache.version
+    payload = catalog_payloads.get(key, version)
+    if payload is not None:
+        return payload_response(request, payload)
+
     try:
         with get_db_cursor() as cursor:
-            cursor.execute("""
-                SELECT 
-                    id,
-                    category_id,
-                    name,
-                    description,
-                    price,
-                    stock,
-                    image_url
-                FROM products
-                ORDER BY id
-            """)
-            products = cursor.fetchall()
-            
-            formatted_products = []
-            for product in products:
-                formatted_product = {
-                    'id': product['id'],
-                    'category_id': product['category_id'],
-                    'name': product['name'],
-                    'description': product['description'] if product['description'] else None,
-                    'price': int(product['price']) if product['price'] else 0,
-                    'stock': product['stock'],
-                    'image_url': product['image_url'] if product['image_url'] else None
-                }
-                formatted_products.append(formatted_product)
-                
-            return formatted_products
+            products, next_cursor = query_product_list(
+                cursor, min_price=min_price, max_price=max_price, in_stock=in_stock,
+                sort=sort, limit=limit, after=after
+            )
+        payload = CompressedPayload(
+            encode_json(products),
+            headers={"X-Next-Cursor": next_cursor} if next_cursor else None
+        )
+        catalog_payloads.put(key, version, payload)
+        return payload_response(request, payload)
     except Exception as e:
         print(f"Error in get_products: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
         raise HTTPException(status_code=500, detail=str(e))
 
 # カテゴリー一覧取得
 @app.get("/api/categories", response_model=List[Category])
 async def get_categories():
     try:
-        with get_db_cursor() as cursor:
+        with get_read_cursor() as cursor:
             cursor.execute("SELECT id, name FROM categories ORDER BY id")
             categories = cursor.fetchall()
             
@@ -166,57 +554,496 @@ async def get_categories():
         print(f"Error in get_categories: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# トップページ用データの構築（カテゴリー・商品数・カテゴリー別の新着商品）
+HOME_PRODUCTS_PER_CATEGORY = int(os.getenv("HOME_PRODUCTS_PER_CATEGORY", 8))
+HOME_FEATURED_COUNT = int(os.getenv("HOME_FEATURED_COUNT", 5))
+
+def build_home_snapshot():
+    with get_db_cursor() as cursor:
+        cursor.execute("""
+            SELECT c.id, c.name, COUNT(p.id) AS product_count
+            FROM categories c
+            LEFT JOIN products p ON p.category_id = c.id
+            GROUP BY c.id, c.name
+            ORDER BY c.id
+        """)
+        categories = cursor.fetchall()
+
+        cursor.execute(f"""
+            SELECT id, category_id, name, description, price, {available_stock_sql("ranked")} AS stock, image_url
+            FROM (
+                SELECT 
+                    id,
+                    category_id,
+                    name,
+                    description,
+                    price,
+                    stock,
+                    image_url,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY category_id
+                        ORDER BY created_at DESC, id DESC
+                    ) AS rank_in_category
+                FROM products
+            ) ranked
+            WHERE rank_in_category <= %s
+            ORDER BY category_id, rank_in_category
+        """, (HOME_PRODUCTS_PER_CATEGORY,))
+        products = [format_product(product) for product in cursor.fetchall()]
+
+    products_by_category = {}
+    for product in products:
+        products_by_category.setdefault(product['category_id'], []).append(product)
+
+    featured = sorted(products, key=lambda product: product['id'], reverse=True)[:HOME_FEATURED_COUNT]
+    return {
+        'featured': featured,
+        'categories': [{
+            'id': category['id'],
+            'name': category['name'],
+            'product_count': category['product_count'],
+            'products': products_by_category.get(category['id'], [])
+        } for category in categories]
+    }
+
+home_snapshot = BackgroundSnapshot(
+    "home",
+    build_home_snapshot,
+    interval=int(os.getenv("HOME_REFRESH_INTERVAL", 60))
+)
+
+@app.on_event("startup")
+async def start_home_refresh():
+    app.state.home_refresh_task = asyncio.create_task(home_snapshot.run_forever())
+
+# トップページ用データ取得（バックグラウンドで構築済みのスナップショットを返す）
+@app.get("/api/home")
+async def get_home(request: Request):
+    try:
+        snapshot = await home_snapshot.get()
+        version = home_snapshot.version
+        payload = catalog_payloads.get(("home",), version)
+        if payload is None:
+            payload = CompressedPayload(encode_json(snapshot))
+            catalog_payloads.put(("home",), version, payload)
+        return payload_response(request, payload)
+    except Exception as e:
+        print(f"Error in get_home: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 商品検索インデックス（products.updated_at を基準に差分同期する）
+SEARCH_SYNC_INTERVAL = int(os.getenv("SEARCH_SYNC_INTERVAL", 10))
+SEARCH_SYNC_BATCH_SIZE = int(os.getenv("SEARCH_SYNC_BATCH_SIZE", 1000))
+# 削除された商品の除去は差分同期では検出できないため、別に間隔を空けて行う
+# （検索結果は load_products() で引き直すので、削除済みの商品が表示されることはない）
+SEARCH_PRUNE_INTERVAL = int(os.getenv("SEARCH_PRUNE_INTERVAL", 600))
+# updated_at は秒精度のため、前回同期位置から少し遡って取り直す
+SEARCH_SYNC_OVERLAP = timedelta(seconds=2)
+
+search_index = SearchIndex()
+
+def sync_search_index():
+    since = search_index.synced_until
+    position = (since - SEARCH_SYNC_OVERLAP, 0) if since else (datetime(1970, 1, 1), 0)
+    with get_db_cursor() as cursor:
+        while True:
+            cursor.execute("""
+                SELECT id, category_id, name, description, updated_at
+                FROM products
+                WHERE (updated_at, id) > (%s, %s)
+                ORDER BY updated_at, id
+                LIMIT %s
+            """, (position[0], position[1], SEARCH_SYNC_BATCH_SIZE))
+            rows = cursor.fetchall()
+            for row in rows:
+                search_index.add(row['id'], row['category_id'], row['name'], row['description'])
+            if rows:
+                position = (rows[-1]['updated_at'], rows[-1]['id'])
+                search_index.synced_until = position[0]
+            if len(rows) < SEARCH_SYNC_BATCH_SIZE:
+                break
+
+# 削除された商品をインデックスから取り除く（インデックス内のIDを主キーでまとめて確認する）
+def prune_search_index():
+    product_ids = sorted(search_index.product_ids())
+    removed = []
+    with get_db_cursor() as cursor:
+        for start in range(0, len(product_ids), SEARCH_SYNC_BATCH_SIZE):
+            batch = product_ids[start:start + SEARCH_SYNC_BATCH_SIZE]
+            placeholders = ", ".join(["%s"] * len(batch))
+            cursor.execute(f"SELECT id FROM products WHERE id IN ({placeholders})", batch)
+            existing_ids = {row['id'] for row in cursor.fetchall()}
+            removed.extend(product_id for product_id in batch if product_id not in existing_ids)
+    for product_id in removed:
+        search_index.remove(product_id)
+
+@app.on_event("startup")
+async def start_search_sync():
+    app.state.search_sync_task = asyncio.create_task(
+        run_periodically("sync_search_index", sync_search_index, SEARCH_SYNC_INTERVAL)
+    )
+
+@app.on_event("startup")
+async def start_search_prune():
+    async def prune_later():
+        # 起動直後は差分同期で全件を読み込むので、初回の確認は1周期後に行う
+        await asyncio.sleep(SEARCH_PRUNE_INTERVAL)
+        await run_periodically("prune_search_index", prune_search_index, SEARCH_PRUNE_INTERVAL)
+
+    app.state.search_prune_task = asyncio.create_task(prune_later())
+
+# 商品検索（商品名・説明文の全文検索、カテゴリー絞り込み・ページング対応）
+@app.get("/api/search")
+async def search_products(q: str, category_id: Optional[int] = None, page: int = 1, per_page: int = 20):
+    page = max(page, 1)
+    per_page = min(max(per_page, 1), 100)
+    try:
+        total, hits = search_index.search(
+            q, category_id=category_id, offset=(page - 1) * per_page, limit=per_page
+        )
+        products = load_products([product_id for product_id, _ in hits])
+        return {
+            "total": total,
+            "page": page,
+            "per_page": per_page,
+            "products": [
+                dict(products[product_id], score=round(score, 4))
+                for product_id, score in hits if product_id in products
+            ]
+        }
+    except Exception as e:
+        print(f"Error in search_products: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 商品名の入力補完（人気度で重み付けした候補を定期的に作り直し、参照を丸ごと差し替える）
+SUGGEST_TOP_K = int(os.getenv("SUGGEST_TOP_K", 10))
+
+def build_suggester():
+    with get_db_cursor() as cursor:
+        cursor.execute("SELECT id, name, popularity FROM products")
+        products = [(row['id'], row['name'], float(row['popularity'])) for row in cursor.fetchall()]
+    return PrefixSuggester(products, top_k=SUGGEST_TOP_K)
+
+suggest_snapshot = BackgroundSnapshot(
+    "suggest",
+    build_suggester,
+    interval=int(os.getenv("SUGGEST_REFRESH_INTERVAL", 300))
+)
+
+@app.on_event("startup")
+async def start_suggest_refresh():
+    app.state.suggest_refresh_task = asyncio.create_task(suggest_snapshot.run_forever())
+
+# 入力補完候補取得（DBには問い合わせない）
+@app.get("/api/suggest")
+async def suggest_products(q: str, limit: int = SUGGEST_TOP_K):
+    suggester = suggest_snapshot.value
+    if suggester is None:
+        return {"suggestions": []}
+    return {"suggestions": suggester.suggest(q, limit)}
+
 # カテゴリー別商品取得
 @app.get("/api/products/category/{category_id}", response_model=List[Product])
-async def get_products_by_category(category_id: int):
+async def get_products_by_category(
+    category_id: int,
+    response: Response,
+    min_price: Optional[int] = None,
+    max_price: Optional[int] = None,
+    in_stock: bool = False,
+    sort: ProductSort = "id",
+    limit: Optional[int] = None,
+    after: Optional[str] = None
+):
     try:
         with get_db_cursor() as cursor:
-            cursor.execute("""
+            products, next_cursor = query_product_list(
+                cursor, category_id=category_id, min_price=min_price, max_price=max_price,
+                in_stock=in_stock, sort=sort, limit=limit, after=after
+            )
+            if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
+            return products
+    except Exception as e:
+        print(f"Error in get_products_by_category: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 人気度カウンタ（注文・カート追加で加算し、まとめてDBへ反映する）
+POPULARITY_ORDER_WEIGHT = float(os.getenv("POPULARITY_ORDER_WEIGHT", 1.0))
+POPULARITY_CART_WEIGHT = float(os.getenv("POPULARITY_CART_WEIGHT", 0.2))
+POPULARITY_FLUSH_INTERVAL = int(os.getenv("POPULARITY_FLUSH_INTERVAL", 10))
+POPULARITY_FLUSH_BATCH_SIZE = 500
+
+popularity = PopularityCounter(
+    half_life=float(os.getenv("POPULARITY_HALF_LIFE_DAYS", 7)) * 86400,
+    # 全ワーカーで共通の値にする
+    epoch=datetime.fromisoformat(os.getenv("POPULARITY_EPOCH", "2024-01-01")).timestamp()
+)
+
+def flush_popularity():
+    pending = popularity.drain()
+    if not pending:
+        return
+    try:
+        product_ids = sorted(pending)
+        for start in range(0, len(product_ids), POPULARITY_FLUSH_BATCH_SIZE):
+            batch = product_ids[start:start + POPULARITY_FLUSH_BATCH_SIZE]
+            cases = " ".join(["WHEN %s THEN %s"] * len(batch))
+            placeholders = ", ".join(["%s"] * len(batch))
+            params = [value for product_id in batch for value in (product_id, pending[product_id])]
+            with get_db_cursor() as cursor:
+                # updated_at を自分自身で上書きし、検索インデックスの再同期対象にしない
+                cursor.execute(f"""
+                    UPDATE products
+                    SET popularity = popularity + CASE id {cases} END,
+                        updated_at = updated_at
+                    WHERE id IN ({placeholders})
+                """, params + batch)
+            for product_id in batch:
+                del pending[product_id]
+            popularity.flushed += len(batch)
+    finally:
+        popularity.restore(pending)
+
+@app.on_event("startup")
+async def start_popularity_flush():
+    app.state.popularity_flush_task = asyncio.create_task(
+        run_periodically("flush_popularity", flush_popularity, POPULARITY_FLUSH_INTERVAL)
+    )
+
+@app.on_event("shutdown")
+async def flush_popularity_on_shutdown():
+    flush_popularity()
+
+# 人気商品ランキング取得（products.popularity のインデックス順に読むだけで集計はしない）
+@app.get("/api/products/popular")
+async def get_popular_products(limit: int = 10, category_id: Optional[int] = None):
+    limit = min(max(limit, 1), PRODUCT_LIST_MAX_LIMIT)
+    where = "WHERE category_id = %s" if category_id is not None else ""
+    params = [category_id] if category_id is not None else []
+    try:
+        with get_db_cursor() as cursor:
+            cursor.execute(f"""
                 SELECT 
                     id,
                     category_id,
                     name,
                     description,
                     price,
-                    stock,
+                    {AVAILABLE_STOCK_SQL} AS stock,
+                    image_url,
+                    popularity
+                FROM products
+                {where}
+                ORDER BY popularity DESC, id DESC
+                LIMIT %s
+            """, params + [limit])
+            rows = cursor.fetchall()
+
+        scale = popularity.scale()
+        return [
+            dict(format_product(row), popularity=round(row['popularity'] / scale, 4))
+            for row in rows
+        ]
+    except Exception as e:
+        print(f"Error in get_popular_products: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 商品IDのリストから商品を取得（キャッシュにない分だけ1回のINクエリで取得）
+def load_products(product_ids):
+    found, missing = product_cache.get_many(product_ids)
+    if missing:
+        version = product_cache.version
+        placeholders = ", ".join(["%s"] * len(missing))
+        with get_db_cursor() as cursor:
+            cursor.execute(f"""
+                SELECT 
+                    id,
+                    category_id,
+                    name,
+                    description,
+                    price,
+                    {AVAILABLE_STOCK_SQL} AS stock,
                     image_url
                 FROM products 
-                WHERE category_id = %s
-                ORDER BY id
-            """, (category_id,))
-            products = cursor.fetchall()
-            
-            formatted_products = []
-            for product in products:
-                formatted_product = {
-                    'id': product['id'],
-                    'category_id': product['category_id'],
-                    'name': product['name'],
-                    'description': product['description'] if product['description'] else None,
-                    'price': int(product['price']) if product['price'] else 0,
-                    'stock': product['stock'],
-                    'image_url': product['image_url'] if product['image_url'] else None
-                }
-                formatted_products.append(formatted_product)
-                
-            return formatted_products
+                WHERE id IN ({placeholders})
+            """, missing)
+            loaded = [format_product(product) for product in cursor.fetchall()]
+        product_cache.put_many(loaded, version=version)
+        found.update((product['id'], product) for product in loaded)
+    return found
+
+# 複数商品の一括取得
+PRODUCT_BATCH_MAX_IDS = int(os.getenv("PRODUCT_BATCH_MAX_IDS", 100))
+
+@app.get("/api/products/batch")
+async def get_products_batch(ids: str):
+    try:
+        product_ids = list(dict.fromkeys(int(value) for value in ids.split(",") if value.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma-separated integers")
+    if len(product_ids) > PRODUCT_BATCH_MAX_IDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many ids (max {PRODUCT_BATCH_MAX_IDS})"
+        )
+
+    try:
+        found = load_products(product_ids)
+        return {
+            "products": [found[product_id] for product_id in product_ids if product_id in found],
+            "missing": [product_id for product_id in product_ids if product_id not in found]
+        }
     except Exception as e:
-        print(f"Error in get_products_by_category: {str(e)}")
+        print(f"Error in get_products_batch: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 在庫数・価格のライブ配信（Server-Sent Events）
+# 在庫・価格の書き込みは invalidation_bus で全ワーカーに通知されるので、その通知を受けて
+# 購読中の商品だけを1回のINクエリで読み直し、値が変わったものを各接続へ送る
+LIVE_UPDATES_KEEPALIVE = int(os.getenv("LIVE_UPDATES_KEEPALIVE", 15))
+
+def load_stock_and_price(product_ids):
+    placeholders = ", ".join(["%s"] * len(product_ids))
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            f"SELECT id, {AVAILABLE_STOCK_SQL} AS stock, price FROM products WHERE id IN ({placeholders})",
+            product_ids
+        )
+        rows = cursor.fetchall()
+    return [{
+        'id': row['id'],
+        'stock': row['stock'],
+        'price': int(row['price'])
+    } for row in rows]
+
+live_updates = ProductUpdateHub(load_stock_and_price)
+invalidation_bus.subscribe("products", live_updates.mark_dirty)
+
+@app.on_event("startup")
+async def start_live_updates():
+    app.state.live_updates_task = asyncio.create_task(live_updates.run())
+
+@app.get("/api/products/stream")
+async def stream_product_updates(ids: str, request: Request):
+    try:
+        product_ids = list(dict.fromkeys(int(value) for value in ids.split(",") if value.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma-separated integers")
+    if not product_ids or len(product_ids) > PRODUCT_BATCH_MAX_IDS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Specify 1 to {PRODUCT_BATCH_MAX_IDS} ids"
+        )
+
+    async def events():
+        subscriber = live_updates.subscribe(product_ids)
+        try:
+            # 接続直後に現在の値を送る
+            loop = asyncio.get_running_loop()
+            for update in await loop.run_in_executor(None, load_stock_and_price, product_ids):
+                yield f"event: product\ndata: {json.dumps(update)}\n\n"
+            while not await request.is_disconnected():
+                updates = await subscriber.next(LIVE_UPDATES_KEEPALIVE)
+                if not updates:
+                    yield ": keep-alive\n\n"
+                for update in updates:
+                    yield f"event: product\ndata: {json.dumps(update)}\n\n"
+        finally:
+            live_updates.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.on_event("startup")
+async def start_image_pipeline():
+    image_pipeline.start()
+    app.state.image_refresh_task = asyncio.create_task(
+        run_periodically("refresh_image_variants", image_pipeline.refresh, int(os.getenv("IMAGE_REFRESH_INTERVAL", 60)))
+    )
+
+@app.on_event("shutdown")
+async def stop_image_pipeline():
+    image_pipeline.stop()
+
+# 商品画像の縮小版の配信（ファイル名が内容のハッシュなので、無期限にキャッシュさせる）
+@app.get("/images/{shard}/{name}")
+async def get_image_variant(shard: str, name: str, request: Request):
+    relative_path = f"{shard}/{name}"
+    if not VARIANT_PATH.match(relative_path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    path = os.path.join(image_pipeline.output_root, relative_path)
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    etag = f'"{name[:-len(".webp")]}"'
+    headers = {"Cache-Control": IMAGE_CACHE_CONTROL, "ETag": etag, "Accept-Ranges": "bytes"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        byte_range = parse_byte_range(request.headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers=dict(headers, **{"Content-Range": f"bytes */{size}"}))
+    if byte_range is None:
+        # サーバーが対応していれば sendfile で送られる
+        return FileResponse(path, media_type="image/webp", headers=headers)
+
+    start, end = byte_range
+    with open(path, "rb") as file:
+        file.seek(start)
+        body = file.read(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return Response(body, status_code=206, media_type="image/webp", headers=headers)
+
+# 関連商品取得（recommendations.py で事前計算した結果を主キーで引くだけ）
+@app.get("/api/products/{product_id}/related")
+async def get_related_products(product_id: int, limit: int = 10):
+    limit = min(max(limit, 1), 20)
+    try:
+        with get_db_cursor() as cursor:
+            cursor.execute("""
+                SELECT related_product_id, score
+                FROM product_related
+                WHERE product_id = %s
+                ORDER BY position
+                LIMIT %s
+            """, (product_id, limit))
+            rows = cursor.fetchall()
+
+        products = load_products([row['related_product_id'] for row in rows])
+        return [
+            dict(products[row['related_product_id']], score=round(row['score'], 4))
+            for row in rows if row['related_product_id'] in products
+        ]
+    except Exception as e:
+        print(f"Error in get_related_products: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # 商品詳細取得
 @app.get("/api/products/{product_id}", response_model=Product)
 async def get_product(product_id: int):
+    cached = product_cache.get(product_id)
+    if cached:
+        return cached
+
     try:
+        version = product_cache.version
         with get_db_cursor() as cursor:
-            cursor.execute("""
+            cursor.execute(f"""
                 SELECT 
                     id,
                     category_id,
                     name,
                     description,
                     price,
-                    stock,
+                    {AVAILABLE_STOCK_SQL} AS stock,
                     image_url
                 FROM products 
                 WHERE id = %s
@@ -226,15 +1053,8 @@ async def get_product(product_id: int):
             if product is None:
                 raise HTTPException(status_code=404, detail="Product not found")
                 
-            formatted_product = {
-                'id': product['id'],
-                'category_id': product['category_id'],
-                'name': product['name'],
-                'description': product['description'] if product['description'] else None,
-                'price': int(product['price']) if product['price'] else 0,
-                'stock': product['stock'],
-                'image_url': product['image_url'] if product['image_url'] else None
-            }
+            formatted_product = format_product(product)
+            product_cache.put_many([formatted_product], version=version)
             
             return formatted_product
     except Exception as e:
@@ -242,17 +1062,84 @@ async def get_product(product_id: int):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
 
+# アクセスが集中する商品の在庫引当（HOT_PRODUCT_IDS にカンマ区切りで指定）
+# カート追加・注文確定で products 行をロックせず、メモリ上の期限付き引当で在庫を確保する
+# 各ワーカーが切り出した数は stock_reservations に記録し、停止したワーカーの分は
+# RESERVATION_WORKER_TIMEOUT 秒後に他のワーカーが products.stock へ戻す
+# ユーザーの引当を変えたワーカーは invalidation_bus で知らせ、他のワーカーは同じユーザーの引当を外す
+RESERVATION_BLOCK_SIZE = int(os.getenv("RESERVATION_BLOCK_SIZE", 50))
+RESERVATION_HOLD_SECONDS = int(os.getenv("RESERVATION_HOLD_SECONDS", 600))
+RESERVATION_RECONCILE_INTERVAL = int(os.getenv("RESERVATION_RECONCILE_INTERVAL", 5))
+RESERVATION_WORKER_TIMEOUT = int(os.getenv("RESERVATION_WORKER_TIMEOUT", 60))
+
+reservations = StockReservations(
+    hot_product_ids(),
+    DatabaseReservationStore(
+        get_db_cursor,
+        invalidation_bus.origin,
+        worker_timeout=RESERVATION_WORKER_TIMEOUT,
+        notify=lambda product_ids: invalidation_bus.publish("products", product_ids)
+    ),
+    block_size=RESERVATION_BLOCK_SIZE,
+    hold_seconds=RESERVATION_HOLD_SECONDS,
+    workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+    on_hold_change=lambda changes: invalidation_bus.publish(
+        "reservation_holds",
+        [[invalidation_bus.origin, product_id, user_id, changed_at] for product_id, user_id, changed_at in changes]
+    )
+)
+
+def drop_remote_holds(keys):
+    # keys が None（通知の取りこぼし）の場合、他のワーカーと重なった引当は期限切れで解放される
+    if keys is None:
+        return
+    reservations.drop_holds([
+        (product_id, user_id, changed_at)
+        for origin, product_id, user_id, changed_at in keys
+        if origin != invalidation_bus.origin
+    ])
+
+invalidation_bus.subscribe("reservation_holds", drop_remote_holds)
+
+# 販売可能な在庫数のSQL式
+# 引当対象の商品は products.stock に、各ワーカーが切り出してまだ引き当てていない分を足す
+def available_stock_sql(table):
+    if not reservations.product_ids:
+        return f"{table}.stock"
+    product_ids = ", ".join(str(product_id) for product_id in sorted(reservations.product_ids))
+    return f"""({table}.stock + CASE WHEN {table}.id IN ({product_ids}) THEN COALESCE((
+        SELECT SUM(r.quantity - r.held) FROM stock_reservations r WHERE r.product_id = {table}.id
+    ), 0) ELSE 0 END)"""
+
+AVAILABLE_STOCK_SQL = available_stock_sql("products")
+
+@app.on_event("startup")
+async def start_reservation_reconcile():
+    app.state.reservation_reconcile_task = asyncio.create_task(
+        run_periodically("reconcile_reservations", reservations.reconcile, RESERVATION_RECONCILE_INTERVAL)
+    )
+
+@app.on_event("shutdown")
+async def release_reservations_on_shutdown():
+    # 引当はメモリ上にしかないので、終了時は全部DBへ戻す（カートの商品は注文確定時に引き当て直す）
+    # 正常に終了できなかった場合は、他のワーカーが RESERVATION_WORKER_TIMEOUT 秒後に回収する
+    reservations.reconcile(release_all=True)
+
 # カートアイテム追加
 @app.post("/api/cart/add")
-async def add_to_cart(item: CartItemAdd):
-    try:
-        with get_db_cursor(isolation_level='REPEATABLE READ') as cursor:
-            # ユーザーの存在確認
-            cursor.execute("SELECT id FROM users WHERE id = %s", (item.user_id,))
-            if not cursor.fetchone():
-                raise HTTPException(status_code=401, detail="User not found")
+async def add_to_cart(item: CartItemAdd, request: Request):
+    enforce_rate_limit("cart", request, item.user_id)
+    hot = item.product_id in reservations
 
-            # 商品の存在と在庫確認
+    def add_item(cursor):
+        # ユーザーの存在確認
+        ensure_user(cursor, request, item.user_id)
+
+        # 商品の存在と在庫確認（引当対象の商品は行をロックせず、後でメモリ上の引当で確認する）
+        if hot:
+            cursor.execute("SELECT id FROM products WHERE id = %s", (item.product_id,))
+            product = cursor.fetchone()
+        else:
             cursor.execute("""
                 SELECT stock, price, name 
                 FROM products 
@@ -260,75 +1147,160 @@ async def add_to_cart(item: CartItemAdd):
                 FOR UPDATE
             """, (item.product_id,))
             product = cursor.fetchone()
-            if not product:
-                raise HTTPException(
-                    status_code=404,
-                    detail="Product not found or out of stock"
-                )
-            if product['stock'] < item.quantity:
-                raise HTTPException(status_code=400, detail="Insufficient stock")
+        if not product:
+            raise HTTPException(
+                status_code=404,
+                detail="Product not found or out of stock"
+            )
+        if not hot and product['stock'] < item.quantity:
+            raise HTTPException(status_code=400, detail="Insufficient stock")
 
-            # カートの存在確認と取得/作成
+        # カートの存在確認と取得/作成
+        cursor.execute(
+            "SELECT id FROM carts WHERE user_id = %s FOR UPDATE",
+            (item.user_id,)
+        )
+        cart = cursor.fetchone()
+        
+        if not cart:
             cursor.execute(
-                "SELECT id FROM carts WHERE user_id = %s FOR UPDATE",
+                "INSERT INTO carts (user_id) VALUES (%s)",
                 (item.user_id,)
             )
-            cart = cursor.fetchone()
-            
-            if not cart:
-                cursor.execute(
-                    "INSERT INTO carts (user_id) VALUES (%s)",
-                    (item.user_id,)
+            cart_id = cursor.lastrowid
+        else:
+            cart_id = cart['id']
+        
+        # 既存のカートアイテムをチェック
+        cursor.execute("""
+            SELECT id, quantity 
+            FROM cart_items 
+            WHERE cart_id = %s AND product_id = %s
+            FOR UPDATE
+        """, (cart_id, item.product_id))
+        existing_item = cursor.fetchone()
+
+        if hot:
+            current_quantity = existing_item['quantity'] if existing_item else 0
+            if not reservations.hold(item.product_id, item.user_id, current_quantity + item.quantity):
+                raise HTTPException(status_code=400, detail="Insufficient stock")
+        
+        if existing_item:
+            new_quantity = existing_item['quantity'] + item.quantity
+            if not hot and new_quantity > product['stock']:
+                raise HTTPException(
+                    status_code=400,
+                    detail="Total quantity exceeds available stock"
                 )
-                cart_id = cursor.lastrowid
-            else:
-                cart_id = cart['id']
-            
-            # 既存のカートアイテムをチェック
+                
+            cursor.execute(
+                "UPDATE cart_items SET quantity = %s WHERE id = %s",
+                (new_quantity, existing_item['id'])
+            )
+        else:
             cursor.execute("""
-                SELECT id, quantity 
-                FROM cart_items 
-                WHERE cart_id = %s AND product_id = %s
-                FOR UPDATE
-            """, (cart_id, item.product_id))
-            existing_item = cursor.fetchone()
-            
-            if existing_item:
-                new_quantity = existing_item['quantity'] + item.quantity
-                if new_quantity > product['stock']:
-                    raise HTTPException(
-                        status_code=400,
-                        detail="Total quantity exceeds available stock"
-                    )
-                    
-                cursor.execute(
-                    "UPDATE cart_items SET quantity = %s WHERE id = %s",
-                    (new_quantity, existing_item['id'])
-                )
-            else:
-                cursor.execute("""
-                    INSERT INTO cart_items (cart_id, product_id, quantity) 
-                    VALUES (%s, %s, %s)
-                """, (cart_id, item.product_id, item.quantity))
-            
-            return {"message": "Successfully added to cart"}
+                INSERT INTO cart_items (cart_id, product_id, quantity) 
+                VALUES (%s, %s, %s)
+            """, (cart_id, item.product_id, item.quantity))
+        
+        return {"message": "Successfully added to cart"}
+
+    try:
+        result = await run_transaction(add_item, isolation_level='REPEATABLE READ')
+        popularity.increment(item.product_id, POPULARITY_CART_WEIGHT * item.quantity)
+        return result
+    except Exception as e:
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+
+# カートの明細・合計・在庫警告を1クエリで取得
+def fetch_cart_view(cursor, user_id):
+    cursor.execute(f"""
+        SELECT 
+            ci.id,
+            ci.product_id,
+            ci.quantity,
+            p.name,
+            p.price,
+            p.image_url,
+            {available_stock_sql("p")} AS stock
+        FROM carts c
+        JOIN cart_items ci ON c.id = ci.cart_id
+        JOIN products p ON ci.product_id = p.id
+        WHERE c.user_id = %s
+        ORDER BY ci.id DESC
+    """, (user_id,))
+    rows = cursor.fetchall()
+
+    items = []
+    warnings = []
+    total_quantity = 0
+    total_amount = 0
+    for row in rows:
+        price = int(row['price']) if row['price'] else 0
+        stock = row['stock']
+        if row['product_id'] in reservations:
+            # 引当対象の商品は自分の引当分も含める
+            stock += reservations.held(row['product_id'], user_id)
+        items.append({
+            'id': row['id'],
+            'product_id': row['product_id'],
+            'quantity': row['quantity'],
+            'name': row['name'],
+            'price': price,
+            'image_url': row['image_url'],
+            'stock': stock,
+            'total_price': price * row['quantity']
+        })
+        total_quantity += row['quantity']
+        total_amount += price * row['quantity']
+
+        if stock <= 0:
+            warnings.append({
+                'item_id': row['id'],
+                'product_id': row['product_id'],
+                'type': 'out_of_stock'
+            })
+        elif row['quantity'] > stock:
+            warnings.append({
+                'item_id': row['id'],
+                'product_id': row['product_id'],
+                'type': 'insufficient_stock',
+                'available': stock
+            })
+
+    return {
+        'items': items,
+        'total_items': len(items),
+        'total_quantity': total_quantity,
+        'total_amount': total_amount,
+        'warnings': warnings
+    }
+
+# カート表示用（明細・合計・在庫警告をまとめて取得）
+@app.get("/api/cart")
+async def get_cart(user_id: int, request: Request):
+    try:
+        with get_db_cursor() as cursor:
+            ensure_user(cursor, request, user_id)
+            return fetch_cart_view(cursor, user_id)
     except Exception as e:
+        print(f"Error in get_cart: {str(e)}")
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
 
 # カートアイテム一覧取得
 @app.get("/api/cart/items")
-async def get_cart_items(user_id: int):
+async def get_cart_items(user_id: int, request: Request):
     try:
         with get_db_cursor() as cursor:
             # ユーザーの存在確認
-            cursor.execute("SELECT id FROM users WHERE id = %s", (user_id,))
-            if not cursor.fetchone():
-                raise HTTPException(status_code=401, detail="User not found")
+            ensure_user(cursor, request, user_id)
 
             # カートアイテムと商品情報を結合して取得
-            cursor.execute("""
+            cursor.execute(f"""
                 SELECT 
                     ci.id,
                     ci.product_id,
@@ -336,7 +1308,7 @@ async def get_cart_items(user_id: int):
                     p.name,
                     p.price,
                     p.image_url,
-                    p.stock,
+                    {available_stock_sql("p")} AS stock,
                     (p.price * ci.quantity) as total_price
                 FROM carts c
                 LEFT JOIN cart_items ci ON c.id = ci.cart_id
@@ -366,34 +1338,194 @@ async def get_cart_items(user_id: int):
             return formatted_items
     except Exception as e:
         print(f"Error in get_cart_items: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+
+# カート一括更新（1トランザクションで add/set/remove をまとめて適用）
+CART_BATCH_MAX_OPERATIONS = int(os.getenv("CART_BATCH_MAX_OPERATIONS", 200))
+
+@app.post("/api/cart/batch")
+async def batch_update_cart(batch: CartBatch, request: Request):
+    enforce_rate_limit("cart", request, batch.user_id)
+    if not batch.operations:
+        raise HTTPException(status_code=400, detail="No operations")
+    if len(batch.operations) > CART_BATCH_MAX_OPERATIONS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many operations (max {CART_BATCH_MAX_OPERATIONS})"
+        )
+
+    def apply_batch(cursor):
+        ensure_user(cursor, request, batch.user_id)
+
+        # カートの存在確認と取得/作成
+        cursor.execute(
+            "SELECT id FROM carts WHERE user_id = %s FOR UPDATE",
+            (batch.user_id,)
+        )
+        cart = cursor.fetchone()
+        if not cart:
+            cursor.execute("INSERT INTO carts (user_id) VALUES (%s)", (batch.user_id,))
+            cart_id = cursor.lastrowid
+        else:
+            cart_id = cart['id']
+
+        # 対象商品の在庫をまとめて取得
+        product_ids = sorted({operation.product_id for operation in batch.operations})
+        placeholders = ", ".join(["%s"] * len(product_ids))
+        cursor.execute(
+            f"SELECT id, stock FROM products WHERE id IN ({placeholders})",
+            product_ids
+        )
+        stocks = {row['id']: row['stock'] for row in cursor.fetchall()}
+
+        # 現在のカート内容
+        cursor.execute("""
+            SELECT id, product_id, quantity
+            FROM cart_items
+            WHERE cart_id = %s
+            FOR UPDATE
+        """, (cart_id,))
+        existing = {row['product_id']: row for row in cursor.fetchall()}
+        quantities = {product_id: row['quantity'] for product_id, row in existing.items()}
+
+        # 操作を順に適用（失敗した操作はスキップ）
+        results = []
+        for index, operation in enumerate(batch.operations):
+            current = quantities.get(operation.product_id, 0)
+            if operation.op == "add":
+                new_quantity = current + operation.quantity
+            elif operation.op == "set":
+                new_quantity = operation.quantity
+            else:
+                new_quantity = 0
+
+            error = None
+            if operation.product_id not in stocks:
+                error = "Product not found"
+            elif operation.op == "add" and operation.quantity <= 0:
+                error = "Quantity must be greater than 0"
+            elif operation.op == "remove" and current == 0:
+                error = "Item not in cart"
+            elif operation.product_id in reservations:
+                if not reservations.hold(operation.product_id, batch.user_id, new_quantity):
+                    error = "Insufficient stock"
+            elif new_quantity > stocks[operation.product_id]:
+                error = "Insufficient stock"
+
+            if error:
+                results.append({
+                    "index": index,
+                    "product_id": operation.product_id,
+                    "status": "error",
+                    "detail": error
+                })
+                continue
+
+            quantities[operation.product_id] = new_quantity
+            results.append({
+                "index": index,
+                "product_id": operation.product_id,
+                "status": "ok",
+                "quantity": new_quantity
+            })
+
+        if batch.atomic and any(result["status"] == "error" for result in results):
+            # 適用しなかった分の引当を元の数量に戻す
+            for product_id in quantities:
+                if product_id in reservations:
+                    reservations.hold(product_id, batch.user_id, existing[product_id]['quantity'] if product_id in existing else 0)
+            raise HTTPException(status_code=400, detail={"results": results})
+
+        # 差分をまとめて書き込む
+        removed = [
+            existing[product_id]['id'] for product_id, quantity in quantities.items()
+            if quantity == 0 and product_id in existing
+        ]
+        updated = [
+            (quantity, existing[product_id]['id']) for product_id, quantity in quantities.items()
+            if quantity > 0 and product_id in existing and existing[product_id]['quantity'] != quantity
+        ]
+        inserted = [
+            (cart_id, product_id, quantity) for product_id, quantity in quantities.items()
+            if quantity > 0 and product_id not in existing
+        ]
+
+        if removed:
+            placeholders = ", ".join(["%s"] * len(removed))
+            cursor.execute(f"DELETE FROM cart_items WHERE id IN ({placeholders})", removed)
+        if updated:
+            cases = " ".join(["WHEN %s THEN %s"] * len(updated))
+            placeholders = ", ".join(["%s"] * len(updated))
+            params = [value for quantity, item_id in updated for value in (item_id, quantity)]
+            params += [item_id for _, item_id in updated]
+            cursor.execute(
+                f"UPDATE cart_items SET quantity = CASE id {cases} END WHERE id IN ({placeholders})",
+                params
+            )
+        if inserted:
+            cursor.executemany(
+                "INSERT INTO cart_items (cart_id, product_id, quantity) VALUES (%s, %s, %s)",
+                inserted
+            )
+
+        return {
+            "results": results,
+            "cart": fetch_cart_view(cursor, batch.user_id)
+        }
+
+    try:
+        return await run_transaction(apply_batch, isolation_level='REPEATABLE READ')
+    except Exception as e:
+        print(f"Error in batch_update_cart: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
         raise HTTPException(status_code=500, detail=str(e))
 
 # カートアイテム数量更新
 @app.put("/api/cart/items/{item_id}")
-async def update_cart_item(item_id: int, item: CartItemUpdate):
-    try:
-        with get_db_cursor(isolation_level='REPEATABLE READ') as cursor:
-            cursor.execute("""
-                SELECT ci.id, ci.product_id, p.stock, ci.cart_id 
-                FROM cart_items ci
-                JOIN products p ON ci.product_id = p.id
-                WHERE ci.id = %s
-                FOR UPDATE
-            """, (item_id,))
-            cart_item = cursor.fetchone()
-            
-            if not cart_item:
-                raise HTTPException(status_code=404, detail="Cart item not found")
-            
-            if item.quantity > cart_item['stock']:
+async def update_cart_item(item_id: int, item: CartItemUpdate, request: Request, user_id: Optional[int] = None):
+    # user_id を指定した場合は所有者を確認し、更新後のカートを同じトランザクションで返す
+    enforce_rate_limit("cart", request)
+
+    def update_item(cursor):
+        cursor.execute("""
+            SELECT ci.id, ci.product_id, p.stock, ci.cart_id, c.user_id
+            FROM cart_items ci
+            JOIN products p ON ci.product_id = p.id
+            JOIN carts c ON ci.cart_id = c.id
+            WHERE ci.id = %s
+            FOR UPDATE OF ci
+        """, (item_id,))
+        cart_item = cursor.fetchone()
+        
+        if not cart_item or (user_id is not None and cart_item['user_id'] != user_id):
+            raise HTTPException(status_code=404, detail="Cart item not found")
+
+        # トークンがあればカートの持ち主と一致するか確認する
+        ensure_user(cursor, request, cart_item['user_id'])
+        
+        if cart_item['product_id'] in reservations:
+            if not reservations.hold(cart_item['product_id'], cart_item['user_id'], item.quantity):
                 raise HTTPException(status_code=400, detail="Insufficient stock")
-            
-            cursor.execute(
-                "UPDATE cart_items SET quantity = %s WHERE id = %s",
-                (item.quantity, item_id)
-            )
-            
-            return {"message": "Successfully updated quantity"}
+        elif item.quantity > cart_item['stock']:
+            raise HTTPException(status_code=400, detail="Insufficient stock")
+        
+        cursor.execute(
+            "UPDATE cart_items SET quantity = %s WHERE id = %s",
+            (item.quantity, item_id)
+        )
+        
+        if user_id is not None:
+            return {
+                "message": "Successfully updated quantity",
+                "cart": fetch_cart_view(cursor, user_id)
+            }
+        return {"message": "Successfully updated quantity"}
+
+    try:
+        return await run_transaction(update_item, isolation_level='REPEATABLE READ')
     except Exception as e:
         if isinstance(e, HTTPException):
             raise e
@@ -401,23 +1533,37 @@ async def update_cart_item(item_id: int, item: CartItemUpdate):
 
 # カートアイテム削除
 @app.delete("/api/cart/items/{item_id}")
-async def delete_cart_item(item_id: int):
+async def delete_cart_item(item_id: int, request: Request, user_id: Optional[int] = None):
+    # user_id を指定した場合は所有者を確認し、削除後のカートを同じトランザクションで返す
+    enforce_rate_limit("cart", request)
     try:
         with get_db_cursor() as cursor:
-            cursor.execute(
-                "SELECT id FROM cart_items WHERE id = %s",
-                (item_id,)
-            )
+            cursor.execute("""
+                SELECT ci.id, ci.product_id, c.user_id
+                FROM cart_items ci
+                JOIN carts c ON ci.cart_id = c.id
+                WHERE ci.id = %s
+            """, (item_id,))
             cart_item = cursor.fetchone()
             
-            if not cart_item:
+            if not cart_item or (user_id is not None and cart_item['user_id'] != user_id):
                 raise HTTPException(status_code=404, detail="Cart item not found")
+
+            # トークンがあればカートの持ち主と一致するか確認する
+            ensure_user(cursor, request, cart_item['user_id'])
             
             cursor.execute(
                 "DELETE FROM cart_items WHERE id = %s",
                 (item_id,)
             )
+            if cart_item['product_id'] in reservations:
+                reservations.release(cart_item['product_id'], cart_item['user_id'])
             
+            if user_id is not None:
+                return {
+                    "message": "Successfully deleted item",
+                    "cart": fetch_cart_view(cursor, user_id)
+                }
             return {"message": "Successfully deleted item"}
     except Exception as e:
         if isinstance(e, HTTPException):
@@ -426,13 +1572,11 @@ async def delete_cart_item(item_id: int):
 
 # カートの合計金額を取得
 @app.get("/api/cart/total")
-async def get_cart_total(user_id: int):
+async def get_cart_total(user_id: int, request: Request):
     try:
         with get_db_cursor() as cursor:
             # ユーザーの存在確認
-            cursor.execute("SELECT id FROM users WHERE id = %s", (user_id,))
-            if not cursor.fetchone():
-                raise HTTPException(status_code=401, detail="User not found")
+            ensure_user(cursor, request, user_id)
 
             cursor.execute("""
                 SELECT 
@@ -453,23 +1597,24 @@ async def get_cart_total(user_id: int):
             }
     except Exception as e:
         print(f"Error in get_cart_total: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
         raise HTTPException(status_code=500, detail=str(e))
 
 # カートをクリア
 @app.delete("/api/cart/clear")
-async def clear_cart(user_id: int):
+async def clear_cart(user_id: int, request: Request):
     try:
         with get_db_cursor() as cursor:
             # ユーザーの存在確認
-            cursor.execute("SELECT id FROM users WHERE id = %s", (user_id,))
-            if not cursor.fetchone():
-                raise HTTPException(status_code=401, detail="User not found")
+            ensure_user(cursor, request, user_id)
 
             cursor.execute("""
                 DELETE ci FROM cart_items ci
                 JOIN carts c ON ci.cart_id = c.id
                 WHERE c.user_id = %s
             """, (user_id,))
+            reservations.release_user(user_id)
             
             return {"message": "Cart cleared successfully"}
     except Exception as e:
@@ -478,250 +1623,736 @@ async def clear_cart(user_id: int):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
 
+# 注文番号の生成（時刻順に並ぶ ULID。ワーカー・ホストをまたいでも重複しない）
+order_ids = UlidGenerator()
+
+def generate_order_number():
+    return f"ORD-{order_ids.new()}"
+
+# 日別売上集計（商品別・カテゴリー別）への加算
+# products, categories: sales_totals() の戻り値と同じ形の加算分
+def write_sales(cursor, products, categories):
+    # ロック順を揃えてデッドロックを避けるためキー順に書き込む
+    if products:
+        cursor.executemany("""
+            INSERT INTO sales_daily_product (sales_date, product_id, category_id, units, revenue)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                units = units + VALUES(units),
+                revenue = revenue + VALUES(revenue)
+        """, [key + (units, revenue) for key, (units, revenue) in sorted(products.items())])
+    if categories:
+        cursor.executemany("""
+            INSERT INTO sales_daily_category (sales_date, category_id, units, revenue)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                units = units + VALUES(units),
+                revenue = revenue + VALUES(revenue)
+        """, [key + (units, revenue) for key, (units, revenue) in sorted(categories.items())])
+
+# items: product_id, category_id, quantity, price を持つ注文明細のリスト
+def record_sales(cursor, items):
+    write_sales(cursor, *sales_totals(items, date.today()))
+
+# 注文確定分はコミット後にメモリ上で加算し、まとめて反映する（集計行のロックを注文処理で持たない）
+# 反映前にプロセスが落ちた分は backfill_sales.py で注文履歴から作り直せる
+SALES_FLUSH_INTERVAL = int(os.getenv("SALES_FLUSH_INTERVAL", 10))
+SALES_FLUSH_BATCH_SIZE = 500
+
+sales_rollup = SalesRollup()
+
+def flush_sales():
+    products, categories = sales_rollup.drain()
+    if not products and not categories:
+        return
+    try:
+        for pending in (products, categories):
+            keys = sorted(pending)
+            for start in range(0, len(keys), SALES_FLUSH_BATCH_SIZE):
+                batch = {key: pending[key] for key in keys[start:start + SALES_FLUSH_BATCH_SIZE]}
+                with get_db_cursor() as cursor:
+                    if pending is products:
+                        write_sales(cursor, batch, {})
+                    else:
+                        write_sales(cursor, {}, batch)
+                for key in batch:
+                    del pending[key]
+                sales_rollup.flushed += len(batch)
+    finally:
+        sales_rollup.restore(products, categories)
+
+@app.on_event("startup")
+async def start_sales_flush():
+    app.state.sales_flush_task = asyncio.create_task(
+        run_periodically("flush_sales", flush_sales, SALES_FLUSH_INTERVAL)
+    )
+
+@app.on_event("shutdown")
+async def flush_sales_on_shutdown():
+    flush_sales()
+
+# 注文する商品の在庫を確保し、合計金額を返す（create_order / intake_order の共通処理）
+# cart_items は商品ID順。引当対象の商品はメモリ上の引当から確保して、このワーカーの切り出し分の記録を
+# 同じトランザクションで減らす。それ以外（と、切り出し分が回収されていた場合）は在庫が足りる場合だけ減らす
+# （商品ID順に更新してデッドロックを避ける）。確保した数量は ordered / reserved に記録する
+def secure_order_stock(cursor, user_id, cart_items, ordered, reserved):
+    def take_stock(item):
+        cursor.execute("""
+            UPDATE products
+            SET stock = stock - %s
+            WHERE id = %s AND stock >= %s
+        """, (item['quantity'], item['product_id'], item['quantity']))
+        return cursor.rowcount > 0
+
+    total_amount = 0
+    for item in cart_items:
+        if item['product_id'] not in reservations:
+            secured = take_stock(item)
+        elif not reservations.hold(item['product_id'], user_id, item['quantity']):
+            secured = False
+        elif reservations.consume(cursor, item['product_id'], item['quantity']):
+            secured = True
+            reserved[item['product_id']] = item['quantity']
+        else:
+            secured = take_stock(item)
+        if not secured:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Insufficient stock for product: {item['name']}"
+            )
+        ordered[item['product_id']] = item['quantity']
+        total_amount += item['price'] * item['quantity']
+    return total_amount
+
+# 注文のコミット後の処理（引当の確定・キャッシュ破棄・人気度の加算）
+def finish_order(user_id, ordered, reserved):
+    pin_user_reads(user_id)
+    for product_id, quantity in reserved.items():
+        reservations.commit(product_id, user_id, quantity)
+    invalidation_bus.publish("products", list(ordered))
+    for product_id, quantity in ordered.items():
+        popularity.increment(product_id, POPULARITY_ORDER_WEIGHT * quantity)
+
 # 注文作成
 @app.post("/api/orders/create")
-async def create_order(order: OrderCreate):
-    try:
-        with get_db_cursor(isolation_level='SERIALIZABLE') as cursor:
-            # ユーザーの存在確認
-            cursor.execute("SELECT id FROM users WHERE id = %s", (order.user_id,))
-            if not cursor.fetchone():
-                raise HTTPException(status_code=404, detail="User not found")
+async def create_order(order: OrderCreate, request: Request):
+    ordered_quantities = {}
+    reserved_quantities = {}
+    ordered_items = []
 
-            # カートの取得
-            cursor.execute("""
-                SELECT c.id 
-                FROM carts c
-                WHERE c.user_id = %s
-            """, (order.user_id,))
-            cart = cursor.fetchone()
-            if not cart:
-                raise HTTPException(status_code=404, detail="Cart not found")
+    def place_order(cursor):
+        ordered_quantities.clear()
+        reserved_quantities.clear()
+        ordered_items.clear()
 
-            # カート内の商品を取得
-            cursor.execute("""
-                SELECT 
-                    ci.product_id,
-                    ci.quantity,
-                    p.price,
-                    p.name,
-                    p.stock,
-                    p.image_url
-                FROM cart_items ci
-                JOIN products p ON ci.product_id = p.id
-                WHERE ci.cart_id = %s
-                FOR UPDATE
-            """, (cart['id'],))
-            cart_items = cursor.fetchall()
-
-            if not cart_items:
-                raise HTTPException(status_code=400, detail="Cart is empty")
-
-            # 在庫チェックと合計金額の計算
-            total_amount = 0
-            for item in cart_items:
-                if item['stock'] < item['quantity']:
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"Insufficient stock for product: {item['name']}"
-                    )
-                total_amount += item['price'] * item['quantity']
-
-            # 注文番号の生成
-            order_number = f"ORD-{datetime.now().strftime('%Y%m%d')}-{uuid.uuid4().hex[:8].upper()}"
-
-            # 注文の作成
+        # ユーザーの存在確認
+        ensure_user(cursor, request, order.user_id, status_code=404)
+
+        # カートの取得
+        cursor.execute("""
+            SELECT c.id 
+            FROM carts c
+            WHERE c.user_id = %s
+        """, (order.user_id,))
+        cart = cursor.fetchone()
+        if not cart:
+            raise HTTPException(status_code=404, detail="Cart not found")
+
+        # カート内の商品を取得（products 行はロックせず、在庫は下の条件付き更新で確保する）
+        cursor.execute("""
+            SELECT 
+                ci.product_id,
+                ci.quantity,
+                p.price,
+                p.name,
+                p.image_url,
+                p.category_id
+            FROM cart_items ci
+            JOIN products p ON ci.product_id = p.id
+            WHERE ci.cart_id = %s
+            ORDER BY ci.product_id
+            FOR UPDATE OF ci
+        """, (cart['id'],))
+        cart_items = cursor.fetchall()
+
+        if not cart_items:
+            raise HTTPException(status_code=400, detail="Cart is empty")
+
+        # 在庫の確保と合計金額の計算
+        total_amount = secure_order_stock(cursor, order.user_id, cart_items, ordered_quantities, reserved_quantities)
+
+        # 注文番号の生成
+        order_number = generate_order_number()
+
+        # 注文の作成
+        cursor.execute("""
+            INSERT INTO orders (
+                user_id, order_number, total_amount, 
+                payment_method, shipping_name, shipping_postal_code,
+                shipping_address, shipping_phone, status
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (
+            order.user_id, order_number, total_amount,
+            order.payment_method, order.shipping_name, order.shipping_postal_code,
+            order.shipping_address, order.shipping_phone, 'completed'
+        ))
+        order_id = cursor.lastrowid
+
+        # 注文詳細の作成
+        for item in cart_items:
             cursor.execute("""
-                INSERT INTO orders (
-                    user_id, order_number, total_amount, 
-                    payment_method, shipping_name, shipping_postal_code,
-                    shipping_address, shipping_phone, status
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                INSERT INTO order_details (
+                    order_id, product_id, quantity, price,
+                    product_name, product_image_url
+                ) VALUES (%s, %s, %s, %s, %s, %s)
             """, (
-                order.user_id, order_number, total_amount,
-                order.payment_method, order.shipping_name, order.shipping_postal_code,
-                order.shipping_address, order.shipping_phone, 'completed'
+                order_id, item['product_id'], item['quantity'],
+                item['price'], item['name'], item['image_url']
             ))
-            order_id = cursor.lastrowid
 
-            # 注文詳細の作成と在庫の更新
-            for item in cart_items:
-                # 注文詳細の追加
-                cursor.execute("""
-                    INSERT INTO order_details (
-                        order_id, product_id, quantity, price,
-                        product_name, product_image_url
-                    ) VALUES (%s, %s, %s, %s, %s, %s)
-                """, (
-                    order_id, item['product_id'], item['quantity'],
-                    item['price'], item['name'], item['image_url']
-                ))
-
-                # 在庫の更新
-                cursor.execute("""
-                    UPDATE products
-                    SET stock = stock - %s
-                    WHERE id = %s
-                """, (item['quantity'], item['product_id']))
+        # 売上集計はコミット後に加算する
+        ordered_items.extend(cart_items)
 
-            # カートの中身を削除
-            cursor.execute("DELETE FROM cart_items WHERE cart_id = %s", (cart['id'],))
+        # カートの中身を削除
+        cursor.execute("DELETE FROM cart_items WHERE cart_id = %s", (cart['id'],))
 
-            return {
-                "message": "Order created successfully",
-                "order_number": order_number
-            }
+        return {
+            "message": "Order created successfully",
+            "order_number": order_number
+        }
+
+    try:
+        result = await run_transaction(place_order)
+        finish_order(order.user_id, ordered_quantities, reserved_quantities)
+        sales_rollup.add(ordered_items, date.today())
+        return result
     except Exception as e:
         print(f"Error in create_order: {str(e)}")
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
 
-# 注文履歴取得
-@app.get("/api/orders")
-async def get_orders(user_id: int):
+# 非同期注文受付用のキューとワーカー
+# 受付時は在庫の確保と注文(pending)の登録だけを行い、明細登録・売上集計・完了処理はワーカーが行う
+order_queue = DurableQueue(
+    os.getenv("ORDER_QUEUE_PATH", "order_queue.sqlite3"),
+    lease_seconds=int(os.getenv("ORDER_QUEUE_LEASE", 60))
+)
+# 注文が見つからないジョブをこの秒数を過ぎたら破棄する（受付がロールバックされた場合）
+ORDER_QUEUE_ORPHAN_TIMEOUT = int(os.getenv("ORDER_QUEUE_ORPHAN_TIMEOUT", 30))
+
+# 受付済み注文の後続処理（同じジョブが再実行されても二重に処理しない）
+def fulfill_order(payload):
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            "SELECT status FROM orders WHERE id = %s FOR UPDATE",
+            (payload['order_id'],)
+        )
+        order = cursor.fetchone()
+        if not order:
+            # 受付トランザクションのコミット前か、ロールバックされた注文
+            if time.time() - payload['accepted_at'] < ORDER_QUEUE_ORPHAN_TIMEOUT:
+                raise RuntimeError(f"Order {payload['order_id']} is not visible yet")
+            print(f"Dropping job for missing order {payload['order_id']}")
+            return
+        if order['status'] != 'pending':
+            return
+
+        cursor.executemany("""
+            INSERT INTO order_details (
+                order_id, product_id, quantity, price,
+                product_name, product_image_url
+            ) VALUES (%s, %s, %s, %s, %s, %s)
+        """, [(
+            payload['order_id'], item['product_id'], item['quantity'],
+            item['price'], item['name'], item['image_url']
+        ) for item in payload['items']])
+
+        record_sales(cursor, payload['items'])
+
+        cursor.execute(
+            "UPDATE orders SET status = 'completed' WHERE id = %s",
+            (payload['order_id'],)
+        )
+
+order_workers = WorkerPool(
+    order_queue,
+    fulfill_order,
+    workers=int(os.getenv("ORDER_WORKERS", 4)),
+    max_attempts=int(os.getenv("ORDER_MAX_ATTEMPTS", 8))
+)
+
+@app.on_event("startup")
+async def start_order_workers():
+    order_workers.start()
+
+@app.on_event("shutdown")
+async def stop_order_workers():
+    await asyncio.get_running_loop().run_in_executor(None, order_workers.stop)
+
+# 注文受付（在庫を確保して pending の注文番号を即座に返す）
+@app.post("/api/orders/intake")
+async def intake_order(order: OrderCreate, request: Request):
+    ordered_quantities = {}
+    reserved_quantities = {}
+
+    def accept_order(cursor):
+        ordered_quantities.clear()
+        reserved_quantities.clear()
+
+        # ユーザーの存在確認
+        ensure_user(cursor, request, order.user_id, status_code=404)
+
+        # カートの取得
+        cursor.execute("SELECT id FROM carts WHERE user_id = %s", (order.user_id,))
+        cart = cursor.fetchone()
+        if not cart:
+            raise HTTPException(status_code=404, detail="Cart not found")
+
+        # カートの行をロックして読む（同じカートの同時受付は先の受付のコミットを待ち、空のカートを読んで400になる）
+        cursor.execute("""
+            SELECT 
+                ci.product_id,
+                ci.quantity,
+                p.price,
+                p.name,
+                p.image_url,
+                p.category_id
+            FROM cart_items ci
+            JOIN products p ON ci.product_id = p.id
+            WHERE ci.cart_id = %s
+            ORDER BY ci.product_id
+            FOR UPDATE OF ci
+        """, (cart['id'],))
+        cart_items = cursor.fetchall()
+        if not cart_items:
+            raise HTTPException(status_code=400, detail="Cart is empty")
+
+        # 在庫の確保と合計金額の計算
+        total_amount = secure_order_stock(cursor, order.user_id, cart_items, ordered_quantities, reserved_quantities)
+
+        order_number = generate_order_number()
+        cursor.execute("""
+            INSERT INTO orders (
+                user_id, order_number, total_amount, 
+                payment_method, shipping_name, shipping_postal_code,
+                shipping_address, shipping_phone, status
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (
+            order.user_id, order_number, total_amount,
+            order.payment_method, order.shipping_name, order.shipping_postal_code,
+            order.shipping_address, order.shipping_phone, 'pending'
+        ))
+        order_id = cursor.lastrowid
+
+        cursor.execute("DELETE FROM cart_items WHERE cart_id = %s", (cart['id'],))
+
+        # コミット前に登録し、コミット後に落ちても後続処理が失われないようにする
+        # （ロールバックされた場合、ワーカーは注文が見つからないジョブを破棄する）
+        order_queue.enqueue({
+            'order_id': order_id,
+            'order_number': order_number,
+            'accepted_at': time.time(),
+            'items': [{
+                'product_id': item['product_id'],
+                'category_id': item['category_id'],
+                'quantity': item['quantity'],
+                'price': int(item['price']),
+                'name': item['name'],
+                'image_url': item['image_url']
+            } for item in cart_items]
+        })
+
+        return {
+            "message": "Order accepted",
+            "order_number": order_number,
+            "status": "pending"
+        }
+
+    try:
+        result = await run_transaction(accept_order)
+        finish_order(order.user_id, ordered_quantities, reserved_quantities)
+        return result
+    except Exception as e:
+        print(f"Error in intake_order: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 注文状態の取得（非同期受付した注文のポーリング用）
+@app.get("/api/orders/{order_number}/status")
+async def get_order_status(order_number: str, user_id: int):
     try:
         with get_db_cursor() as cursor:
-            # ユーザーの存在確認
-            cursor.execute("SELECT id FROM users WHERE id = %s", (user_id,))
-            if not cursor.fetchone():
-                raise HTTPException(status_code=404, detail="User not found")
+            cursor.execute(
+                "SELECT status FROM orders WHERE order_number = %s AND user_id = %s",
+                (order_number, user_id)
+            )
+            order = cursor.fetchone()
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        return {"order_number": order_number, "status": order['status']}
+    except Exception as e:
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
 
-            # 注文一覧の取得
-            cursor.execute("""
-                SELECT 
-                    o.id,
-                    o.order_number,
-                    o.status,
-                    o.total_amount,
-                    o.payment_method,
-                    o.shipping_name,
-                    o.shipping_postal_code,
-                    o.shipping_address,
-                    o.shipping_phone,
-                    o.created_at
-                FROM orders o
-                WHERE o.user_id = %s
-                ORDER BY o.created_at DESC
-            """, (user_id,))
-            orders = cursor.fetchall()
+# ユーザーの注文一覧と明細の取得
+def load_orders(cursor, user_id):
+    # 注文一覧の取得
+    cursor.execute("""
+        SELECT 
+            o.id,
+            o.order_number,
+            o.status,
+            o.total_amount,
+            o.payment_method,
+            o.shipping_name,
+            o.shipping_postal_code,
+            o.shipping_address,
+            o.shipping_phone,
+            o.created_at
+        FROM orders o
+        WHERE o.user_id = %s
+        ORDER BY o.created_at DESC
+    """, (user_id,))
+    orders = cursor.fetchall()
 
-            formatted_orders = []
-            for order in orders:
-                # 各注文の詳細を取得
-                cursor.execute("""
-                    SELECT
-                        id,
-                        product_id,
-                        quantity,
-                        price,
-                        product_name,
-                        product_image_url
-                    FROM order_details
-                    WHERE order_id = %s
-                """, (order['id'],))
-                details = cursor.fetchall()
-
-                # 注文データのフォーマット
-                formatted_order = {
-                    'id': order['id'],
-                    'order_number': order['order_number'],
-                    'status': order['status'],
-                    'total_amount': int(order['total_amount']),
-                    'payment_method': order['payment_method'],
-                    'shipping_name': order['shipping_name'],
-                    'shipping_postal_code': order['shipping_postal_code'],
-                    'shipping_address': order['shipping_address'],
-                    'shipping_phone': order['shipping_phone'],
-                    'created_at': order['created_at'].isoformat(),
-                    'details': [{
-                        'id': detail['id'],
-                        'product_id': detail['product_id'],
-                        'quantity': detail['quantity'],
-                        'price': int(detail['price']),
-                        'product_name': detail['product_name'],
-                        'product_image_url': detail['product_image_url']
-                    } for detail in details]
-                }
-                formatted_orders.append(formatted_order)
+    formatted_orders = []
+    for order in orders:
+        # 各注文の詳細を取得
+        cursor.execute("""
+            SELECT
+                id,
+                product_id,
+                quantity,
+                price,
+                product_name,
+                product_image_url
+            FROM order_details
+            WHERE order_id = %s
+        """, (order['id'],))
+        details = cursor.fetchall()
 
-            return formatted_orders
+        # 注文データのフォーマット
+        formatted_order = {
+            'id': order['id'],
+            'order_number': order['order_number'],
+            'status': order['status'],
+            'total_amount': int(order['total_amount']),
+            'payment_method': order['payment_method'],
+            'shipping_name': order['shipping_name'],
+            'shipping_postal_code': order['shipping_postal_code'],
+            'shipping_address': order['shipping_address'],
+            'shipping_phone': order['shipping_phone'],
+            'created_at': order['created_at'].isoformat(),
+            'details': [{
+                'id': detail['id'],
+                'product_id': detail['product_id'],
+                'quantity': detail['quantity'],
+                'price': int(detail['price']),
+                'product_name': detail['product_name'],
+                'product_image_url': detail['product_image_url']
+            } for detail in details]
+        }
+        formatted_orders.append(formatted_order)
+
+    return formatted_orders
+
+# 注文履歴取得
+# order_number: 直前に作成した注文の番号（指定すると、レプリカの結果に含まれなければプライマリから読み直す）
+@app.get("/api/orders")
+async def get_orders(user_id: int, request: Request, order_number: Optional[str] = None):
+    try:
+        with get_read_cursor(user_id) as cursor:
+            # ユーザーの存在確認
+            ensure_user(cursor, request, user_id, status_code=404)
+            orders = load_orders(cursor, user_id)
+        if (
+            order_number is not None and replica_router.enabled
+            and not any(order['order_number'] == order_number for order in orders)
+        ):
+            # 別のワーカーで作成された直後の注文はレプリカにまだ届いていないことがある
+            with get_db_cursor() as cursor:
+                orders = load_orders(cursor, user_id)
+        return orders
     except Exception as e:
         print(f"Error in get_orders: {str(e)}")
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
 
+# 注文1件と明細の取得（見つからなければ None）
+def load_order(cursor, order_number, user_id):
+    # 注文の取得（ユーザーIDもチェック）
+    cursor.execute("""
+        SELECT 
+            o.id,
+            o.order_number,
+            o.status,
+            o.total_amount,
+            o.payment_method,
+            o.shipping_name,
+            o.shipping_postal_code,
+            o.shipping_address,
+            o.shipping_phone,
+            o.created_at
+        FROM orders o
+        WHERE o.order_number = %s AND o.user_id = %s
+    """, (order_number, user_id))
+    
+    order = cursor.fetchone()
+    if not order:
+        return None
+
+    # 注文詳細の取得
+    cursor.execute("""
+        SELECT
+            id,
+            product_id,
+            quantity,
+            price,
+            product_name,
+            product_image_url
+        FROM order_details
+        WHERE order_id = %s
+    """, (order['id'],))
+    
+    details = cursor.fetchall()
+
+    # レスポンスの整形
+    return {
+        'id': order['id'],
+        'order_number': order['order_number'],
+        'status': order['status'],
+        'total_amount': int(order['total_amount']),
+        'payment_method': order['payment_method'],
+        'shipping_name': order['shipping_name'],
+        'shipping_postal_code': order['shipping_postal_code'],
+        'shipping_address': order['shipping_address'],
+        'shipping_phone': order['shipping_phone'],
+        'created_at': order['created_at'].isoformat(),
+        'details': [{
+            'id': detail['id'],
+            'product_id': detail['product_id'],
+            'quantity': detail['quantity'],
+            'price': int(detail['price']),
+            'product_name': detail['product_name'],
+            'product_image_url': detail['product_image_url']
+        } for detail in details]
+    }
+
 # 特定の注文詳細取得
 @app.get("/api/orders/{order_number}")
 async def get_order_details(order_number: str, user_id: int):
+    try:
+        with get_read_cursor(user_id) as cursor:
+            formatted_order = load_order(cursor, order_number, user_id)
+        if formatted_order is None and replica_router.enabled:
+            # 別のワーカーで作成された直後の注文はレプリカにまだ届いていないことがある
+            with get_db_cursor() as cursor:
+                formatted_order = load_order(cursor, order_number, user_id)
+        if formatted_order is None:
+            raise HTTPException(status_code=404, detail="Order not found")
+        return formatted_order
+
+    except Exception as e:
+        print(f"Error in get_order_details: {str(e)}")
+        if isinstance(e, HTTPException):
+            raise e
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 管理者用エンドポイントの認証（ADMIN_API_TOKEN 未設定時は無効）
+def require_admin(request):
+    admin_token = os.getenv("ADMIN_API_TOKEN")
+    if not admin_token or not secrets.compare_digest(
+        request.headers.get("X-Admin-Token", ""), admin_token
+    ):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+# 日別売上の時系列取得（集計テーブルのみを参照する）
+@app.get("/api/analytics/sales")
+async def get_sales_series(
+    request: Request,
+    start: date,
+    end: date,
+    product_id: Optional[int] = None,
+    category_id: Optional[int] = None
+):
+    require_admin(request)
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
     try:
         with get_db_cursor() as cursor:
-            # 注文の取得（ユーザーIDもチェック）
-            cursor.execute("""
-                SELECT 
-                    o.id,
-                    o.order_number,
-                    o.status,
-                    o.total_amount,
-                    o.payment_method,
-                    o.shipping_name,
-                    o.shipping_postal_code,
-                    o.shipping_address,
-                    o.shipping_phone,
-                    o.created_at
-                FROM orders o
-                WHERE o.order_number = %s AND o.user_id = %s
-            """, (order_number, user_id))
-            
-            order = cursor.fetchone()
-            if not order:
-                raise HTTPException(status_code=404, detail="Order not found")
+            if product_id is not None:
+                cursor.execute("""
+                    SELECT sales_date, units, revenue
+                    FROM sales_daily_product
+                    WHERE product_id = %s AND sales_date BETWEEN %s AND %s
+                    ORDER BY sales_date
+                """, (product_id, start, end))
+            elif category_id is not None:
+                cursor.execute("""
+                    SELECT sales_date, units, revenue
+                    FROM sales_daily_category
+                    WHERE category_id = %s AND sales_date BETWEEN %s AND %s
+                    ORDER BY sales_date
+                """, (category_id, start, end))
+            else:
+                cursor.execute("""
+                    SELECT sales_date, SUM(units) AS units, SUM(revenue) AS revenue
+                    FROM sales_daily_category
+                    WHERE sales_date BETWEEN %s AND %s
+                    GROUP BY sales_date
+                    ORDER BY sales_date
+                """, (start, end))
+            rows = cursor.fetchall()
 
-            # 注文詳細の取得
-            cursor.execute("""
-                SELECT
-                    id,
-                    product_id,
-                    quantity,
-                    price,
-                    product_name,
-                    product_image_url
-                FROM order_details
-                WHERE order_id = %s
-            """, (order['id'],))
-            
-            details = cursor.fetchall()
-
-            # レスポンスの整形
-            formatted_order = {
-                'id': order['id'],
-                'order_number': order['order_number'],
-                'status': order['status'],
-                'total_amount': int(order['total_amount']),
-                'payment_method': order['payment_method'],
-                'shipping_name': order['shipping_name'],
-                'shipping_postal_code': order['shipping_postal_code'],
-                'shipping_address': order['shipping_address'],
-                'shipping_phone': order['shipping_phone'],
-                'created_at': order['created_at'].isoformat(),
-                'details': [{
-                    'id': detail['id'],
-                    'product_id': detail['product_id'],
-                    'quantity': detail['quantity'],
-                    'price': int(detail['price']),
-                    'product_name': detail['product_name'],
-                    'product_image_url': detail['product_image_url']
-                } for detail in details]
-            }
+        return {
+            "product_id": product_id,
+            "category_id": category_id,
+            "series": [{
+                'date': row['sales_date'].isoformat(),
+                'units': int(row['units']),
+                'revenue': int(row['revenue'])
+            } for row in rows]
+        }
+    except Exception as e:
+        print(f"Error in get_sales_series: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 在庫の一括調整（入荷・倉庫との同期用）
+# 商品ID順のチャンクごとに短いトランザクションで set-based に更新し、注文確定のロック待ちを長引かせない
+STOCK_ADJUST_MAX_ITEMS = int(os.getenv("STOCK_ADJUST_MAX_ITEMS", 50000))
+STOCK_ADJUST_CHUNK_SIZE = int(os.getenv("STOCK_ADJUST_CHUNK_SIZE", 500))
+
+@app.post("/api/admin/stock")
+async def adjust_stock(batch: StockAdjustmentBatch, request: Request):
+    require_admin(request)
+    if not batch.adjustments:
+        raise HTTPException(status_code=400, detail="No adjustments")
+    if len(batch.adjustments) > STOCK_ADJUST_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many adjustments (max {STOCK_ADJUST_MAX_ITEMS})"
+        )
+
+    # 同じ商品への調整は先頭から順にまとめる（set の後の add は set の値に足し込む）
+    targets = {}
+    for adjustment in batch.adjustments:
+        if adjustment.mode == "set":
+            if adjustment.quantity < 0:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Stock must not be negative: product {adjustment.product_id}"
+                )
+            targets[adjustment.product_id] = ("set", adjustment.quantity)
+        else:
+            mode, quantity = targets.get(adjustment.product_id, ("add", 0))
+            targets[adjustment.product_id] = (mode, quantity + adjustment.quantity)
 
-            return formatted_order
+    product_ids = sorted(targets)
+    missing = []
+    clamped = []
 
+    def apply_chunk(chunk):
+        # 戻り値: (存在しない商品ID, 0未満になるため0にそろえた商品ID)
+        def work(cursor):
+            # 在庫引当のワーカーと同じく products → stock_reservations の順にロックする
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(
+                f"SELECT id, stock FROM products WHERE id IN ({placeholders}) FOR UPDATE",
+                chunk
+            )
+            current = {row['id']: row['stock'] for row in cursor.fetchall()}
+
+            # 引当対象の商品の set は、ワーカーが切り出し済みの数を除いた値を products.stock に入れる
+            # （表示・販売できる在庫 = products.stock + 切り出し分 が指定した数になる）
+            carved = {}
+            hot = [product_id for product_id in current if product_id in reservations and targets[product_id][0] == "set"]
+            if hot:
+                placeholders = ", ".join(["%s"] * len(hot))
+                cursor.execute(f"""
+                    SELECT product_id, SUM(quantity) AS quantity FROM stock_reservations
+                    WHERE product_id IN ({placeholders})
+                    GROUP BY product_id
+                """, hot)
+                carved = {row['product_id']: int(row['quantity']) for row in cursor.fetchall()}
+
+            values = {}
+            chunk_clamped = []
+            for product_id, stock in current.items():
+                mode, quantity = targets[product_id]
+                value = quantity - carved.get(product_id, 0) if mode == "set" else stock + quantity
+                if value < 0:
+                    chunk_clamped.append(product_id)
+                    value = 0
+                values[product_id] = value
+
+            if values:
+                ids = sorted(values)
+                cases = " ".join(["WHEN %s THEN %s"] * len(ids))
+                placeholders = ", ".join(["%s"] * len(ids))
+                params = [value for product_id in ids for value in (product_id, values[product_id])]
+                cursor.execute(
+                    f"UPDATE products SET stock = CASE id {cases} END WHERE id IN ({placeholders})",
+                    params + ids
+                )
+            return [product_id for product_id in chunk if product_id not in current], sorted(chunk_clamped)
+        return work
+
+    updated = []
+    try:
+        for start in range(0, len(product_ids), STOCK_ADJUST_CHUNK_SIZE):
+            chunk = product_ids[start:start + STOCK_ADJUST_CHUNK_SIZE]
+            chunk_missing, chunk_clamped = await run_transaction(apply_chunk(chunk))
+            missing.extend(chunk_missing)
+            clamped.extend(chunk_clamped)
+            updated.extend(product_id for product_id in chunk if product_id not in chunk_missing)
     except Exception as e:
-        print(f"Error in get_order_details: {str(e)}")
+        print(f"Error in adjust_stock: {str(e)}")
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # 途中で失敗しても、反映済みのチャンクの分はまとめて1回だけ破棄を通知する
+        if updated:
+            invalidation_bus.publish("products", updated)
+
+    return {
+        "updated": len(updated),
+        "missing": missing,
+        # 減算しきれず（set では切り出し済みの数が指定値を超えていて）0にした商品
+        "clamped": clamped,
+        "cache_version": product_cache.version
+    }
+
+# 運用メトリクス取得
+@app.get("/api/metrics")
+async def get_metrics():
+    return {
+        "admission": {name: pool.stats() for name, pool in admission_pools.items()},
+        "rate_limit": rate_limiter.stats(),
+        "transactions": transaction_retry_stats,
+        "user_cache": user_cache.stats(),
+        "product_cache": product_cache.stats(),
+        "catalog_payloads": catalog_payloads.stats(),
+        "invalidation": invalidation_bus.stats(),
+        "live_updates": live_updates.stats(),
+        "images": image_pipeline.stats(),
+        "home_snapshot": home_snapshot.stats(),
+        "search_index": {"documents": len(search_index), "synced_until": search_index.synced_until},
+        "suggest": suggest_snapshot.stats(),
+        "popularity": {"pending": len(popularity), "flushed": popularity.flushed},
+        "sales_rollup": {"pending": len(sales_rollup), "flushed": sales_rollup.flushed},
+        "order_queue": dict(
+            order_queue.stats(),
+            processed=order_workers.processed,
+            failed=order_workers.failed
+        ),
+        "reservations": reservations.stats(),
+        "replicas": replica_router.stats()
+    }
 
 if __name__ == "__main__":
     import uvicorn
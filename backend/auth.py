@@ -0,0 +1,69 @@
+# auth.py
+
+import base64
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+
+
+# 署名付きセッショントークン（検証にDBアクセス不要）
+# 形式: <user_id>.<有効期限(UNIX秒)>.<HMAC-SHA256署名>
+class SessionTokens:
+    def __init__(self, secret, ttl=86400):
+        self._secret = secret.encode()
+        self.ttl = ttl
+
+    def _sign(self, payload):
+        digest = hmac.new(self._secret, payload.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+    def issue(self, user_id):
+        payload = f"{user_id}.{int(time.time()) + self.ttl}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, token):
+        # 有効なら user_id、不正または期限切れなら None を返す
+        try:
+            user_id, expires_at, signature = token.split(".")
+            payload = f"{user_id}.{expires_at}"
+            if not hmac.compare_digest(signature, self._sign(payload)):
+                return None
+            if int(expires_at) < time.time():
+                return None
+            return int(user_id)
+        except (ValueError, AttributeError):
+            return None
+
+
+# 存在が確認できたユーザーIDを一定時間覚えておくキャッシュ
+class UserCache:
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id):
+        with self._lock:
+            expires_at = self._entries.get(user_id)
+            if expires_at is None or expires_at < time.monotonic():
+                self._entries.pop(user_id, None)
+                self.misses += 1
+                return False
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return True
+
+    def add(self, user_id):
+        with self._lock:
+            self._entries[user_id] = time.monotonic() + self.ttl
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
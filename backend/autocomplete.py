@@ -0,0 +1,78 @@
+# autocomplete.py
+
+import heapq
+import unicodedata
+from bisect import bisect_left
+
+# 該当件数がこれを超える接頭辞は上位候補を事前計算しておく（短い入力ほど該当件数が多いため）
+PRECOMPUTE_THRESHOLD = 256
+
+
+def normalize(text):
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+# 商品名の接頭辞検索（ソート済み配列 + 二分探索、人気順の上位k件）
+# 一度作ったら変更しない。更新時は新しいインスタンスを作って丸ごと差し替える
+class PrefixSuggester:
+    def __init__(self, products, top_k=10):
+        # products: (product_id, name, popularity) のリスト
+        self.top_k = top_k
+        entries = []
+        for product_id, name, popularity in products:
+            key = normalize(name)
+            # 単語の先頭からも一致させる（「Tシャツ」で「コットン Tシャツ」を候補に出す）
+            start = 0
+            for word in key.split():
+                position = key.index(word, start)
+                entries.append((key[position:], -popularity, product_id, name))
+                start = position + len(word)
+        entries.sort()
+        self._keys = [entry[0] for entry in entries]
+        self._entries = [(entry[1], entry[2], entry[3]) for entry in entries]
+
+        # 該当件数の多い接頭辞を1文字ずつ伸ばしながら探し、上位候補を保存する
+        self._precomputed = {}
+        large_ranges = [(0, len(self._keys))]
+        length = 1
+        while large_ranges:
+            next_ranges = []
+            for start, end in large_ranges:
+                position = start
+                while position < end:
+                    prefix = self._keys[position][:length]
+                    stop = bisect_left(self._keys, prefix + "\U0010ffff", position, end)
+                    if stop - position > PRECOMPUTE_THRESHOLD and prefix not in self._precomputed:
+                        self._precomputed[prefix] = self._top(self._entries[position:stop], top_k)
+                        next_ranges.append((position, stop))
+                    position = stop
+            large_ranges = next_ranges
+            length += 1
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def _top(candidates, limit):
+        results = []
+        seen = set()
+        for negative_popularity, product_id, name in heapq.nsmallest(limit * 2, candidates):
+            if product_id in seen:
+                continue
+            seen.add(product_id)
+            results.append({"product_id": product_id, "name": name, "popularity": -negative_popularity})
+            if len(results) == limit:
+                break
+        return results
+
+    def suggest(self, prefix, limit=None):
+        limit = min(limit or self.top_k, self.top_k)
+        prefix = normalize(prefix).lstrip()
+        if not prefix:
+            return []
+        if prefix in self._precomputed:
+            return self._precomputed[prefix][:limit]
+
+        start = bisect_left(self._keys, prefix)
+        end = bisect_left(self._keys, prefix + "\U0010ffff", lo=start)
+        return self._top(self._entries[start:end], limit)
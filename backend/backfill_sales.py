@@ -0,0 +1,73 @@
+# backfill_sales.py
+# 注文履歴から日別売上集計テーブルを作り直すバッチ
+# 使い方: python backfill_sales.py --start 2024-01-01 --end 2024-12-31 [--batch-days 7]
+
+import argparse
+from datetime import date, timedelta
+
+from db import get_db_cursor
+
+
+# 指定期間の集計行を削除し、注文履歴から集計し直す（1バッチ = 1トランザクション）
+def rebuild_range(start, end):
+    with get_db_cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM sales_daily_product WHERE sales_date BETWEEN %s AND %s",
+            (start, end)
+        )
+        cursor.execute(
+            "DELETE FROM sales_daily_category WHERE sales_date BETWEEN %s AND %s",
+            (start, end)
+        )
+
+        cursor.execute("""
+            INSERT INTO sales_daily_product (sales_date, product_id, category_id, units, revenue)
+            SELECT
+                DATE(o.created_at),
+                od.product_id,
+                p.category_id,
+                SUM(od.quantity),
+                SUM(od.quantity * od.price)
+            FROM orders o
+            JOIN order_details od ON od.order_id = o.id
+            JOIN products p ON p.id = od.product_id
+            WHERE o.status = 'completed'
+                AND o.created_at >= %s AND o.created_at < %s
+            GROUP BY DATE(o.created_at), od.product_id, p.category_id
+        """, (start, end + timedelta(days=1)))
+        products = cursor.rowcount
+
+        cursor.execute("""
+            INSERT INTO sales_daily_category (sales_date, category_id, units, revenue)
+            SELECT sales_date, category_id, SUM(units), SUM(revenue)
+            FROM sales_daily_product
+            WHERE sales_date BETWEEN %s AND %s
+            GROUP BY sales_date, category_id
+        """, (start, end))
+        categories = cursor.rowcount
+
+    return products, categories
+
+
+def main():
+    parser = argparse.ArgumentParser(description="日別売上集計テーブルのバックフィル")
+    parser.add_argument("--start", type=date.fromisoformat, required=True)
+    parser.add_argument(
+        "--end",
+        type=date.fromisoformat,
+        default=date.today() - timedelta(days=1),
+        help="終了日（既定: 昨日。当日分は注文確定時に加算されるため通常は含めない）"
+    )
+    parser.add_argument("--batch-days", type=int, default=7)
+    args = parser.parse_args()
+
+    batch_start = args.start
+    while batch_start <= args.end:
+        batch_end = min(batch_start + timedelta(days=args.batch_days - 1), args.end)
+        products, categories = rebuild_range(batch_start, batch_end)
+        print(f"{batch_start} - {batch_end}: {products} product rows, {categories} category rows")
+        batch_start = batch_end + timedelta(days=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# catalog_cache.py
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+# 商品IDごとのプロセス内キャッシュ（TTL付きLRU）
+# 在庫・価格が変わったら invalidate() で該当IDを破棄し、version を進める
+class ProductCache:
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, product_ids):
+        # (見つかった商品の dict, 見つからなかったIDのリスト) を返す
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self._lock:
+            for product_id in product_ids:
+                entry = self._entries.get(product_id)
+                if entry is None or entry[0] < now:
+                    missing.append(product_id)
+                    continue
+                self._entries.move_to_end(product_id)
+                found[product_id] = entry[1]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def get(self, product_id):
+        found, _ = self.get_many([product_id])
+        return found.get(product_id)
+
+    def put_many(self, products, version=None):
+        # 読み込み開始後に invalidate された場合は古い値を入れない
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            for product in products:
+                self._entries[product['id']] = (expires_at, product)
+                self._entries.move_to_end(product['id'])
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, product_ids=None):
+        with self._lock:
+            if product_ids is None:
+                self._entries.clear()
+            else:
+                for product_id in product_ids:
+                    self._entries.pop(product_id, None)
+            self.version += 1
+            return self.version
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# 定期的にバックグラウンドで作り直すスナップショット（トップページ等の集計結果用）
+class BackgroundSnapshot:
+    def __init__(self, name, build, interval=60):
+        self.name = name
+        self.build = build
+        self.interval = interval
+        self.value = None
+        self.version = 0
+        self.built_at = None
+        self._lock = asyncio.Lock()
+
+    async def refresh(self):
+        # build() はDBを参照するためスレッドプールで実行する
+        loop = asyncio.get_running_loop()
+        value = await loop.run_in_executor(None, self.build)
+        self.value = value
+        self.version += 1
+        self.built_at = time.time()
+
+    async def get(self):
+        if self.value is None:
+            async with self._lock:
+                if self.value is None:
+                    await self.refresh()
+        return self.value
+
+    async def run_forever(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"Error refreshing {self.name}: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    def stats(self):
+        return {"version": self.version, "built_at": self.built_at}
+
+
+# func をスレッドプールで定期実行する（インデックスの差分同期等）
+async def run_periodically(name, func, interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            await loop.run_in_executor(None, func)
+        except Exception as e:
+            print(f"Error in {name}: {str(e)}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,152 @@
+# compression.py
+
+import gzip
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def negotiate(accept_encoding):
+    # クライアントが受け付ける圧縮方式（brotli を優先、どちらも不可なら None）
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, *params = [value.strip() for value in part.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(name)
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def compressible(content_type):
+    # 画像などの圧縮済み形式と、ストリーミング（SSE）は対象外
+    if content_type.startswith(b"text/event-stream"):
+        return False
+    return content_type.startswith((b"text/", b"application/json", b"application/javascript"))
+
+
+# レスポンス本文を minimum_size 以上なら gzip / brotli で圧縮する（純粋なASGIミドルウェア）
+# 圧縮に向かない形式と、すでに圧縮済みのレスポンスはそのまま通す
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        encoding = negotiate(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        chunks = []
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, passthrough
+            if passthrough:
+                await send(message)
+                return
+
+            if message["type"] == "http.response.start":
+                response_headers = dict(message.get("headers", []))
+                content_type = response_headers.get(b"content-type", b"")
+                if b"content-encoding" in response_headers or not compressible(content_type):
+                    passthrough = True
+                    await send(message)
+                else:
+                    start = message
+                return
+
+            # 本文はすべて受け取ってから圧縮するかを決める
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            body = b"".join(chunks)
+            response_headers = [
+                (name, value) for name, value in start.get("headers", [])
+                if name not in (b"content-length", b"vary")
+            ]
+            response_headers.append((b"vary", b"Accept-Encoding"))
+            if len(body) >= self.minimum_size:
+                body = compress(body, encoding)
+                response_headers.append((b"content-encoding", encoding.encode()))
+            response_headers.append((b"content-length", str(len(body)).encode()))
+            await send(dict(start, headers=response_headers))
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+
+# 圧縮済みの本文を方式ごとに1回だけ作って保持する
+class CompressedPayload:
+    def __init__(self, body, headers=None):
+        self.body = body
+        self.headers = headers or {}
+        self._encoded = {}
+
+    def encoded(self, encoding):
+        if encoding is None:
+            return self.body
+        if encoding not in self._encoded:
+            self._encoded[encoding] = compress(self.body, encoding)
+        return self._encoded[encoding]
+
+
+# キャッシュ可能なカタログ応答の圧縮済み本文（キーとバージョンが一致する間だけ使う、TTL付きLRU）
+class PayloadCache:
+    def __init__(self, max_entries=1000, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, version, payload):
+        with self._lock:
+            self._entries[key] = (version, time.monotonic() + self.ttl, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
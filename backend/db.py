@@ -0,0 +1,38 @@
+# db.py
+# データベース接続（import しても接続や起動処理を行わないので、バッチからも使える）
+
+import os
+from contextlib import contextmanager
+
+import mysql.connector
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# MySQL接続情報
+db_config = {
+    "host": os.getenv("DB_HOST", "localhost"),
+    "user": os.getenv("DB_USER", "takuya_oshima"),
+    "password": os.getenv("DB_PASSWORD", "Shigure1230@"),
+    "database": os.getenv("DB_NAME", "ec_site")
+}
+
+
+# データベース接続のコンテキストマネージャ（connection 省略時はプライマリに接続）
+@contextmanager
+def get_db_cursor(isolation_level=None, connection=None):
+    conn = connection or mysql.connector.connect(**db_config)
+    cursor = None
+    try:
+        if isolation_level:
+            conn.start_transaction(isolation_level=isolation_level)
+        cursor = conn.cursor(dictionary=True)
+        yield cursor
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        if cursor:
+            cursor.close()
+        conn.close()
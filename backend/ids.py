@@ -0,0 +1,48 @@
+# ids.py
+
+import os
+import threading
+import time
+
+# Crockford's Base32（紛らわしい I, L, O, U を含まない）
+ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+RANDOM_BITS = 80
+
+
+def encode(value, length=26):
+    chars = []
+    for _ in range(length):
+        chars.append(ALPHABET[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+
+# 時刻順に並ぶ一意なID（ULID形式: 48ビットのミリ秒時刻 + 80ビットの乱数、26文字）
+# 文字列の辞書順が生成順とほぼ一致するので、インデックスへの挿入が末尾に集まる。
+# 乱数部が十分長いため、ワーカー・ホスト間で番号を調整しなくても衝突しない
+class UlidGenerator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._last_time = 0
+        self._last_random = 0
+
+    def new(self):
+        with self._lock:
+            if os.getpid() != self._pid:
+                # fork した子プロセスが親と同じ続き番号を出さないようにやり直す
+                self._pid = os.getpid()
+                self._last_time = 0
+            now = time.time_ns() // 1_000_000
+            if now <= self._last_time:
+                # 同じミリ秒内（または時計が戻った場合）は前回の乱数部を1増やして単調増加を保つ
+                now = self._last_time
+                random_part = self._last_random + 1
+                if random_part >> RANDOM_BITS:
+                    now += 1
+                    random_part = int.from_bytes(os.urandom(RANDOM_BITS // 8), "big")
+            else:
+                random_part = int.from_bytes(os.urandom(RANDOM_BITS // 8), "big")
+            self._last_time = now
+            self._last_random = random_part
+        return encode((now << RANDOM_BITS) | random_part)
@@ -0,0 +1,217 @@
+# images.py
+
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import PIL
+except ImportError:
+    PIL = None
+
+WEBP_QUALITY = 80
+# 生成した画像の相対パス（内容から決まるハッシュ名）
+VARIANT_PATH = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{64}\.webp$")
+
+
+# 元画像から幅ごとの WebP を作る（別プロセスで実行する）
+# 出力ファイル名は元画像の内容と変換条件のハッシュなので、同じ画像は何度呼んでも同じ名前になる
+def render_variants(source_path, output_root, widths):
+    from PIL import Image, ImageOps
+
+    with open(source_path, "rb") as file:
+        data = file.read()
+    digest = hashlib.sha256(data).hexdigest()
+
+    results = {}
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        for name, width in widths.items():
+            key = hashlib.sha256(f"{digest}:{width}:webp:{WEBP_QUALITY}".encode()).hexdigest()
+            relative_path = f"{key[:2]}/{key}.webp"
+            path = os.path.join(output_root, relative_path)
+            if not os.path.exists(path):
+                resized = image
+                if image.width > width:
+                    height = max(1, round(image.height * width / image.width))
+                    resized = image.resize((width, height), Image.LANCZOS)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temporary_path = f"{path}.{os.getpid()}.tmp"
+                resized.save(temporary_path, "WEBP", quality=WEBP_QUALITY, method=6)
+                os.replace(temporary_path, path)
+            results[name] = relative_path
+    return results
+
+
+# 商品画像の縮小版（WebP）の生成と対応表の管理
+# urls() は生成済みなら縮小版のパスを返し、未生成ならプロセスプールに生成を依頼して None を返す。
+# 対応表は output_root/manifest.json に保存し、他のワーカーや再起動後も使い回す
+# 生成できなかった画像（元画像がない・読めない）も対応表に記録し、元画像が変わるまで作り直さない
+class ImagePipeline:
+    def __init__(self, source_root, output_root, widths, workers=2):
+        self.source_root = os.path.abspath(source_root)
+        self.output_root = os.path.abspath(output_root)
+        self.widths = widths
+        self.workers = workers
+        self.rendered = 0
+        self.failed = 0
+        self._manifest_path = os.path.join(self.output_root, "manifest.json")
+        # image_url -> {"mtime": 元画像の更新時刻（元画像がなければ None）, "variants": {名前: 相対パス}}
+        # 生成に失敗した画像は variants が None
+        self._manifest = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def enabled(self):
+        return PIL is not None
+
+    def start(self):
+        if not self.enabled:
+            return
+        os.makedirs(self.output_root, exist_ok=True)
+        self._load_manifest()
+        # fork だとサーバーのスレッドやソケットまで複製されるため spawn で起動する
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _load_manifest(self):
+        try:
+            with open(self._manifest_path) as file:
+                manifest = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return
+        with self._lock:
+            for image_url, entry in manifest.items():
+                self._manifest.setdefault(image_url, entry)
+
+    def _save_manifest(self):
+        with self._lock:
+            manifest = dict(self._manifest)
+        temporary_path = f"{self._manifest_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(manifest, file)
+        os.replace(temporary_path, self._manifest_path)
+
+    def source_path(self, image_url):
+        # 外部URLや source_root の外を指すパスは扱わない
+        if not image_url or "://" in image_url:
+            return None
+        path = os.path.abspath(os.path.join(self.source_root, image_url.lstrip("/")))
+        if not path.startswith(self.source_root + os.sep):
+            return None
+        return path
+
+    def urls(self, image_url):
+        entry = self._manifest.get(image_url)
+        if entry is not None:
+            return entry["variants"]
+        if self._executor is not None:
+            self._submit(image_url)
+        return None
+
+    def _submit(self, image_url):
+        path = self.source_path(image_url)
+        if path is None:
+            return
+        with self._lock:
+            if image_url in self._pending:
+                return
+            self._pending.add(image_url)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError as e:
+            self._record(image_url, None, None, e)
+            return
+        try:
+            future = self._executor.submit(render_variants, path, self.output_root, self.widths)
+        except (OSError, RuntimeError) as e:
+            with self._lock:
+                self._pending.discard(image_url)
+            print(f"Error scheduling image variants for {image_url}: {str(e)}")
+            return
+        future.add_done_callback(lambda done: self._finish(image_url, mtime, done))
+
+    def _finish(self, image_url, mtime, future):
+        try:
+            variants = future.result()
+        except Exception as e:
+            self._record(image_url, mtime, None, e)
+            return
+        self._record(image_url, mtime, variants)
+
+    def _record(self, image_url, mtime, variants, error=None):
+        if error is not None:
+            self.failed += 1
+            print(f"Error rendering image variants for {image_url}: {str(error)}")
+        with self._lock:
+            self._pending.discard(image_url)
+            self._manifest[image_url] = {"mtime": mtime, "variants": variants}
+        if variants is not None:
+            self.rendered += 1
+        self._save_manifest()
+
+    def refresh(self):
+        # 他のワーカーが作った分を取り込み、元画像が差し替えられた（追加・削除を含む）ものは作り直す
+        if self._executor is None:
+            return
+        self._load_manifest()
+        with self._lock:
+            entries = list(self._manifest.items())
+        changed = []
+        for image_url, entry in entries:
+            path = self.source_path(image_url)
+            try:
+                mtime = os.stat(path).st_mtime_ns if path is not None else None
+            except FileNotFoundError:
+                mtime = None
+            if path is None or mtime != entry["mtime"]:
+                changed.append(image_url)
+        if changed:
+            with self._lock:
+                for image_url in changed:
+                    self._manifest.pop(image_url, None)
+            self._save_manifest()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "images": sum(1 for entry in self._manifest.values() if entry["variants"] is not None),
+            "pending": len(self._pending),
+            "rendered": self.rendered,
+            "failed": self.failed
+        }
+
+
+def parse_byte_range(header, size):
+    # "bytes=start-end" 形式の単一範囲を (start, end) で返す（指定なし・解釈できない場合は None）
+    # 範囲がファイルの外なら ValueError
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    try:
+        if start:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+        elif end:
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            return None
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, end
@@ -0,0 +1,150 @@
+# import_catalog.py
+# 商品カタログの一括取り込み（CSV / JSONL を1行ずつ読み、products へまとめて upsert する）
+# 各行は Product モデルで検証し、不正な行は取り込まずに rejects ファイルへ書き出す
+#
+# 使い方:
+#   python import_catalog.py feed.csv
+#   python import_catalog.py feed.jsonl --batch-size 2000 --rejects rejects.jsonl
+#
+# 列: id, category_id, name, description, price, stock, image_url（id が既存なら更新）
+#
+# 既存商品の stock は既定では更新しない（新規商品にだけフィードの stock を入れる）。
+# フィードの stock は取り込み中に入った注文の減算を反映していないため、上書きすると
+# 売れた分が在庫に戻ってしまう。棚卸しなどでフィードの値に合わせる場合は --update-stock を指定する
+# （その場合も、在庫引当の対象商品（HOT_PRODUCT_IDS）はワーカーが切り出した分と合わなくなるため更新しない）
+
+import argparse
+import csv
+import itertools
+import json
+import sys
+import time
+
+from pydantic import ValidationError
+
+from db import get_db_cursor
+from invalidation import InvalidationBus, transport_from_env
+from models import Product
+from reservations import hot_product_ids
+
+NAME_MAX_LENGTH = 100
+IMAGE_URL_MAX_LENGTH = 255
+COLUMNS = ("id", "category_id", "name", "description", "price", "stock", "image_url")
+
+
+def read_rows(file, file_format):
+    # (行番号, dict) を1行ずつ返す（JSONとして読めない行は文字列のまま返す）
+    if file_format == "csv":
+        reader = csv.DictReader(file)
+        for row in reader:
+            # CSV の空欄は未指定として扱う
+            yield reader.line_num, {key: value for key, value in row.items() if value != ""}
+    else:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except ValueError:
+                yield line_number, line.rstrip("\n")
+
+
+def batched(items, size):
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def validate(row, category_ids):
+    if not isinstance(row, dict):
+        raise ValueError("row is not a JSON object")
+    product = Product(**row)
+    if len(product.name) > NAME_MAX_LENGTH:
+        raise ValueError(f"name is longer than {NAME_MAX_LENGTH} characters")
+    if product.image_url and len(product.image_url) > IMAGE_URL_MAX_LENGTH:
+        raise ValueError(f"image_url is longer than {IMAGE_URL_MAX_LENGTH} characters")
+    if product.price < 0 or product.stock < 0:
+        raise ValueError("price and stock must not be negative")
+    if product.category_id not in category_ids:
+        raise ValueError(f"unknown category_id {product.category_id}")
+    return tuple(getattr(product, column) for column in COLUMNS)
+
+
+def update_clause(update_stock):
+    # ON DUPLICATE KEY UPDATE の内容（stock は update_stock のときだけ、在庫引当の対象商品を除いて更新する）
+    updates = [f"{column} = VALUES({column})" for column in COLUMNS if column not in ("id", "stock")]
+    if update_stock:
+        hot_ids = ", ".join(str(product_id) for product_id in sorted(set(hot_product_ids())))
+        if hot_ids:
+            updates.append(f"stock = IF(id IN ({hot_ids}), stock, VALUES(stock))")
+        else:
+            updates.append("stock = VALUES(stock)")
+    return ", ".join(updates)
+
+
+# 1バッチ = 1トランザクションの複数行 upsert
+def upsert_batch(rows, update_stock=False):
+    placeholders = ", ".join(["(" + ", ".join(["%s"] * len(COLUMNS)) + ")"] * len(rows))
+    with get_db_cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO products ({", ".join(COLUMNS)})
+            VALUES {placeholders}
+            ON DUPLICATE KEY UPDATE {update_clause(update_stock)}
+        """, [value for row in rows for value in row])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="商品カタログの一括取り込み")
+    parser.add_argument("input", help="CSV / JSONL ファイル（- で標準入力）")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="既定: 拡張子から判定")
+    parser.add_argument("--batch-size", type=int, default=1000, help="1回の upsert・トランザクションの行数")
+    parser.add_argument("--rejects", help="不正な行の書き出し先（既定: <input>.rejects.jsonl）")
+    parser.add_argument(
+        "--update-stock", action="store_true",
+        help="既存商品の stock もフィードの値で上書きする（取り込み中の注文による減算も上書きされる）"
+    )
+    args = parser.parse_args()
+
+    file_format = args.format or ("csv" if args.input.endswith(".csv") else "jsonl")
+    rejects_path = args.rejects or (
+        "rejects.jsonl" if args.input == "-" else f"{args.input}.rejects.jsonl"
+    )
+
+    with get_db_cursor() as cursor:
+        cursor.execute("SELECT id FROM categories")
+        category_ids = {row['id'] for row in cursor.fetchall()}
+
+    started_at = time.monotonic()
+    upserted = 0
+    rejected = 0
+    source = sys.stdin if args.input == "-" else open(args.input, newline="", encoding="utf-8")
+    try:
+        with source, open(rejects_path, "w", encoding="utf-8") as rejects:
+            for lines in batched(read_rows(source, file_format), args.batch_size):
+                batch = []
+                for line_number, row in lines:
+                    try:
+                        batch.append(validate(row, category_ids))
+                    except (ValidationError, ValueError, TypeError) as e:
+                        rejected += 1
+                        rejects.write(json.dumps(
+                            {"line": line_number, "error": str(e), "row": row},
+                            ensure_ascii=False, default=str
+                        ) + "\n")
+                if batch:
+                    upsert_batch(batch, update_stock=args.update_stock)
+                    upserted += len(batch)
+                elapsed = time.monotonic() - started_at
+                print(f"{upserted} upserted, {rejected} rejected ({upserted / max(elapsed, 1e-9):.0f} rows/s)")
+    finally:
+        # 取り込んだ分のキャッシュは最後に1回だけまとめて破棄する（サーバーの各ワーカーへ通知する）
+        if upserted:
+            InvalidationBus(transport_from_env()).publish("products")
+
+    print(f"Done in {time.monotonic() - started_at:.1f}s: {upserted} upserted, {rejected} rejected")
+    if rejected:
+        print(f"Rejected rows: {rejects_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+# invalidation.py
+
+import itertools
+import json
+import os
+import secrets
+import socket
+import threading
+
+# これより多いキーはまとめて「全件破棄」として送る（1メッセージを小さく保つ）
+MAX_KEYS_PER_EVENT = 1000
+
+
+# ワーカー間のキャッシュ破棄通知
+# publish() は自分のキャッシュを即座に破棄したうえで、トランスポート経由で他のワーカーへ送る。
+# イベントには送信元ごとの連番を付け、重複は捨て、欠番（取りこぼし）があれば全件破棄する
+class InvalidationBus:
+    def __init__(self, transport=None):
+        self.transport = transport
+        self.origin = f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}"
+        self.published = 0
+        self.received = 0
+        self.resets = 0
+        self._sequence = itertools.count(1)
+        self._handlers = {}
+        self._last_seen = {}
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def subscribe(self, topic, handler):
+        # handler(keys): keys が None なら全件破棄
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def _apply(self, topic, keys):
+        for handler in self._handlers.get(topic, []):
+            try:
+                handler(keys)
+            except Exception as e:
+                print(f"Error invalidating {topic}: {str(e)}")
+
+    def _reset(self):
+        self.resets += 1
+        for topic in self._handlers:
+            self._apply(topic, None)
+
+    def publish(self, topic, keys=None):
+        if keys is not None:
+            keys = list(keys)
+            if len(keys) > MAX_KEYS_PER_EVENT:
+                keys = None
+        self._apply(topic, keys)
+        self.published += 1
+        if self.transport is None:
+            return
+        event = {
+            "origin": self.origin,
+            "sequence": next(self._sequence),
+            "topic": topic,
+            "keys": keys
+        }
+        try:
+            self.transport.send(event)
+        except Exception as e:
+            print(f"Error publishing invalidation: {str(e)}")
+
+    def _receive(self, event):
+        # event が None なら、トランスポート側でイベントを取りこぼした可能性がある
+        if event is None:
+            self._reset()
+            return
+        if event["origin"] == self.origin:
+            return
+        last = self._last_seen.get(event["origin"])
+        if last is not None and event["sequence"] <= last:
+            return
+        self._last_seen[event["origin"]] = event["sequence"]
+        self.received += 1
+        if last is not None and event["sequence"] > last + 1:
+            self._reset()
+        else:
+            self._apply(event["topic"], event["keys"])
+
+    def _listen(self):
+        while not self._stopping.is_set():
+            try:
+                self.transport.listen(self.origin, self._receive, self._stopping)
+            except Exception as e:
+                print(f"Error receiving invalidations: {str(e)}")
+                self._receive(None)
+                self._stopping.wait(1)
+
+    def start(self):
+        if self.transport is None or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._listen, name="invalidation-bus", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            "transport": type(self.transport).__name__ if self.transport else None,
+            "published": self.published,
+            "received": self.received,
+            "resets": self.resets
+        }
+
+
+# 同一ホスト用: ワーカーごとに UNIX ドメインソケット（データグラム）を作り、全員へ直接送る
+class UnixSocketTransport:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._path = None
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # 受信側が詰まっていても書き込み処理を待たせない（落ちた分は欠番として検出される）
+        self._sender.setblocking(False)
+        self._lock = threading.Lock()
+
+    def send(self, event):
+        data = json.dumps(event).encode()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".sock") or path == self._path:
+                continue
+            try:
+                with self._lock:
+                    self._sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 終了したワーカーのソケットが残っている
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                pass
+
+    def listen(self, origin, callback, stopping):
+        self._path = os.path.join(self.directory, f"{origin}.sock")
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(self._path)
+        receiver.settimeout(0.5)
+        try:
+            while not stopping.is_set():
+                try:
+                    data = receiver.recv(1 << 20)
+                except socket.timeout:
+                    continue
+                callback(json.loads(data))
+        finally:
+            receiver.close()
+            os.unlink(self._path)
+
+
+# 同一ホスト・テスト用: 共有ファイルに1行1イベントで追記し、各ワーカーが末尾を読み進める
+# max_bytes を超えたら空のファイルに置き換える（読み残しがあったワーカーは全件破棄する）
+class FileTransport:
+    def __init__(self, path, poll_interval=0.1, max_bytes=1 << 20):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.max_bytes = max_bytes
+
+    def send(self, event):
+        line = (json.dumps(event) + "\n").encode()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size > self.max_bytes:
+            temporary_path = f"{self.path}.{os.getpid()}.tmp"
+            open(temporary_path, "wb").close()
+            os.replace(temporary_path, self.path)
+
+    def listen(self, origin, callback, stopping):
+        open(self.path, "ab").close()
+        start_at_end = True
+        while not stopping.is_set():
+            with open(self.path, "rb") as file:
+                if start_at_end:
+                    file.seek(0, os.SEEK_END)
+                else:
+                    callback(None)
+                start_at_end = False
+                buffer = b""
+                while not stopping.is_set():
+                    chunk = file.read()
+                    if chunk:
+                        buffer += chunk
+                        *lines, buffer = buffer.split(b"\n")
+                        for line in lines:
+                            if line:
+                                callback(json.loads(line))
+                        continue
+                    try:
+                        replaced = os.stat(self.path).st_ino != os.fstat(file.fileno()).st_ino
+                    except FileNotFoundError:
+                        replaced = False
+                    if replaced:
+                        break
+                    stopping.wait(self.poll_interval)
+
+
+# 複数ホスト用: Redis の Pub/Sub で配信する
+class RedisTransport:
+    def __init__(self, url, channel="cache-invalidation"):
+        import redis
+
+        self.channel = channel
+        self._client = redis.Redis.from_url(url)
+
+    def send(self, event):
+        self._client.publish(self.channel, json.dumps(event))
+
+    def listen(self, origin, callback, stopping):
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        try:
+            while not stopping.is_set():
+                message = pubsub.get_message(timeout=0.5)
+                if message is not None:
+                    callback(json.loads(message["data"]))
+        finally:
+            pubsub.close()
+
+
+def transport_from_env():
+    # INVALIDATION_REDIS_URL: 複数ホスト / INVALIDATION_SOCKET_DIR, INVALIDATION_FILE: 同一ホスト / なし: 単一プロセス
+    if os.getenv("INVALIDATION_REDIS_URL"):
+        return RedisTransport(os.getenv("INVALIDATION_REDIS_URL"))
+    if os.getenv("INVALIDATION_SOCKET_DIR"):
+        return UnixSocketTransport(os.getenv("INVALIDATION_SOCKET_DIR"))
+    if os.getenv("INVALIDATION_FILE"):
+        return FileTransport(os.getenv("INVALIDATION_FILE"))
+    return None
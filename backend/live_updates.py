@@ -0,0 +1,105 @@
+# live_updates.py
+
+import asyncio
+import threading
+
+
+class Subscriber:
+    def __init__(self, product_ids):
+        self.product_ids = product_ids
+        # 未送信の更新（商品ごとに最新の値だけを残す）
+        self.pending = {}
+        self.event = asyncio.Event()
+
+    async def next(self, timeout):
+        # 更新をまとめて返す（timeout 秒間なにもなければ空のリスト）
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self.event.clear()
+        updates, self.pending = list(self.pending.values()), {}
+        return updates
+
+
+# 商品の在庫・価格の変更を、その商品を購読している接続（SSE）へ配る
+# mark_dirty() はどのスレッドからでも呼べる。変更のあった商品IDを貯めておき、
+# run() が load(ids) でまとめて最新値を読み込んで、値が変わった商品だけを配信する
+class ProductUpdateHub:
+    def __init__(self, load):
+        # load(product_ids) -> [{"id", "stock", "price"}, ...]（DBを参照するためスレッドプールで実行する）
+        self.load = load
+        self.published = 0
+        self._subscribers = {}
+        self._last_sent = {}
+        self._dirty = set()
+        self._all_dirty = False
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+
+    def subscribe(self, product_ids):
+        subscriber = Subscriber(product_ids)
+        for product_id in product_ids:
+            self._subscribers.setdefault(product_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        for product_id in subscriber.product_ids:
+            subscribers = self._subscribers.get(product_id)
+            if subscribers is None:
+                continue
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[product_id]
+                self._last_sent.pop(product_id, None)
+
+    def mark_dirty(self, product_ids=None):
+        # product_ids が None なら購読中の全商品を読み直す
+        with self._lock:
+            if product_ids is None:
+                self._all_dirty = True
+            else:
+                self._dirty.update(product_ids)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _publish(self, products):
+        for product in products:
+            update = {"id": product["id"], "stock": product["stock"], "price": product["price"]}
+            if self._last_sent.get(product["id"]) == update:
+                continue
+            subscribers = self._subscribers.get(product["id"])
+            if not subscribers:
+                continue
+            self._last_sent[product["id"]] = update
+            for subscriber in subscribers:
+                subscriber.pending[product["id"]] = update
+                subscriber.event.set()
+            self.published += 1
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                all_dirty, self._all_dirty = self._all_dirty, False
+            product_ids = sorted(self._subscribers if all_dirty else dirty & self._subscribers.keys())
+            if not product_ids:
+                continue
+            try:
+                products = await self._loop.run_in_executor(None, self.load, product_ids)
+            except Exception as e:
+                print(f"Error loading product updates: {str(e)}")
+                continue
+            self._publish(products)
+
+    def stats(self):
+        return {
+            "connections": len({subscriber for subscribers in self._subscribers.values() for subscriber in subscribers}),
+            "products": len(self._subscribers),
+            "published": self.published
+        }
@@ -0,0 +1,22 @@
+# models.py
+# 商品カタログのモデル（import_catalog.py からも使うため app.py から分離）
+
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+
+
+class Product(BaseModel):
+    id: int
+    category_id: int
+    name: str
+    description: Optional[str] = None
+    price: int
+    stock: int
+    image_url: Optional[str] = None
+    image_variants: Optional[Dict[str, str]] = None
+
+
+class Category(BaseModel):
+    id: int
+    name: str
@@ -0,0 +1,156 @@
+# order_queue.py
+
+import json
+import sqlite3
+import threading
+import time
+
+
+# SQLiteファイルを使った永続ジョブキュー（外部ブローカー不要）
+# 同じホスト上の複数ワーカープロセスで共有できる。取り出したジョブには
+# リース期限を付け、処理中にプロセスが落ちても期限切れ後に再配布される
+class DurableQueue:
+    def __init__(self, path, lease_seconds=60):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'ready',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    available_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                )
+            """)
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_jobs_status_available_at ON jobs (status, available_at)"
+            )
+
+    def _connect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return _Transaction(connection)
+
+    def enqueue(self, payload, delay=0):
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "INSERT INTO jobs (payload, available_at, created_at) VALUES (?, ?, ?)",
+                (json.dumps(payload), now + delay, now)
+            )
+            return cursor.lastrowid
+
+    def claim(self):
+        # 実行可能なジョブを1件取り出し、リース期限まで他のワーカーから見えなくする
+        # 戻り値: (job_id, payload, attempts) または None
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute("""
+                SELECT id, payload, attempts FROM jobs
+                WHERE status IN ('ready', 'running') AND available_at <= ?
+                ORDER BY available_at, id
+                LIMIT 1
+            """, (now,)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, available_at = ? WHERE id = ?",
+                (now + self.lease_seconds, row[0])
+            )
+            return row[0], json.loads(row[1]), row[2] + 1
+
+    def complete(self, job_id):
+        with self._connect() as connection:
+            connection.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def fail(self, job_id, error, retry_delay=None):
+        # retry_delay が None なら再試行せず dead にする
+        with self._connect() as connection:
+            if retry_delay is None:
+                connection.execute(
+                    "UPDATE jobs SET status = 'dead', last_error = ? WHERE id = ?",
+                    (error, job_id)
+                )
+            else:
+                connection.execute(
+                    "UPDATE jobs SET status = 'ready', last_error = ?, available_at = ? WHERE id = ?",
+                    (error, time.time() + retry_delay, job_id)
+                )
+
+    def stats(self):
+        with self._connect() as connection:
+            counts = dict(connection.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+            ).fetchall())
+        return {status: counts.get(status, 0) for status in ("ready", "running", "dead")}
+
+
+# BEGIN IMMEDIATE で書き込みロックを先に取り、複数プロセスでの取り合いを防ぐ
+class _Transaction:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.connection.execute("COMMIT")
+        else:
+            self.connection.execute("ROLLBACK")
+
+
+# キューからジョブを取り出して handler(payload) を実行するワーカースレッド群
+class WorkerPool:
+    def __init__(self, queue, handler, workers=4, max_attempts=5, poll_interval=0.2):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.processed = 0
+        self.failed = 0
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"order-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=10):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                job = self.queue.claim()
+            except sqlite3.Error as e:
+                print(f"Error claiming job: {str(e)}")
+                job = None
+            if job is None:
+                self._stopping.wait(self.poll_interval)
+                continue
+
+            job_id, payload, attempts = job
+            try:
+                self.handler(payload)
+                self.queue.complete(job_id)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Error processing job {job_id} (attempt {attempts}): {str(e)}")
+                retry_delay = None if attempts >= self.max_attempts else min(2 ** attempts, 60)
+                self.queue.fail(job_id, str(e), retry_delay)
@@ -0,0 +1,70 @@
+# passwords.py
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+PREFIX = "scrypt"
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode()
+
+
+def _b64decode(data):
+    return base64.b64decode(data.encode())
+
+
+# scryptによるパスワードハッシュ
+# 計算はイベントループを塞がないよう専用スレッドプールで行い、同時実行数も制限する
+# 形式: scrypt$<n>$<r>$<p>$<salt>$<hash>
+class PasswordHasher:
+    def __init__(self, max_workers=2, n=2 ** 14, r=8, p=1):
+        self.n = n
+        self.r = r
+        self.p = p
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password")
+        self._semaphore = asyncio.Semaphore(max_workers)
+        # 存在しないユーザーでも同じ時間をかけるためのダミーハッシュ
+        self._dummy_hash = self.hash_sync(os.urandom(16).hex())
+
+    def _derive(self, password, salt, n, r, p):
+        return hashlib.scrypt(
+            password.encode(), salt=salt, n=n, r=r, p=p,
+            maxmem=128 * n * r * p + 1024 * 1024, dklen=32
+        )
+
+    def hash_sync(self, password):
+        salt = os.urandom(16)
+        derived = self._derive(password, salt, self.n, self.r, self.p)
+        return f"{PREFIX}${self.n}${self.r}${self.p}${_b64encode(salt)}${_b64encode(derived)}"
+
+    def verify_sync(self, password, stored):
+        # (一致したか, 再ハッシュが必要か) を返す
+        if stored is None:
+            self.verify_sync(password, self._dummy_hash)
+            return False, False
+
+        if not stored.startswith(PREFIX + "$"):
+            # 移行前の平文パスワード
+            return hmac.compare_digest(password.encode(), stored.encode()), True
+
+        _, n, r, p, salt, expected = stored.split("$")
+        n, r, p = int(n), int(r), int(p)
+        derived = self._derive(password, _b64decode(salt), n, r, p)
+        matched = hmac.compare_digest(derived, _b64decode(expected))
+        return matched, matched and (n, r, p) != (self.n, self.r, self.p)
+
+    async def _run(self, func, *args):
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    async def hash(self, password):
+        return await self._run(self.hash_sync, password)
+
+    async def verify(self, password, stored):
+        return await self._run(self.verify_sync, password, stored)
@@ -0,0 +1,44 @@
+# popularity.py
+
+import threading
+import time
+from collections import defaultdict
+
+
+# 時間減衰する人気度カウンタ（forward decay 方式）
+# 加算時に 2^((t - epoch) / half_life) 倍した値を足し込むことで、保存済みの値を
+# 書き換えずに「新しいイベントほど重い」順位を保つ。減衰後の値は decayed() で求める。
+# half_life=7日なら約19年で倍精度の上限に達するので、それまでに epoch を進めて全体を縮める
+class PopularityCounter:
+    def __init__(self, half_life, epoch):
+        self.half_life = half_life
+        self.epoch = epoch
+        self.flushed = 0
+        self._pending = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def scale(self, now=None):
+        now = time.time() if now is None else now
+        return 2 ** ((now - self.epoch) / self.half_life)
+
+    def decayed(self, score, now=None):
+        return score / self.scale(now)
+
+    def increment(self, product_id, weight=1.0):
+        value = weight * self.scale()
+        with self._lock:
+            self._pending[product_id] += value
+
+    def drain(self):
+        # 未反映の加算分を取り出す（DBへの反映に失敗したら restore() で戻す）
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+        return dict(pending)
+
+    def restore(self, pending):
+        with self._lock:
+            for product_id, value in pending.items():
+                self._pending[product_id] += value
+
+    def __len__(self):
+        return len(self._pending)
@@ -0,0 +1,99 @@
+# rate_limit.py
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+# プロセス内のトークンバケット保存先（上限を超えたら最も古いバケットから破棄）
+class MemoryBucketStore:
+    def __init__(self, max_buckets=10000):
+        self.max_buckets = max_buckets
+        self.evicted = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+
+            if tokens >= cost:
+                tokens -= cost
+                retry_after = 0
+            else:
+                retry_after = (cost - tokens) / rate
+
+            self._buckets[key] = (tokens, now)
+            # 長く使われていないバケットは満タンと同じなので破棄しても挙動は変わらない
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+                self.evicted += 1
+            return retry_after
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+# 複数ワーカーで共有するRedis上のトークンバケット
+class RedisBucketStore:
+    _SCRIPT = """
+    local burst = tonumber(ARGV[2])
+    local rate = tonumber(ARGV[1])
+    local cost = tonumber(ARGV[3])
+    local now = tonumber(ARGV[4])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+    local tokens = tonumber(state[1]) or burst
+    local updated_at = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+    local retry_after = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+    else
+        retry_after = (cost - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated_at', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(retry_after)
+    """
+
+    def __init__(self, url, prefix="ratelimit:"):
+        import redis
+
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._take = self._client.register_script(self._SCRIPT)
+
+    def take(self, key, rate, burst, cost=1):
+        return float(self._take(keys=[self.prefix + key], args=[rate, burst, cost, time.time()]))
+
+    def __len__(self):
+        return 0
+
+
+# レート制限超過
+class RateLimited(Exception):
+    def __init__(self, group, retry_after):
+        super().__init__(f"rate limit exceeded: {group}")
+        self.group = group
+        self.retry_after = retry_after
+
+
+# ルートグループごとの予算（1秒あたりの補充量とバースト量）でリクエストを制限する
+class RateLimiter:
+    def __init__(self, store, budgets):
+        self.store = store
+        self.budgets = budgets
+        self.limited = {group: 0 for group in budgets}
+
+    def check(self, group, key):
+        rate, burst = self.budgets[group]
+        retry_after = self.store.take(f"{group}:{key}", rate, burst)
+        if retry_after > 0:
+            self.limited[group] += 1
+            raise RateLimited(group, max(1, math.ceil(retry_after)))
+
+    def stats(self):
+        return {"buckets": len(self.store), "limited": dict(self.limited)}
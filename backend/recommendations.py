@@ -0,0 +1,190 @@
+# recommendations.py
+# 「よく一緒に購入されている商品」を事前計算するバッチ
+# 注文明細を注文ID範囲ごとに読み込み、商品×商品の共起行列（疎行列）を積み上げて
+# 商品ごとの関連商品上位を product_related テーブルへ書き込む
+#
+# 使い方:
+#   python recommendations.py           # 前回以降の注文だけを反映（差分更新）
+#   python recommendations.py --full    # 共起行列を作り直して全商品を再計算
+
+import argparse
+import os
+import time
+
+import numpy as np
+from scipy import sparse
+
+STATE_PATH = os.getenv("RECOMMENDATION_STATE_PATH", "recommendations_state.npz")
+
+
+# 1バッチ分の注文明細から共起行列への加算分を求める
+# order_ids, product_ids: 注文明細1行ごとの注文ID・商品ID（同じ長さの配列）
+def cooccurrence_delta(order_ids, product_ids, size):
+    _, rows = np.unique(order_ids, return_inverse=True)
+    baskets = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, product_ids)),
+        shape=(rows.max() + 1, size)
+    )
+    # 同じ注文内の同じ商品は1回として数える
+    baskets.sum_duplicates()
+    baskets.data[:] = 1
+    return (baskets.T @ baskets).tocsr()
+
+
+def resize(matrix, size):
+    if matrix.shape[0] >= size:
+        return matrix
+    matrix = matrix.tocsr(copy=True)
+    matrix.resize((size, size))
+    return matrix
+
+
+# 商品ごとの関連商品上位k件（コサイン類似度、共起回数 min_support 未満は除外）
+# 戻り値: {商品ID: [(関連商品ID, スコア), ...]}
+def top_related(cooccurrence, product_ids, top_k=20, min_support=2):
+    counts = cooccurrence.diagonal()
+    related = {}
+    for product_id in product_ids:
+        start, end = cooccurrence.indptr[product_id], cooccurrence.indptr[product_id + 1]
+        others = cooccurrence.indices[start:end]
+        together = cooccurrence.data[start:end]
+
+        mask = (others != product_id) & (together >= min_support)
+        others = others[mask]
+        if len(others) == 0:
+            related[product_id] = []
+            continue
+        scores = together[mask] / np.sqrt(counts[product_id] * counts[others])
+
+        if len(scores) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        related[product_id] = [(int(others[i]), float(scores[i])) for i in best]
+    return related
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return sparse.csr_matrix((1, 1), dtype=np.float32), 0
+    state = np.load(path)
+    size = int(state["size"])
+    matrix = sparse.csr_matrix(
+        (state["data"], state["indices"], state["indptr"]), shape=(size, size)
+    )
+    return matrix, int(state["last_order_id"])
+
+
+def save_state(path, matrix, last_order_id):
+    # 書き込み途中で壊れないよう一時ファイルに書いてから置き換える
+    temporary_path = path + ".tmp.npz"
+    np.savez_compressed(
+        temporary_path,
+        data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+        size=matrix.shape[0], last_order_id=last_order_id
+    )
+    os.replace(temporary_path, path)
+
+
+# 注文ID範囲ごとに完了済み注文の明細を読み込む（1つの注文の明細が範囲をまたがない）
+# 非同期受付でまだ pending の注文があれば、その手前までで止める（次回の差分更新で読む）。
+# ただし max_pending_age 時間より古い pending の注文は処理が止まっているものとみなし、待たない。
+# IDの順にコミットされるとは限らないので、直近1分の注文も次回に回す
+def stream_order_lines(cursor, after_order_id, window, max_pending_age=24):
+    cursor.execute("SELECT MAX(id) AS max_id FROM orders WHERE created_at < NOW() - INTERVAL 1 MINUTE")
+    max_order_id = cursor.fetchone()['max_id'] or 0
+    cursor.execute("""
+        SELECT MIN(id) AS pending_id
+        FROM orders
+        WHERE id > %s AND status = 'pending' AND created_at >= NOW() - INTERVAL %s HOUR
+    """, (after_order_id, max_pending_age))
+    pending_order_id = cursor.fetchone()['pending_id']
+    if pending_order_id is not None:
+        max_order_id = min(max_order_id, pending_order_id - 1)
+
+    window_start = after_order_id
+    while window_start < max_order_id:
+        window_end = min(window_start + window, max_order_id)
+        cursor.execute("""
+            SELECT od.order_id, od.product_id
+            FROM orders o
+            JOIN order_details od ON od.order_id = o.id
+            WHERE o.id > %s AND o.id <= %s AND o.status = 'completed'
+        """, (window_start, window_end))
+        rows = cursor.fetchall()
+        order_ids = np.fromiter((row['order_id'] for row in rows), dtype=np.int64, count=len(rows))
+        product_ids = np.fromiter((row['product_id'] for row in rows), dtype=np.int64, count=len(rows))
+        yield window_end, order_ids, product_ids
+        window_start = window_end
+
+
+def write_related(get_db_cursor, related, batch_size=1000):
+    product_ids = sorted(related)
+    for start in range(0, len(product_ids), batch_size):
+        batch = product_ids[start:start + batch_size]
+        placeholders = ", ".join(["%s"] * len(batch))
+        with get_db_cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM product_related WHERE product_id IN ({placeholders})",
+                batch
+            )
+            rows = [
+                (product_id, position, related_id, score)
+                for product_id in batch
+                for position, (related_id, score) in enumerate(related[product_id])
+            ]
+            if rows:
+                cursor.executemany("""
+                    INSERT INTO product_related (product_id, position, related_product_id, score)
+                    VALUES (%s, %s, %s, %s)
+                """, rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="関連商品（よく一緒に購入されている商品）の事前計算")
+    parser.add_argument("--full", action="store_true", help="前回の状態を使わずに作り直す")
+    parser.add_argument("--window", type=int, default=50000, help="1回に読み込む注文数")
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--min-support", type=int, default=2)
+    parser.add_argument(
+        "--max-pending-age", type=int, default=24,
+        help="これより古い（時間）pending の注文は待たずに先へ進む"
+    )
+    parser.add_argument("--state", default=STATE_PATH)
+    args = parser.parse_args()
+
+    from db import get_db_cursor
+
+    started_at = time.monotonic()
+    if args.full:
+        cooccurrence, last_order_id = sparse.csr_matrix((1, 1), dtype=np.float32), 0
+    else:
+        cooccurrence, last_order_id = load_state(args.state)
+
+    touched = set()
+    lines = 0
+    with get_db_cursor() as cursor:
+        for window_end, order_ids, product_ids in stream_order_lines(
+            cursor, last_order_id, args.window, args.max_pending_age
+        ):
+            if len(product_ids):
+                size = max(cooccurrence.shape[0], int(product_ids.max()) + 1)
+                cooccurrence = resize(cooccurrence, size)
+                cooccurrence = cooccurrence + cooccurrence_delta(order_ids, product_ids, size)
+                touched.update(np.unique(product_ids).tolist())
+                lines += len(product_ids)
+            last_order_id = window_end
+            print(f"orders <= {window_end}: {lines} lines")
+
+    # 差分更新では新しい注文に含まれる商品の行だけを計算し直す
+    if args.full:
+        touched = set(np.flatnonzero(cooccurrence.diagonal()).tolist())
+    related = top_related(cooccurrence, sorted(touched), args.top_k, args.min_support)
+    write_related(get_db_cursor, related)
+    save_state(args.state, cooccurrence, last_order_id)
+    print(f"{len(related)} products updated in {time.monotonic() - started_at:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# replicas.py
+
+import itertools
+import threading
+import time
+
+import mysql.connector
+
+
+# 読み取り専用クエリの振り分け先（リードレプリカ）の管理
+# check() で各レプリカの遅延を定期的に調べ、max_lag 秒以内のものだけを使う。
+# 使えるレプリカがない・接続できない場合は None を返し、呼び出し側はプライマリを使う
+class ReplicaRouter:
+    def __init__(self, configs, max_lag=2, pin_seconds=5, connect_timeout=2):
+        self.configs = configs
+        self.max_lag = max_lag
+        self.pin_seconds = pin_seconds
+        self.connect_timeout = connect_timeout
+        self.fallbacks = 0
+        # 遅延を確認するまでは使わない
+        self._lag = {index: None for index in range(len(configs))}
+        self._healthy = []
+        self._round_robin = itertools.count()
+        self._pins = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.configs)
+
+    def _connect(self, config):
+        return mysql.connector.connect(**config, connection_timeout=self.connect_timeout)
+
+    def _measure_lag(self, config):
+        connection = self._connect(config)
+        try:
+            cursor = connection.cursor(dictionary=True)
+            try:
+                cursor.execute("SHOW REPLICA STATUS")
+                column = "Seconds_Behind_Source"
+            except mysql.connector.Error:
+                # MySQL 8.0.22 より前
+                cursor.execute("SHOW SLAVE STATUS")
+                column = "Seconds_Behind_Master"
+            rows = cursor.fetchall()
+            cursor.close()
+        finally:
+            connection.close()
+        if not rows:
+            # レプリケーション設定のない単体のインスタンス（ローカル検証用）は遅延0とみなす
+            return 0
+        # NULL はレプリケーション停止中
+        lags = [row[column] for row in rows]
+        return None if any(lag is None for lag in lags) else max(lags)
+
+    def check(self):
+        for index, config in enumerate(self.configs):
+            try:
+                lag = self._measure_lag(config)
+            except mysql.connector.Error as e:
+                print(f"Replica {config['host']} is unreachable: {str(e)}")
+                lag = None
+            self._lag[index] = lag
+        with self._lock:
+            self._healthy = [
+                index for index, lag in self._lag.items()
+                if lag is not None and lag <= self.max_lag
+            ]
+            now = time.monotonic()
+            for user_id, until in list(self._pins.items()):
+                if until <= now:
+                    del self._pins[user_id]
+
+    def pin(self, user_id):
+        # 書き込んだユーザーの読み取りを一定時間プライマリに固定する（自分の書き込みが見えるように）
+        if self.enabled:
+            with self._lock:
+                self._pins[user_id] = time.monotonic() + self.pin_seconds
+
+    def pinned(self, user_id):
+        with self._lock:
+            return self._pins.get(user_id, 0) > time.monotonic()
+
+    def connect(self, user_id=None):
+        # 遅延の小さいレプリカへの接続を返す（使えない場合は None）
+        if not self.enabled or (user_id is not None and self.pinned(user_id)):
+            return None
+        with self._lock:
+            healthy = list(self._healthy)
+        start = next(self._round_robin)
+        for offset in range(len(healthy)):
+            index = healthy[(start + offset) % len(healthy)]
+            try:
+                return self._connect(self.configs[index])
+            except mysql.connector.Error as e:
+                print(f"Replica {self.configs[index]['host']} is unreachable: {str(e)}")
+                with self._lock:
+                    if index in self._healthy:
+                        self._healthy.remove(index)
+        self.fallbacks += 1
+        return None
+
+    def stats(self):
+        return {
+            "replicas": [
+                {"host": config['host'], "lag": self._lag[index]}
+                for index, config in enumerate(self.configs)
+            ],
+            "healthy": len(self._healthy),
+            "pinned_users": len(self._pins),
+            "fallbacks": self.fallbacks
+        }
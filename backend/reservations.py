@@ -0,0 +1,412 @@
+# reservations.py
+
+import os
+import threading
+import time
+
+
+def hot_product_ids():
+    # 在庫引当の対象商品（HOT_PRODUCT_IDS にカンマ区切りで指定）
+    return [int(value) for value in os.getenv("HOT_PRODUCT_IDS", "").split(",") if value.strip()]
+
+
+class _Pool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # DBから切り出したが、まだ誰にも引き当てていない在庫
+        self.free = 0
+        # user_id -> [数量, 期限, 設定した時刻（time.time()）]
+        self.holds = {}
+        self.last_used = time.monotonic()
+        # DB側の行を作り直すたびに進める（回収の検出と、その後に切り出した分の取り違えを防ぐ）
+        self.generation = 0
+
+    def held(self):
+        return sum(hold[0] for hold in self.holds.values())
+
+
+# 限定販売などアクセスが集中する商品の在庫引当をメモリ上で行う
+# products.stock から在庫をまとめて切り出して手元に持ち、カート追加のたびに
+# products 行をロックせずに期限付きの引当（ホールド）を作る。
+# 切り出した数（手元の在庫 + 引当中）は store を通じてワーカーごとにDBへ記録するので、
+# 在庫の表示には products.stock と各ワーカーの未引当分を合計した値を使え、
+# 落ちたワーカーの分は他のワーカーが回収できる。
+# 1回に切り出す数は残り在庫をワーカー数で分けた量までに抑え、1つのワーカーが抱え込まないようにする。
+# ユーザーはワーカーに固定されないので、あるワーカーで引当を変えたら on_hold_change で他のワーカーへ知らせ、
+# 他のワーカーは drop_holds() で同じユーザーの古い引当を外す（引当は最後に変えたワーカーのものだけが残る）。
+# 期限切れや余った在庫は reconcile() でまとめてDBへ戻す
+class StockReservations:
+    def __init__(self, product_ids, store, block_size=50, hold_seconds=600, workers=1, on_hold_change=None):
+        # store: DatabaseReservationStore と同じメソッドを持つ、切り出した在庫の記録先
+        # workers: 切り出し量の計算に使うワーカー数の下限（実際の数は store から得る）
+        # on_hold_change(changes): このワーカーで引当を変えた [(商品ID, user_id, 時刻)] の通知先
+        self.product_ids = frozenset(product_ids)
+        self.store = store
+        self.block_size = block_size
+        self.hold_seconds = hold_seconds
+        self.workers = workers
+        self.on_hold_change = on_hold_change
+        self.sold = 0
+        self.rejected = 0
+        self.lost = 0
+        self._pools = {product_id: _Pool() for product_id in self.product_ids}
+
+    def __contains__(self, product_id):
+        return product_id in self._pools
+
+    def _expire(self, pool, now):
+        for user_id, (quantity, expires_at, _) in list(pool.holds.items()):
+            if expires_at <= now:
+                pool.free += quantity
+                del pool.holds[user_id]
+
+    def _reset(self, pool):
+        # DB側の記録が回収された（停止したワーカーとみなされた）ので、手元の在庫と引当を捨てる
+        # （カートの商品は注文確定時に引き当て直す）
+        pool.free = 0
+        pool.holds.clear()
+        self.lost += 1
+
+    def block(self, shortage, remaining, workers):
+        # 1回に切り出す数（残り在庫が shortage 未満なら0）
+        # 残り在庫の 1/(2×ワーカー数) と block_size の小さい方まで。ただし不足分は必ず切り出す
+        if remaining < shortage:
+            return 0
+        share = remaining // (2 * max(workers, self.workers, 1))
+        return min(remaining, max(shortage, min(self.block_size, share)))
+
+    def _notify(self, changes):
+        if self.on_hold_change is not None and changes:
+            self.on_hold_change(changes)
+
+    def hold(self, product_id, user_id, quantity):
+        # ユーザーの引当数を quantity にそろえ、期限を延長する（足りなければ False）
+        if not self._hold(product_id, user_id, quantity):
+            return False
+        self._notify([(product_id, user_id, time.time())])
+        return True
+
+    def _hold(self, product_id, user_id, quantity):
+        pool = self._pools[product_id]
+        with pool.lock:
+            now = time.monotonic()
+            pool.last_used = now
+            self._expire(pool, now)
+            current = pool.holds.get(user_id, [0])[0]
+            needed = quantity - current
+            # 回収に気付いて手元の在庫を捨てた場合は、不足分を計算し直してもう1回切り出す
+            for _ in range(2):
+                if needed <= pool.free:
+                    break
+                shortage = needed - pool.free
+                taken, persisted = self.store.take(
+                    product_id, shortage,
+                    lambda remaining, workers: self.block(shortage, remaining, workers)
+                )
+                if persisted is None:
+                    # DB側の行が新しく作られた（手元に在庫があるなら、それは回収済み）
+                    pool.generation += 1
+                    if pool.free or pool.holds:
+                        self._reset(pool)
+                        needed = quantity
+                pool.free += taken
+            if needed > pool.free:
+                self.rejected += 1
+                return False
+            pool.free -= needed
+            if quantity > 0:
+                pool.holds[user_id] = [quantity, now + self.hold_seconds, time.time()]
+            else:
+                pool.holds.pop(user_id, None)
+            return True
+
+    def _release(self, product_id, user_id, changed_before=None):
+        # changed_before を指定した場合は、その時刻より後に設定した引当は外さない
+        pool = self._pools[product_id]
+        with pool.lock:
+            hold = pool.holds.get(user_id)
+            if hold is None or (changed_before is not None and hold[2] > changed_before):
+                return
+            del pool.holds[user_id]
+            pool.free += hold[0]
+
+    def release(self, product_id, user_id):
+        self._release(product_id, user_id)
+        self._notify([(product_id, user_id, time.time())])
+
+    def release_user(self, user_id):
+        for product_id in self._pools:
+            self._release(product_id, user_id)
+        changed_at = time.time()
+        self._notify([(product_id, user_id, changed_at) for product_id in sorted(self._pools)])
+
+    def drop_holds(self, changes):
+        # 他のワーカーが引当を変えた [(商品ID, user_id, 時刻)] について、このワーカーの同じユーザーの引当を外す
+        # （通知より後にこのワーカーで設定し直した引当は残す）
+        for product_id, user_id, changed_at in changes:
+            if product_id in self._pools:
+                self._release(product_id, user_id, changed_before=changed_at)
+
+    def consume(self, cursor, product_id, quantity):
+        # 注文のトランザクション内で、このワーカーの切り出し分から quantity を減らす
+        # 記録が回収されていて減らせなければ手元の在庫と引当を捨てて False を返す
+        # （呼び出し側は products.stock から確保し直す）
+        if self.store.consume(cursor, product_id, quantity):
+            return True
+        pool = self._pools[product_id]
+        with pool.lock:
+            self._reset(pool)
+        return False
+
+    def commit(self, product_id, user_id, quantity):
+        # consume() した注文のコミット後に、確定分を引当から外す
+        pool = self._pools[product_id]
+        with pool.lock:
+            held = pool.holds.get(user_id)
+            covered = min(held[0], quantity) if held is not None else 0
+            if held is not None:
+                held[0] -= covered
+                if held[0] <= 0:
+                    del pool.holds[user_id]
+            # 引当が期限切れ等で足りなかった分は手元の在庫から減らす（DB側はすでに減らし済み）
+            pool.free = max(pool.free - (quantity - covered), 0)
+            self.sold += quantity
+        self._notify([(product_id, user_id, time.time())])
+
+    def held(self, product_id, user_id):
+        # このワーカーでユーザーが引き当てている数
+        pool = self._pools[product_id]
+        with pool.lock:
+            self._expire(pool, time.monotonic())
+            return pool.holds.get(user_id, [0])[0]
+
+    def _drop_lost(self, lost, generations):
+        # 回収された商品の手元の在庫を捨てる（確認後に行を作り直した商品は除く）
+        for product_id in lost:
+            pool = self._pools[product_id]
+            with pool.lock:
+                if pool.generation == generations.get(product_id):
+                    self._reset(pool)
+
+    def reconcile(self, release_all=False):
+        # 期限切れの引当を解放し、引当数とワーカーの生存を記録したうえで、
+        # 手元に残す分（残り在庫の取り分、しばらく使われていない商品は0）を超える在庫をDBへ戻す
+        # release_all=True なら引当中の分も含めてすべて戻す（終了時用）
+        now = time.monotonic()
+        held = {}
+        generations = {}
+        for product_id, pool in self._pools.items():
+            with pool.lock:
+                self._expire(pool, now)
+                if release_all:
+                    pool.free += pool.held()
+                    pool.holds.clear()
+                if pool.free or pool.holds:
+                    held[product_id] = pool.held()
+                    generations[product_id] = pool.generation
+
+        remaining, workers = {}, 1
+        if not release_all:
+            lost, remaining, workers = self.store.sync(held)
+            self._drop_lost(lost, generations)
+
+        surplus = {}
+        for product_id, pool in self._pools.items():
+            with pool.lock:
+                if release_all or (not pool.holds and now - pool.last_used > self.hold_seconds):
+                    keep = 0
+                else:
+                    keep = self.block(0, remaining.get(product_id, 0) + pool.free, workers)
+                if pool.free > keep:
+                    surplus[product_id] = pool.free - keep
+                    pool.free = keep
+                    generations[product_id] = pool.generation
+        if not surplus:
+            return surplus
+        try:
+            lost = self.store.give_back(surplus)
+        except Exception:
+            for product_id, quantity in surplus.items():
+                pool = self._pools[product_id]
+                with pool.lock:
+                    pool.free += quantity
+            raise
+        self._drop_lost(lost, generations)
+        return surplus
+
+    def stats(self):
+        products = {}
+        for product_id, pool in self._pools.items():
+            with pool.lock:
+                products[product_id] = {
+                    "free": pool.free,
+                    "held": pool.held(),
+                    "holds": len(pool.holds)
+                }
+        return {"sold": self.sold, "rejected": self.rejected, "lost": self.lost, "products": products}
+
+
+# 切り出した在庫のワーカーごとの記録（stock_reservations テーブル）
+# quantity: products.stock から切り出してまだ売れていない数 / held: そのうち引当中の数（reconcile 時に更新）
+# ロックは products → stock_reservations の順に取る
+class DatabaseReservationStore:
+    def __init__(self, get_db_cursor, worker_id, worker_timeout=60, notify=None):
+        # worker_timeout: この秒数 heartbeat_at が更新されないワーカーの分は停止したとみなして回収する
+        # notify(product_ids): 表示する在庫数が変わった商品の通知先
+        self.get_db_cursor = get_db_cursor
+        self.worker_id = worker_id
+        self.worker_timeout = worker_timeout
+        self.notify = notify
+        self.reclaimed = 0
+
+    def _live_workers(self, cursor):
+        cursor.execute("""
+            SELECT COUNT(DISTINCT worker_id) AS workers
+            FROM stock_reservations
+            WHERE heartbeat_at >= NOW() - INTERVAL %s SECOND AND worker_id <> %s
+        """, (self.worker_timeout, self.worker_id))
+        return cursor.fetchone()['workers'] + 1
+
+    def take(self, product_id, shortage, size):
+        # size(残り在庫, ワーカー数) の数だけ切り出す
+        # 戻り値: (切り出した数, 切り出す前の記録の数量。記録がなければ None)
+        with self.get_db_cursor() as cursor:
+            cursor.execute("SELECT stock FROM products WHERE id = %s FOR UPDATE", (product_id,))
+            product = cursor.fetchone()
+            cursor.execute("""
+                SELECT quantity FROM stock_reservations
+                WHERE product_id = %s AND worker_id = %s
+                FOR UPDATE
+            """, (product_id, self.worker_id))
+            row = cursor.fetchone()
+            persisted = row['quantity'] if row else None
+            if not product:
+                return 0, persisted
+            taken = size(product['stock'], self._live_workers(cursor))
+            if taken <= 0:
+                return 0, persisted
+            cursor.execute(
+                "UPDATE products SET stock = stock - %s WHERE id = %s",
+                (taken, product_id)
+            )
+            cursor.execute("""
+                INSERT INTO stock_reservations (product_id, worker_id, quantity, held, heartbeat_at)
+                VALUES (%s, %s, %s, 0, NOW())
+                ON DUPLICATE KEY UPDATE
+                    quantity = quantity + VALUES(quantity),
+                    heartbeat_at = NOW()
+            """, (product_id, self.worker_id, taken))
+        return taken, persisted
+
+    def give_back(self, quantities):
+        # 切り出した在庫を products.stock へ戻す。記録が回収済みだった商品IDの集合を返す
+        lost = set()
+        with self.get_db_cursor() as cursor:
+            for product_id in sorted(quantities):
+                cursor.execute("SELECT id FROM products WHERE id = %s FOR UPDATE", (product_id,))
+                cursor.fetchone()
+                cursor.execute("""
+                    UPDATE stock_reservations
+                    SET quantity = quantity - %s
+                    WHERE product_id = %s AND worker_id = %s AND quantity >= %s
+                """, (quantities[product_id], product_id, self.worker_id, quantities[product_id]))
+                if cursor.rowcount == 0:
+                    lost.add(product_id)
+                    continue
+                cursor.execute(
+                    "UPDATE products SET stock = stock + %s WHERE id = %s",
+                    (quantities[product_id], product_id)
+                )
+        return lost
+
+    def consume(self, cursor, product_id, quantity):
+        cursor.execute("""
+            UPDATE stock_reservations
+            SET quantity = quantity - %s
+            WHERE product_id = %s AND worker_id = %s AND quantity >= %s
+        """, (quantity, product_id, self.worker_id, quantity))
+        return cursor.rowcount > 0
+
+    def sync(self, held):
+        # held: {商品ID: 引当中の数}（切り出した在庫がある商品のみ）
+        # 生存を記録して引当数を更新し、停止したワーカーの分を回収する
+        # 戻り値: (記録が回収済みだった商品IDの集合, {商品ID: products.stock}, 生存ワーカー数)
+        with self.get_db_cursor() as cursor:
+            cursor.execute(
+                "SELECT product_id, held FROM stock_reservations WHERE worker_id = %s FOR UPDATE",
+                (self.worker_id,)
+            )
+            persisted = {row['product_id']: row['held'] for row in cursor.fetchall()}
+            lost = {product_id for product_id in held if product_id not in persisted}
+            changed = sorted(
+                product_id for product_id, quantity in held.items()
+                if product_id in persisted and persisted[product_id] != quantity
+            )
+            cursor.execute(
+                "UPDATE stock_reservations SET heartbeat_at = NOW() WHERE worker_id = %s",
+                (self.worker_id,)
+            )
+            if changed:
+                cursor.executemany(
+                    "UPDATE stock_reservations SET held = %s WHERE product_id = %s AND worker_id = %s",
+                    [(held[product_id], product_id, self.worker_id) for product_id in changed]
+                )
+            remaining = {}
+            if held:
+                placeholders = ", ".join(["%s"] * len(held))
+                cursor.execute(
+                    f"SELECT id, stock FROM products WHERE id IN ({placeholders})",
+                    sorted(held)
+                )
+                remaining = {row['id']: row['stock'] for row in cursor.fetchall()}
+            workers = self._live_workers(cursor)
+
+        changed.extend(self.reclaim())
+        if changed and self.notify is not None:
+            self.notify(sorted(set(changed)))
+        return lost, remaining, workers
+
+    def reclaim(self):
+        # 停止したワーカーの切り出し分を products.stock へ戻して記録を消す（戻した商品IDのリストを返す）
+        with self.get_db_cursor() as cursor:
+            cursor.execute("""
+                SELECT DISTINCT product_id
+                FROM stock_reservations
+                WHERE heartbeat_at < NOW() - INTERVAL %s SECOND AND worker_id <> %s
+                ORDER BY product_id
+            """, (self.worker_timeout, self.worker_id))
+            product_ids = [row['product_id'] for row in cursor.fetchall()]
+            if not product_ids:
+                return []
+
+            placeholders = ", ".join(["%s"] * len(product_ids))
+            cursor.execute(
+                f"SELECT id FROM products WHERE id IN ({placeholders}) ORDER BY id FOR UPDATE",
+                product_ids
+            )
+            cursor.fetchall()
+            cursor.execute(f"""
+                SELECT product_id, worker_id, quantity
+                FROM stock_reservations
+                WHERE product_id IN ({placeholders})
+                    AND heartbeat_at < NOW() - INTERVAL %s SECOND AND worker_id <> %s
+                FOR UPDATE
+            """, product_ids + [self.worker_timeout, self.worker_id])
+            rows = cursor.fetchall()
+
+            quantities = {}
+            for row in rows:
+                quantities[row['product_id']] = quantities.get(row['product_id'], 0) + row['quantity']
+            if not rows:
+                return []
+            cursor.executemany(
+                "UPDATE products SET stock = stock + %s WHERE id = %s",
+                [(quantity, product_id) for product_id, quantity in sorted(quantities.items())]
+            )
+            cursor.executemany(
+                "DELETE FROM stock_reservations WHERE product_id = %s AND worker_id = %s",
+                [(row['product_id'], row['worker_id']) for row in rows]
+            )
+        self.reclaimed += sum(quantities.values())
+        print(f"Reclaimed reserved stock of stopped workers: {quantities}")
+        return sorted(quantities)
@@ -0,0 +1,52 @@
+# sales_rollup.py
+
+import threading
+from collections import defaultdict
+
+
+def sales_totals(items, sales_date):
+    # 注文明細から日別売上集計への加算分を求める
+    # items: product_id, category_id, quantity, price を持つ注文明細のリスト
+    # 戻り値: ({(日付, 商品ID, カテゴリーID): [数量, 売上]}, {(日付, カテゴリーID): [数量, 売上]})
+    by_product = defaultdict(lambda: [0, 0])
+    by_category = defaultdict(lambda: [0, 0])
+    for item in items:
+        amount = int(item['price']) * item['quantity']
+        for totals in (
+            by_product[(sales_date, item['product_id'], item['category_id'])],
+            by_category[(sales_date, item['category_id'])]
+        ):
+            totals[0] += item['quantity']
+            totals[1] += amount
+    return dict(by_product), dict(by_category)
+
+
+# 日別売上集計への加算分をメモリ上に貯め、まとめてDBへ反映する
+# 注文確定のトランザクションで集計行を更新すると、同じカテゴリーの注文がその行のロックで
+# 直列化されるため、コミット後にここへ加算し、定期的に1回の upsert で書き込む
+class SalesRollup:
+    def __init__(self):
+        self.flushed = 0
+        self._products = defaultdict(lambda: [0, 0])
+        self._categories = defaultdict(lambda: [0, 0])
+        self._lock = threading.Lock()
+
+    def add(self, items, sales_date):
+        self.restore(*sales_totals(items, sales_date))
+
+    def drain(self):
+        # 未反映の加算分を取り出す（DBへの反映に失敗したら restore() で戻す）
+        with self._lock:
+            products, self._products = self._products, defaultdict(lambda: [0, 0])
+            categories, self._categories = self._categories, defaultdict(lambda: [0, 0])
+        return dict(products), dict(categories)
+
+    def restore(self, products, categories):
+        with self._lock:
+            for pending, totals in ((self._products, products), (self._categories, categories)):
+                for key, (units, revenue) in totals.items():
+                    pending[key][0] += units
+                    pending[key][1] += revenue
+
+    def __len__(self):
+        return len(self._products) + len(self._categories)
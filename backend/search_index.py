@@ -0,0 +1,141 @@
+# search_index.py
+
+import heapq
+import math
+import threading
+import unicodedata
+from collections import Counter
+
+# 商品名の一致は説明文より重く評価する
+NAME_WEIGHT = 3
+K1 = 1.2
+B = 0.75
+
+
+def _runs(text):
+    # NFKC正規化・小文字化し、文字/数字の連続部分ごとに分割する
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    run = []
+    for char in text:
+        if unicodedata.category(char)[0] in ("L", "N"):
+            run.append(char)
+        elif run:
+            yield "".join(run)
+            run = []
+    if run:
+        yield "".join(run)
+
+
+def tokenize(text):
+    # 日本語でも分かち書き不要な 1-gram + 2-gram
+    tokens = []
+    for run in _runs(text):
+        tokens.extend(run)
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def query_tokens(text):
+    # 2文字以上の語は 2-gram、1文字の語は 1-gram で検索する
+    tokens = []
+    for run in _runs(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return list(dict.fromkeys(tokens))
+
+
+# 商品名・説明文の転置インデックス（BM25でランキング）
+class SearchIndex:
+    def __init__(self):
+        self._postings = {}
+        self._docs = {}
+        self._total_length = 0
+        self._lock = threading.RLock()
+        # 差分同期の位置 (updated_at, id)
+        self.synced_until = None
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, product_id, category_id, name, description):
+        weights = Counter()
+        for token in tokenize(name):
+            weights[token] += NAME_WEIGHT
+        for token in tokenize(description):
+            weights[token] += 1
+        length = sum(weights.values())
+
+        with self._lock:
+            self._remove(product_id)
+            for token, weight in weights.items():
+                self._postings.setdefault(token, {})[product_id] = weight
+            self._docs[product_id] = (category_id, length, tuple(weights))
+            self._total_length += length
+
+    def remove(self, product_id):
+        with self._lock:
+            self._remove(product_id)
+
+    def _remove(self, product_id):
+        doc = self._docs.pop(product_id, None)
+        if doc is None:
+            return
+        _, length, tokens = doc
+        for token in tokens:
+            postings = self._postings.get(token)
+            if postings is not None:
+                postings.pop(product_id, None)
+                if not postings:
+                    del self._postings[token]
+        self._total_length -= length
+
+    def product_ids(self):
+        with self._lock:
+            return set(self._docs)
+
+    def search(self, query, category_id=None, offset=0, limit=20):
+        # (ヒット件数, [(product_id, score), ...]) を返す
+        tokens = query_tokens(query)
+        if not tokens:
+            return 0, []
+
+        with self._lock:
+            postings = [self._postings.get(token) for token in tokens]
+            if not all(postings):
+                return 0, []
+            postings.sort(key=len)
+
+            # 全トークンを含む商品に絞り込む（件数の少ない順に積集合を取る）
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates.intersection_update(posting)
+                if not candidates:
+                    return 0, []
+            if category_id is not None:
+                candidates = {
+                    product_id for product_id in candidates
+                    if self._docs[product_id][0] == category_id
+                }
+
+            docs = self._docs
+            doc_count = len(docs)
+            length_factor = K1 * B * doc_count / self._total_length
+            base_norm = K1 * (1 - B)
+            weighted = [
+                (posting, math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5)) * (K1 + 1))
+                for posting in postings
+            ]
+
+            scored = []
+            for product_id in candidates:
+                norm = base_norm + length_factor * docs[product_id][1]
+                score = 0.0
+                for posting, idf in weighted:
+                    weight = posting[product_id]
+                    score += idf * weight / (weight + norm)
+                scored.append((score, -product_id))
+
+        top = heapq.nlargest(offset + limit, scored)[offset:]
+        return len(scored), [(-negative_id, score) for score, negative_id in top]
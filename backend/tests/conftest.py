@@ -0,0 +1,5 @@
+import os
+import sys
+
+# backend/ のモジュールは backend/ をカレントにして起動する前提で import されている
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,382 @@
+import pytest
+
+import reservations
+from reservations import StockReservations
+
+PRODUCT_ID = 1
+
+
+class SharedStock:
+    # products.stock と stock_reservations をメモリ上で再現する（複数ワーカーで共有）
+    def __init__(self, stock):
+        self.stock = {PRODUCT_ID: stock}
+        # (商品ID, ワーカーID) -> {"quantity", "held"}
+        self.rows = {}
+        self.stopped = set()
+
+    def workers(self, worker_id):
+        live = {key[1] for key in self.rows if key[1] not in self.stopped}
+        return len(live - {worker_id}) + 1
+
+    def reclaim(self, worker_id):
+        # 停止したワーカーの分を products.stock へ戻す
+        for key in [key for key in self.rows if key[1] == worker_id]:
+            self.stock[key[0]] += self.rows.pop(key)["quantity"]
+
+    def total(self):
+        return self.stock[PRODUCT_ID] + sum(row["quantity"] for row in self.rows.values())
+
+
+class MemoryStore:
+    # DatabaseReservationStore と同じメソッドを持つ、テスト用の記録先
+    def __init__(self, shared, worker_id):
+        self.shared = shared
+        self.worker_id = worker_id
+        self.fail_give_back = False
+
+    def row(self, product_id):
+        return self.shared.rows.get((product_id, self.worker_id))
+
+    def take(self, product_id, shortage, size):
+        row = self.row(product_id)
+        persisted = row["quantity"] if row else None
+        taken = size(self.shared.stock[product_id], self.shared.workers(self.worker_id))
+        if taken > 0:
+            self.shared.stock[product_id] -= taken
+            row = self.shared.rows.setdefault((product_id, self.worker_id), {"quantity": 0, "held": 0})
+            row["quantity"] += taken
+        return taken, persisted
+
+    def give_back(self, quantities):
+        if self.fail_give_back:
+            raise RuntimeError("database unavailable")
+        lost = set()
+        for product_id, quantity in quantities.items():
+            row = self.row(product_id)
+            if row is None or row["quantity"] < quantity:
+                lost.add(product_id)
+                continue
+            row["quantity"] -= quantity
+            self.shared.stock[product_id] += quantity
+        return lost
+
+    def consume(self, cursor, product_id, quantity):
+        row = self.row(product_id)
+        if row is None or row["quantity"] < quantity:
+            return False
+        row["quantity"] -= quantity
+        return True
+
+    def sync(self, held):
+        lost = {product_id for product_id in held if self.row(product_id) is None}
+        for product_id, quantity in held.items():
+            if product_id not in lost:
+                self.row(product_id)["held"] = quantity
+        remaining = {product_id: self.shared.stock[product_id] for product_id in held}
+        return lost, remaining, self.shared.workers(self.worker_id)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(reservations.time, "monotonic", clock)
+    monkeypatch.setattr(reservations.time, "time", clock)
+    return clock
+
+
+def make_worker(shared, worker_id, **kwargs):
+    store = MemoryStore(shared, worker_id)
+    options = dict(block_size=50, hold_seconds=600)
+    options.update(kwargs)
+    return StockReservations([PRODUCT_ID], store, **options), store
+
+
+def pool_total(engine):
+    stats = engine.stats()["products"][PRODUCT_ID]
+    return stats["free"] + stats["held"]
+
+
+def test_hold_carves_only_a_share_of_the_remaining_stock(clock):
+    shared = SharedStock(50)
+    engine, store = make_worker(shared, "a")
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=1)
+
+    # 1ワーカーでも残り在庫の半分までしか切り出さない
+    assert shared.stock[PRODUCT_ID] == 25
+    assert store.row(PRODUCT_ID)["quantity"] == 25
+    assert pool_total(engine) == 25
+    assert shared.total() == 50
+
+
+def test_other_workers_can_still_hold_after_one_worker_carves(clock):
+    shared = SharedStock(50)
+    first, _ = make_worker(shared, "a")
+    second, _ = make_worker(shared, "b")
+
+    assert first.hold(PRODUCT_ID, user_id=10, quantity=1)
+    assert second.hold(PRODUCT_ID, user_id=20, quantity=20)
+    assert shared.stock[PRODUCT_ID] > 0
+    assert shared.total() == 50
+
+
+def test_small_stock_is_carved_only_as_needed(clock):
+    shared = SharedStock(3)
+    engine, _ = make_worker(shared, "a", workers=4)
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=1)
+
+    assert shared.stock[PRODUCT_ID] == 2
+    assert pool_total(engine) == 1
+
+
+def test_hold_fails_when_stock_is_insufficient(clock):
+    shared = SharedStock(5)
+    engine, _ = make_worker(shared, "a")
+
+    assert not engine.hold(PRODUCT_ID, user_id=10, quantity=6)
+    assert engine.stats()["rejected"] == 1
+    assert shared.total() == 5
+
+
+def test_hold_sets_the_quantity_and_release_returns_it(clock):
+    shared = SharedStock(100)
+    engine, _ = make_worker(shared, "a")
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=3)
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=5)
+    assert engine.held(PRODUCT_ID, 10) == 5
+
+    free = engine.stats()["products"][PRODUCT_ID]["free"]
+    engine.release(PRODUCT_ID, 10)
+    assert engine.held(PRODUCT_ID, 10) == 0
+    assert engine.stats()["products"][PRODUCT_ID]["free"] == free + 5
+
+
+def test_expired_holds_return_to_free_stock(clock):
+    shared = SharedStock(100)
+    engine, _ = make_worker(shared, "a", hold_seconds=60)
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=4)
+    clock.now += 61
+
+    assert engine.held(PRODUCT_ID, 10) == 0
+    assert engine.stats()["products"][PRODUCT_ID]["held"] == 0
+
+
+def test_consume_and_commit_sell_from_the_carved_stock(clock):
+    shared = SharedStock(100)
+    engine, store = make_worker(shared, "a")
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=2)
+    carved = store.row(PRODUCT_ID)["quantity"]
+    assert engine.consume(None, PRODUCT_ID, 2)
+    engine.commit(PRODUCT_ID, 10, 2)
+
+    assert store.row(PRODUCT_ID)["quantity"] == carved - 2
+    assert engine.held(PRODUCT_ID, 10) == 0
+    assert pool_total(engine) == carved - 2
+    assert shared.total() == 98
+    assert engine.stats()["sold"] == 2
+
+
+def test_reconcile_records_holds_and_returns_surplus(clock):
+    shared = SharedStock(100)
+    engine, store = make_worker(shared, "a", block_size=10)
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=30)
+    engine.release(PRODUCT_ID, 10)
+    assert engine.hold(PRODUCT_ID, user_id=20, quantity=1)
+
+    engine.reconcile()
+
+    # 手元に残すのは1ブロックまで。引当数は記録される
+    assert engine.stats()["products"][PRODUCT_ID]["free"] == 10
+    assert store.row(PRODUCT_ID)["held"] == 1
+    assert store.row(PRODUCT_ID)["quantity"] == 11
+    assert shared.total() == 100
+
+
+def test_reconcile_returns_idle_stock(clock):
+    shared = SharedStock(100)
+    engine, store = make_worker(shared, "a", hold_seconds=60)
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=1)
+    engine.release(PRODUCT_ID, 10)
+    clock.now += 61
+    engine.reconcile()
+
+    assert pool_total(engine) == 0
+    assert store.row(PRODUCT_ID)["quantity"] == 0
+    assert shared.stock[PRODUCT_ID] == 100
+
+
+def test_release_all_returns_held_stock_too(clock):
+    shared = SharedStock(100)
+    engine, _ = make_worker(shared, "a")
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=5)
+    engine.reconcile(release_all=True)
+
+    assert pool_total(engine) == 0
+    assert shared.stock[PRODUCT_ID] == 100
+
+
+def test_reconcile_restores_free_stock_when_giving_back_fails(clock):
+    shared = SharedStock(100)
+    engine, store = make_worker(shared, "a", block_size=10)
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=30)
+    engine.release(PRODUCT_ID, 10)
+    store.fail_give_back = True
+
+    with pytest.raises(RuntimeError):
+        engine.reconcile()
+    assert pool_total(engine) == store.row(PRODUCT_ID)["quantity"]
+
+
+def test_reclaimed_worker_drops_its_stock_on_reconcile(clock):
+    shared = SharedStock(100)
+    engine, _ = make_worker(shared, "a")
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=5)
+    shared.reclaim("a")
+    engine.reconcile()
+
+    assert pool_total(engine) == 0
+    assert engine.stats()["lost"] == 1
+    assert shared.stock[PRODUCT_ID] == 100
+
+
+def test_take_after_reclaim_does_not_count_reclaimed_stock(clock):
+    shared = SharedStock(100)
+    engine, store = make_worker(shared, "a", block_size=10)
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=5)
+    shared.reclaim("a")
+    # 手元の在庫では足りないので切り出し直す（その時点で回収に気付く）
+    assert engine.hold(PRODUCT_ID, user_id=20, quantity=50)
+
+    assert engine.held(PRODUCT_ID, 10) == 0
+    assert pool_total(engine) == store.row(PRODUCT_ID)["quantity"]
+    assert shared.total() == 100
+
+
+def test_consume_after_reclaim_resets_the_pool(clock):
+    shared = SharedStock(100)
+    engine, _ = make_worker(shared, "a")
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=2)
+    shared.reclaim("a")
+
+    assert not engine.consume(None, PRODUCT_ID, 2)
+    assert pool_total(engine) == 0
+    assert shared.stock[PRODUCT_ID] == 100
+
+
+def test_stale_lost_report_does_not_drop_stock_carved_afterwards(clock):
+    shared = SharedStock(100)
+    engine, store = make_worker(shared, "a", block_size=10)
+
+    assert engine.hold(PRODUCT_ID, user_id=10, quantity=1)
+    shared.reclaim("a")
+
+    # 回収を確認した後、反映する前に別のリクエストが切り出し直した場合
+    sync = store.sync
+
+    def sync_then_take(held):
+        result = sync(held)
+        assert engine.hold(PRODUCT_ID, user_id=20, quantity=20)
+        return result
+
+    store.sync = sync_then_take
+    engine.reconcile()
+
+    assert engine.held(PRODUCT_ID, 20) == 20
+    assert pool_total(engine) == store.row(PRODUCT_ID)["quantity"]
+    assert shared.total() == 100
+
+
+def connect(*engines):
+    # invalidation_bus の代わりに、引当の変更を他のワーカーへそのまま渡す
+    for engine in engines:
+        others = [other for other in engines if other is not engine]
+
+        def publish(changes, others=others):
+            for other in others:
+                other.drop_holds(changes)
+
+        engine.on_hold_change = publish
+
+
+def test_hold_on_another_worker_replaces_the_previous_hold(clock):
+    shared = SharedStock(100)
+    first, _ = make_worker(shared, "a", block_size=10)
+    second, _ = make_worker(shared, "b", block_size=10)
+    connect(first, second)
+
+    assert first.hold(PRODUCT_ID, user_id=10, quantity=2)
+    clock.now += 1
+    # 次のリクエストは別のワーカーに届き、カートの合計数で引き当て直す
+    assert second.hold(PRODUCT_ID, user_id=10, quantity=3)
+
+    assert first.held(PRODUCT_ID, 10) == 0
+    assert second.held(PRODUCT_ID, 10) == 3
+    assert first.stats()["products"][PRODUCT_ID]["held"] == 0
+
+
+def test_order_on_another_worker_drops_the_users_hold(clock):
+    shared = SharedStock(100)
+    first, _ = make_worker(shared, "a", block_size=10)
+    second, _ = make_worker(shared, "b", block_size=10)
+    connect(first, second)
+
+    assert first.hold(PRODUCT_ID, user_id=10, quantity=2)
+    clock.now += 1
+    # 注文確定は別のワーカーで、カートの数量を引き当ててから切り出し分を減らす
+    assert second.hold(PRODUCT_ID, user_id=10, quantity=2)
+    assert second.consume(None, PRODUCT_ID, 2)
+    second.commit(PRODUCT_ID, 10, 2)
+
+    assert first.held(PRODUCT_ID, 10) == 0
+    assert second.held(PRODUCT_ID, 10) == 0
+    first.reconcile(release_all=True)
+    second.reconcile(release_all=True)
+    assert shared.stock[PRODUCT_ID] == 98
+
+
+def test_release_user_drops_holds_on_other_workers(clock):
+    shared = SharedStock(100)
+    first, _ = make_worker(shared, "a", block_size=10)
+    second, _ = make_worker(shared, "b", block_size=10)
+    connect(first, second)
+
+    assert first.hold(PRODUCT_ID, user_id=10, quantity=2)
+    clock.now += 1
+    second.release_user(10)
+
+    assert first.held(PRODUCT_ID, 10) == 0
+
+
+def test_late_notification_does_not_drop_a_newer_hold(clock):
+    shared = SharedStock(100)
+    first, _ = make_worker(shared, "a", block_size=10)
+    second, _ = make_worker(shared, "b", block_size=10)
+    outbox = []
+    first.on_hold_change = outbox.append
+
+    assert first.hold(PRODUCT_ID, user_id=10, quantity=2)
+    clock.now += 1
+    assert second.hold(PRODUCT_ID, user_id=10, quantity=3)
+    # first の通知が second の引当より後に届いた場合
+    second.drop_holds(outbox[0])
+
+    assert second.held(PRODUCT_ID, 10) == 3
@@ -1,7 +1,7 @@
 import os
 import mysql.connector
 from mysql.connector import Error
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, TIMESTAMP
+from sqlalchemy import create_engine, inspect, text, Column, Integer, BigInteger, Float, String, Text, Date, ForeignKey, Index, TIMESTAMP
 from sqlalchemy.orm import relationship, sessionmaker, declarative_base
 from datetime import datetime
 
@@ -61,8 +61,29 @@ class Product(Base):
     price = Column(Integer, nullable=False)
     stock = Column(Integer, nullable=False)
     image_url = Column(String(255), nullable=True)
-    created_at = Column(TIMESTAMP, default=datetime.utcnow)
-    updated_at = Column(TIMESTAMP, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = Column(TIMESTAMP, nullable=False, default=datetime.utcnow, server_default=text("CURRENT_TIMESTAMP"))
+    # アプリ側のUPDATE文でも更新されるようDB側で自動更新する（検索インデックスの差分同期に使用）
+    updated_at = Column(
+        TIMESTAMP,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=text("CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP")
+    )
+
+    # 人気度（並び替え用）
+    popularity = Column(Float(53), nullable=False, default=0, server_default=text("0"))
+
+    # 一覧の絞り込み・並び替え用の複合インデックス（キーセットページングで末尾に id を含める）
+    __table_args__ = (
+        Index('ix_products_updated_at_id', 'updated_at', 'id'),
+        Index('ix_products_category_price_id', 'category_id', 'price', 'id'),
+        Index('ix_products_category_created_at_id', 'category_id', 'created_at', 'id'),
+        Index('ix_products_category_popularity_id', 'category_id', 'popularity', 'id'),
+        Index('ix_products_price_id', 'price', 'id'),
+        Index('ix_products_created_at_id', 'created_at', 'id'),
+        Index('ix_products_popularity_id', 'popularity', 'id'),
+    )
 
 # Userテーブルの定義
 class User(Base):
@@ -77,6 +98,53 @@ class User(Base):
     phone = Column(String(20), nullable=True)
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
 
+# 日別・商品別売上集計テーブルの定義（注文確定時に加算）
+class SalesDailyProduct(Base):
+    __tablename__ = 'sales_daily_product'
+    
+    product_id = Column(Integer, primary_key=True)
+    sales_date = Column(Date, primary_key=True)
+    category_id = Column(Integer, nullable=False)
+    units = Column(Integer, nullable=False, default=0)
+    revenue = Column(BigInteger, nullable=False, default=0)
+
+# 日別・カテゴリー別売上集計テーブルの定義（注文確定時に加算）
+class SalesDailyCategory(Base):
+    __tablename__ = 'sales_daily_category'
+    
+    category_id = Column(Integer, primary_key=True)
+    sales_date = Column(Date, primary_key=True)
+    units = Column(Integer, nullable=False, default=0)
+    revenue = Column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_sales_daily_category_sales_date', 'sales_date'),
+    )
+
+# 関連商品（よく一緒に購入されている商品）テーブルの定義（recommendations.py が作成）
+class ProductRelated(Base):
+    __tablename__ = 'product_related'
+    
+    product_id = Column(Integer, primary_key=True)
+    position = Column(Integer, primary_key=True)
+    related_product_id = Column(Integer, nullable=False)
+    score = Column(Float, nullable=False)
+
+# 在庫引当のワーカーごとの切り出し数テーブルの定義（backend/reservations.py が使用）
+# quantity: products.stock から切り出してまだ売れていない数 / held: そのうちカートで引当中の数
+class StockReservation(Base):
+    __tablename__ = 'stock_reservations'
+    
+    product_id = Column(Integer, primary_key=True)
+    worker_id = Column(String(100), primary_key=True)
+    quantity = Column(Integer, nullable=False, default=0)
+    held = Column(Integer, nullable=False, default=0, server_default=text("0"))
+    heartbeat_at = Column(TIMESTAMP, nullable=False, server_default=text("CURRENT_TIMESTAMP"))
+
+    __table_args__ = (
+        Index('ix_stock_reservations_heartbeat_at', 'heartbeat_at'),
+    )
+
 # データベース作成関数を実行
 create_database()
 
@@ -84,6 +152,90 @@ create_database()
 DATABASE_URL = f"mysql+mysqlconnector://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['database']}"
 engine = create_engine(DATABASE_URL, echo=True)
 
+# orders.order_number の桁数（注文番号は ORD- + ULID の30文字）
+ORDER_NUMBER_LENGTH = 32
+
+# 既存テーブルへのスキーマ変更を適用する関数
+def upgrade_tables():
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        # products.updated_at の自動更新・NOT NULL が未設定の場合だけ設定する
+        # （ON UPDATE はSQLAlchemyの inspector では取得できないため information_schema を参照する）
+        # NULL の行は検索インデックスの差分同期 (updated_at, id) > (...) に一致しないため、先に埋める
+        column = connection.execute(text("""
+            SELECT COLUMN_DEFAULT, EXTRA, IS_NULLABLE
+            FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'products' AND COLUMN_NAME = 'updated_at'
+        """)).mappings().first()
+        if column is not None and (
+            "CURRENT_TIMESTAMP" not in str(column["COLUMN_DEFAULT"]).upper()
+            or "ON UPDATE CURRENT_TIMESTAMP" not in str(column["EXTRA"]).upper()
+            or column["IS_NULLABLE"] == "YES"
+        ):
+            filled = connection.execute(text(
+                "UPDATE products SET updated_at = COALESCE(created_at, NOW()) WHERE updated_at IS NULL"
+            )).rowcount
+            if filled:
+                print(f"Filled 'products.updated_at' for {filled} rows.")
+            connection.execute(text(
+                "ALTER TABLE products MODIFY updated_at TIMESTAMP NOT NULL "
+                "DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"
+            ))
+            print("Column 'products.updated_at' set to update automatically.")
+
+        # products.created_at を NOT NULL にする
+        # （新着順のキーセットページングで NULL がカーソルに入ると、次のページの条件に何も一致しなくなる）
+        column = connection.execute(text("""
+            SELECT IS_NULLABLE
+            FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'products' AND COLUMN_NAME = 'created_at'
+        """)).mappings().first()
+        if column is not None and column["IS_NULLABLE"] == "YES":
+            filled = connection.execute(text(
+                "UPDATE products SET created_at = updated_at, updated_at = updated_at WHERE created_at IS NULL"
+            )).rowcount
+            if filled:
+                print(f"Filled 'products.created_at' for {filled} rows.")
+            connection.execute(text(
+                "ALTER TABLE products MODIFY created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP"
+            ))
+            print("Column 'products.created_at' set to NOT NULL.")
+
+    # 注文番号が入りきらない場合は orders.order_number を広げる
+    if inspector.has_table("orders"):
+        for column in inspector.get_columns("orders"):
+            length = getattr(column["type"], "length", None)
+            if column["name"] == "order_number" and length is not None and length < ORDER_NUMBER_LENGTH:
+                definition = f"VARCHAR({ORDER_NUMBER_LENGTH})"
+                if not column["nullable"]:
+                    definition += " NOT NULL"
+                with engine.begin() as connection:
+                    connection.execute(text(f"ALTER TABLE orders MODIFY order_number {definition}"))
+                print(f"Column 'orders.order_number' widened to {ORDER_NUMBER_LENGTH} characters.")
+
+    for table in Base.metadata.sorted_tables:
+        # 不足しているカラムを追加
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            definition = f"{column.name} {column.type.compile(dialect=engine.dialect)}"
+            if not column.nullable:
+                definition += " NOT NULL"
+            if column.server_default is not None:
+                definition += f" DEFAULT {column.server_default.arg}"
+            with engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+            print(f"Column '{table.name}.{column.name}' added.")
+
+        # 不足しているインデックスを作成
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+                print(f"Index '{index.name}' created.")
+
 # テーブルを作成
 Base.metadata.create_all(bind=engine)
+upgrade_tables()
 print("Tables created successfully.")
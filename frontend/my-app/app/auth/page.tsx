@@ -28,6 +28,7 @@ const LoginPage = () => {
 
       const data = await response.json();
       localStorage.setItem('userId', data.userId);
+      localStorage.setItem('sessionToken', data.token);
       router.push('/');
     } catch (err) {
       setError('ログインに失敗しました');
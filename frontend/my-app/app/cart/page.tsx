@@ -24,6 +24,7 @@ export default function Cart() {
 
   useEffect(() => {
     const userId = localStorage.getItem('userId');
+    const token = localStorage.getItem('sessionToken');
     if (!userId) {
       router.push('/auth/login');
       return;
@@ -31,10 +32,12 @@ export default function Cart() {
 
     const fetchCartItems = async () => {
       try {
-        const res = await fetch(`http://localhost:8000/api/cart/items?user_id=${userId}`);
+        const res = await fetch(`http://localhost:8000/api/cart?user_id=${userId}`, {
+          headers: token ? { 'Authorization': `Bearer ${token}` } : {},
+        });
         if (!res.ok) throw new Error('カートの取得に失敗しました');
         const data = await res.json();
-        setCartItems(data);
+        setCartItems(data.items);
       } catch (error) {
         console.error('カートの商品取得に失敗しました:', error);
       } finally {
@@ -53,7 +56,7 @@ export default function Cart() {
     }
 
     try {
-      const response = await fetch(`http://localhost:8000/api/cart/items/${itemId}`, {
+      const response = await fetch(`http://localhost:8000/api/cart/items/${itemId}?user_id=${userId}`, {
         method: 'PUT',
         headers: {
           'Content-Type': 'application/json',
@@ -63,9 +66,8 @@ export default function Cart() {
       
       if (!response.ok) throw new Error('数量の更新に失敗しました');
       
-      const res = await fetch(`http://localhost:8000/api/cart/items?user_id=${userId}`);
-      const data = await res.json();
-      setCartItems(data);
+      const data = await response.json();
+      setCartItems(data.cart.items);
     } catch (error) {
       console.error('数量の更新に失敗しました:', error);
     }
@@ -79,15 +81,14 @@ export default function Cart() {
     }
 
     try {
-      const response = await fetch(`http://localhost:8000/api/cart/items/${itemId}`, {
+      const response = await fetch(`http://localhost:8000/api/cart/items/${itemId}?user_id=${userId}`, {
         method: 'DELETE',
       });
       
       if (!response.ok) throw new Error('商品の削除に失敗しました');
       
-      const res = await fetch(`http://localhost:8000/api/cart/items?user_id=${userId}`);
-      const data = await res.json();
-      setCartItems(data);
+      const data = await response.json();
+      setCartItems(data.cart.items);
     } catch (error) {
       console.error('商品の削除に失敗しました:', error);
     }
@@ -95,6 +96,7 @@ export default function Cart() {
 
   const handlePurchase = async () => {
     const userId = localStorage.getItem('userId');
+    const token = localStorage.getItem('sessionToken');
     if (!userId) {
       router.push('/auth/login');
       return;
@@ -109,6 +111,7 @@ export default function Cart() {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          ...(token ? { 'Authorization': `Bearer ${token}` } : {}),
         },
         body: JSON.stringify({
           user_id: parseInt(userId),
@@ -11,6 +11,7 @@ interface Product {
   price: number;
   stock: number;
   image_url: string | null;
+  image_variants?: { thumb: string; medium: string } | null;
 }
 
 export default function CategoryProductsPage({ params }: { params: { id: string } }) {
@@ -87,7 +88,7 @@ export default function CategoryProductsPage({ params }: { params: { id: string
               {product.image_url ? (
                 <div className="relative aspect-square">
                   <img
-                    src={product.image_url}
+                    src={product.image_variants?.thumb ?? product.image_url}
                     alt={product.name}
                     className="w-full h-full object-cover"
                   />
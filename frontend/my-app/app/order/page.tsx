@@ -30,6 +30,7 @@ export default function OrderHistory() {
 
   useEffect(() => {
     const userId = localStorage.getItem('userId');
+    const token = localStorage.getItem('sessionToken');
     if (!userId) {
       router.push('/auth/login');
       return;
@@ -37,7 +38,9 @@ export default function OrderHistory() {
 
     const fetchOrders = async () => {
       try {
-        const res = await fetch(`http://localhost:8000/api/orders?user_id=${userId}`);
+        const res = await fetch(`http://localhost:8000/api/orders?user_id=${userId}`, {
+          headers: token ? { 'Authorization': `Bearer ${token}` } : {},
+        });
         if (!res.ok) throw new Error('注文履歴の取得に失敗しました');
         const data = await res.json();
         setOrders(data);
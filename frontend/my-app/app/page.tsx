@@ -11,11 +11,13 @@ interface Product {
   price: number;
   stock: number;
   image_url: string | null;
+  image_variants?: { thumb: string; medium: string } | null;
 }
 
 interface Category {
   id: number;
   name: string;
+  product_count: number;
 }
 
 export default function ECSite() {
@@ -28,13 +30,10 @@ export default function ECSite() {
     const fetchData = async () => {
       try {
         setIsLoading(true);
-        const productsRes = await fetch('http://localhost:8000/api/products');
-        const productsData = await productsRes.json();
-        setFeaturedProducts(productsData.slice(0, 5));
-
-        const categoriesRes = await fetch('http://localhost:8000/api/categories');
-        const categoriesData = await categoriesRes.json();
-        setCategories(categoriesData);
+        const res = await fetch('http://localhost:8000/api/home');
+        const data = await res.json();
+        setFeaturedProducts(data.featured);
+        setCategories(data.categories);
       } catch (error) {
         console.error('データの取得に失敗しました:', error);
       } finally {
@@ -100,7 +99,7 @@ export default function ECSite() {
                 {product.image_url ? (
                   <div className="relative aspect-square cursor-pointer">
                     <img 
-                      src={product.image_url} 
+                      src={product.image_variants?.thumb ?? product.image_url} 
                       alt={product.name}
                       className="w-full h-full object-cover"
                     />
@@ -133,6 +132,7 @@ export default function ECSite() {
               >
                 <div className="w-16 h-16 bg-[#EAEDED] rounded-full mx-auto mb-4"/>
                 <h3 className="text-center text-[#0F1111] font-medium">{category.name}</h3>
+                <p className="text-center text-sm text-gray-600">{category.product_count}点</p>
               </div>
             ))}
           </div>
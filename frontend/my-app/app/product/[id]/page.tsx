@@ -10,6 +10,7 @@ interface Product {
   price: number;
   stock: number;
   image_url: string | null;
+  image_variants?: { thumb: string; medium: string } | null;
 }
 
 import { useEffect, useState } from 'react';
@@ -39,8 +40,25 @@ export default function ProductDetail({ params }: { params: { id: string } }) {
     fetchProduct();
   }, [params.id]);
 
+  // 在庫数・価格の変更をサーバーから受け取る（Server-Sent Events）
+  useEffect(() => {
+    const source = new EventSource(`http://localhost:8000/api/products/stream?ids=${params.id}`);
+    source.addEventListener('product', (event) => {
+      const update = JSON.parse((event as MessageEvent).data);
+      setProduct((current) =>
+        current && current.id === update.id
+          ? { ...current, stock: update.stock, price: update.price }
+          : current
+      );
+      setQuantity((current) => Math.max(1, Math.min(current, update.stock, 10)));
+    });
+
+    return () => source.close();
+  }, [params.id]);
+
   const handleAddToCart = async () => {
     const userId = localStorage.getItem('userId');
+    const token = localStorage.getItem('sessionToken');
     if (!userId) {
       router.push('/auth/login');
       return;
@@ -54,6 +72,7 @@ export default function ProductDetail({ params }: { params: { id: string } }) {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          ...(token ? { 'Authorization': `Bearer ${token}` } : {}),
         },
         body: JSON.stringify({
           user_id: parseInt(userId),
@@ -76,6 +95,7 @@ export default function ProductDetail({ params }: { params: { id: string } }) {
 
   const handleDirectPurchase = async () => {
     const userId = localStorage.getItem('userId');
+    const token = localStorage.getItem('sessionToken');
     if (!userId) {
       router.push('/auth/login');
       return;
@@ -90,6 +110,7 @@ export default function ProductDetail({ params }: { params: { id: string } }) {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          ...(token ? { 'Authorization': `Bearer ${token}` } : {}),
         },
         body: JSON.stringify({
           user_id: parseInt(userId),
@@ -107,6 +128,7 @@ export default function ProductDetail({ params }: { params: { id: string } }) {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          ...(token ? { 'Authorization': `Bearer ${token}` } : {}),
         },
         body: JSON.stringify({
           user_id: parseInt(userId),
@@ -192,7 +214,7 @@ export default function ProductDetail({ params }: { params: { id: string } }) {
             <div>
               {product.image_url ? (
                 <img
-                  src={product.image_url}
+                  src={product.image_variants?.medium ?? product.image_url}
                   alt={product.name}
                   className="w-full rounded-lg"
                 />